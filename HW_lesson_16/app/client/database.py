@@ -36,6 +36,24 @@ class ClientDatabase:
             self.id = None
             self.name = contact
 
+    class SyncState:
+        '''
+        Класс - отображение для таблицы версии списков пользователей
+        и контактов, полученной с сервера.
+        '''
+        def __init__(self, version):
+            self.id = None
+            self.version = version
+
+    class PublicKeys:
+        '''
+        Класс - отображение для таблицы открытых ключей собеседников.
+        '''
+        def __init__(self, user, pubkey):
+            self.id = None
+            self.username = user
+            self.pubkey = pubkey
+
     # Конструктор класса:
     def __init__(self, name):
         # Создаём движок базы данных, поскольку разрешено несколько
@@ -76,6 +94,19 @@ class ClientDatabase:
                          Column('name', String, unique=True)
                          )
 
+        # Создаём таблицу версии списков
+        sync_state = Table('sync_state', self.metadata,
+                           Column('id', Integer, primary_key=True),
+                           Column('version', Integer)
+                           )
+
+        # Создаём таблицу открытых ключей собеседников
+        public_keys = Table('public_keys', self.metadata,
+                            Column('id', Integer, primary_key=True),
+                            Column('username', String, unique=True),
+                            Column('pubkey', Text)
+                            )
+
         # Создаём таблицы
         self.metadata.create_all(self.database_engine)
 
@@ -83,15 +114,16 @@ class ClientDatabase:
         mapper(self.KnownUsers, users)
         mapper(self.MessageStat, history)
         mapper(self.Contacts, contacts)
+        mapper(self.SyncState, sync_state)
+        mapper(self.PublicKeys, public_keys)
 
         # Создаём сессию
         Session = sessionmaker(bind=self.database_engine)
         self.session = Session()
 
-        # Необходимо очистить таблицу контактов, т.к. при запуске они
-        # подгружаются с сервера.
-        self.session.query(self.Contacts).delete()
-        self.session.commit()
+        # Таблицы контактов и пользователей сохраняются между запусками,
+        # при подключении с сервера загружаются только изменения с
+        # версии из sync_state.
 
     def add_contact(self, contact):
         """ Метод добавляющий контакт в базу данных. """
@@ -112,6 +144,53 @@ class ClientDatabase:
         self.session.query(self.Contacts).filter_by(name=contact).delete()
         self.session.commit()
 
+    def add_user(self, user):
+        """ Метод добавляющий пользователя в таблицу известных пользователей. """
+        if not self.check_user(user):
+            self.session.add(self.KnownUsers(user))
+            self.session.commit()
+
+    def del_user(self, user):
+        """ Метод удаляющий пользователя из таблицы известных пользователей. """
+        self.session.query(self.KnownUsers).filter_by(username=user).delete()
+        self.session.commit()
+
+    def get_version(self):
+        """ Метод возвращающий версию списков или None, если списки не загружались. """
+        state = self.session.query(self.SyncState).first()
+        return state.version if state else None
+
+    def set_version(self, version):
+        """ Метод сохраняющий версию списков. """
+        state = self.session.query(self.SyncState).first()
+        if state:
+            state.version = version
+        else:
+            self.session.add(self.SyncState(version))
+        self.session.commit()
+
+    def get_pubkey(self, user):
+        """ Метод возвращающий сохранённый открытый ключ пользователя или None. """
+        row = self.session.query(
+            self.PublicKeys.pubkey).filter_by(username=user).first()
+        return row[0] if row else None
+
+    def save_pubkey(self, user, pubkey):
+        """ Метод сохраняющий открытый ключ пользователя. """
+        self.session.query(self.PublicKeys).filter_by(username=user).delete()
+        self.session.add(self.PublicKeys(user, pubkey))
+        self.session.commit()
+
+    def del_pubkey(self, user):
+        """ Метод удаляющий сохранённый открытый ключ пользователя. """
+        self.session.query(self.PublicKeys).filter_by(username=user).delete()
+        self.session.commit()
+
+    def pubkeys_clear(self):
+        """ Метод, очищающий таблицу открытых ключей. """
+        self.session.query(self.PublicKeys).delete()
+        self.session.commit()
+
     def add_users(self, users_list):
         """ Метод, заполняющий таблицу известных пользователей. """
         self.session.query(self.KnownUsers).delete()
@@ -0,0 +1,100 @@
+import time
+from collections import OrderedDict
+from Crypto.Cipher import AES, PKCS1_OAEP
+from Crypto.Random import get_random_bytes
+import sys
+sys.path.append('../../')
+from common.variables import *
+
+# Первый байт сообщения, зашифрованного сеансовым ключом. Сообщение,
+# целиком зашифрованное RSA, имеет длину ключа собеседника, поэтому
+# форматы различаются по длине.
+HYBRID_MARKER = 0x01
+NONCE_LENGTH = 12
+TAG_LENGTH = 16
+
+
+class SessionEncryptor:
+    '''
+    Класс - шифрование сообщений одному собеседнику.
+    Сообщение шифруется AES-GCM сеансовым ключом, сеансовый ключ -
+    открытым ключом собеседника (RSA-OAEP). Зашифрованный сеансовый
+    ключ передаётся в каждом сообщении, поэтому получатель может
+    расшифровать любое сообщение независимо от остальных.
+    Формат: HYBRID_MARKER, ключ RSA, nonce, тег GCM, шифротекст.
+    '''
+
+    def __init__(self, public_key):
+        self.public_key = public_key
+        self.wrapper = PKCS1_OAEP.new(public_key)
+        self.rotate()
+
+    def rotate(self):
+        '''Метод создающий новый сеансовый ключ.'''
+        self.key = get_random_bytes(32)
+        self.wrapped = self.wrapper.encrypt(self.key)
+        self.count = 0
+        self.created = time.monotonic()
+
+    def encrypt(self, data):
+        '''
+        Метод шифрования сообщения.
+        :param data: байты сообщения.
+        :return: байты зашифрованного сообщения.
+        '''
+        if self.count >= SESSION_KEY_MESSAGES or \
+                time.monotonic() - self.created >= SESSION_KEY_LIFETIME:
+            self.rotate()
+        self.count += 1
+        cipher = AES.new(self.key, AES.MODE_GCM, nonce=get_random_bytes(NONCE_LENGTH))
+        # Зашифрованный сеансовый ключ защищён тегом сообщения.
+        cipher.update(self.wrapped)
+        ciphertext, tag = cipher.encrypt_and_digest(data)
+        return bytes((HYBRID_MARKER,)) + self.wrapped + cipher.nonce + tag + ciphertext
+
+
+class MessageDecrypter:
+    '''
+    Класс - расшифровка входящих сообщений закрытым ключом клиента.
+    Расшифрованные сеансовые ключи запоминаются, поэтому операция RSA
+    выполняется один раз на сеансовый ключ. Сообщения, целиком
+    зашифрованные RSA (старые клиенты), также расшифровываются.
+    '''
+
+    def __init__(self, keys):
+        self.unwrapper = PKCS1_OAEP.new(keys)
+        self.key_length = keys.size_in_bytes()
+        self.session_keys = OrderedDict()
+
+    def session_key(self, wrapped):
+        '''Метод возвращающий расшифрованный сеансовый ключ.'''
+        key = self.session_keys.get(wrapped)
+        if key is None:
+            key = self.unwrapper.decrypt(wrapped)
+            self.session_keys[wrapped] = key
+            if len(self.session_keys) > SESSION_KEYS_CACHE:
+                self.session_keys.popitem(last=False)
+        else:
+            self.session_keys.move_to_end(wrapped)
+        return key
+
+    def decrypt(self, data):
+        '''
+        Метод расшифровки сообщения.
+        При повреждённом сообщении или чужом ключе генерирует ValueError.
+        :param data: байты зашифрованного сообщения.
+        :return: байты сообщения.
+        '''
+        if len(data) == self.key_length:
+            return self.unwrapper.decrypt(data)
+        header = 1 + self.key_length
+        if len(data) < header + NONCE_LENGTH + TAG_LENGTH or \
+                data[0] != HYBRID_MARKER:
+            raise ValueError('Неизвестный формат сообщения.')
+        wrapped = data[1:header]
+        nonce = data[header:header + NONCE_LENGTH]
+        tag = data[header + NONCE_LENGTH:header + NONCE_LENGTH + TAG_LENGTH]
+        cipher = AES.new(self.session_key(wrapped), AES.MODE_GCM, nonce=nonce)
+        cipher.update(wrapped)
+        return cipher.decrypt_and_verify(
+            data[header + NONCE_LENGTH + TAG_LENGTH:], tag)
@@ -1,7 +1,6 @@
 from PyQt5.QtWidgets import QMainWindow, qApp, QMessageBox, QApplication, QListView
 from PyQt5.QtGui import QStandardItemModel, QStandardItem, QBrush, QColor
 from PyQt5.QtCore import pyqtSlot, QEvent, Qt
-from Crypto.Cipher import PKCS1_OAEP
 from Crypto.PublicKey import RSA
 import json
 import logging
@@ -12,6 +11,7 @@ sys.path.append('../../')
 from client.main_window_conv import Ui_MainClientWindow
 from client.add_contact import AddContactDialog
 from client.del_contact import DelContactDialog
+from client.encryption import SessionEncryptor, MessageDecrypter
 from common.errors import ServerError
 from common.variables import *
 
@@ -26,7 +26,14 @@ class ClientMainWindow(QMainWindow):
         self.transport = transport
 
         # объект - дешифорвщик сообщений с предзагруженным ключём
-        self.decrypter = PKCS1_OAEP.new(keys)
+        self.decrypter = MessageDecrypter(keys)
+        # Объекты шифрования собеседников {имя: SessionEncryptor},
+        # хранят сеансовые ключи между переключениями чатов.
+        self.encryptors = dict()
+        # Отправленные, но ещё не подтверждённые сообщения
+        # {номер: (получатель, текст)}. В историю сообщение попадает
+        # после подтверждения сервером.
+        self.sending = dict()
 
         # Загружаем конфигурацию окна из дизайнера
         self.ui = Ui_MainClientWindow()
@@ -140,8 +147,12 @@ class ClientMainWindow(QMainWindow):
                 self.current_chat)
             logger.debug(f'Загружен открытый ключ для {self.current_chat}')
             if self.current_chat_key:
-                self.encryptor = PKCS1_OAEP.new(
-                    RSA.import_key(self.current_chat_key))
+                self.encryptor = self.encryptors.get(self.current_chat)
+                public_key = RSA.import_key(self.current_chat_key)
+                if self.encryptor is None or \
+                        self.encryptor.public_key != public_key:
+                    self.encryptor = SessionEncryptor(public_key)
+                    self.encryptors[self.current_chat] = self.encryptor
         except (OSError, json.JSONDecodeError):
             self.current_chat_key = None
             self.encryptor = None
@@ -257,33 +268,44 @@ class ClientMainWindow(QMainWindow):
         self.ui.text_message.clear()
         if not message_text:
             return
-        # Шифруем сообщение ключом получателя и упаковываем в base64.
+        # Шифруем сообщение сеансовым ключом получателя и упаковываем в base64.
         message_text_encrypted = self.encryptor.encrypt(
             message_text.encode('utf8'))
         message_text_encrypted_base64 = base64.b64encode(
             message_text_encrypted)
-        try:
-            self.transport.send_message(
-                self.current_chat,
-                message_text_encrypted_base64.decode('ascii'))
-            pass
-        except ServerError as err:
-            self.messages.critical(self, 'Ошибка', err.text)
-        except OSError as err:
-            if err.errno:
-                self.messages.critical(
-                    self, 'Ошибка', 'Потеряно соединение с сервером!')
-                self.close()
-            self.messages.critical(self, 'Ошибка', 'Таймаут соединения!')
-        except (ConnectionResetError, ConnectionAbortedError):
-            self.messages.critical(
-                self, 'Ошибка', 'Потеряно соединение с сервером!')
-            self.close()
-        else:
-            self.database.save_message(self.current_chat, 'out', message_text)
-            logger.debug(
-                f'Отправлено сообщение для {self.current_chat}: {message_text}')
+        # Сообщение ставится в очередь отправки, результат приходит
+        # сигналами message_sent и message_failed.
+        message_id = self.transport.send_message(
+            self.current_chat,
+            message_text_encrypted_base64.decode('ascii'))
+        self.sending[message_id] = (self.current_chat, message_text)
+        logger.debug(
+            f'Отправлено сообщение для {self.current_chat}: {message_text}')
+
+    @pyqtSlot(int)
+    def message_sent(self, message_id):
+        '''
+        Слот обработчик подтверждения доставки сообщения сервером.
+        Сохраняет доставленное сообщение в истории.
+        '''
+        if message_id not in self.sending:
+            return
+        contact, message_text = self.sending.pop(message_id)
+        self.database.save_message(contact, 'out', message_text)
+        if contact == self.current_chat:
             self.history_list_update()
+        self.ui.statusBar.showMessage(
+            f'Сообщение для {contact} доставлено на сервер.', 2000)
+
+    @pyqtSlot(int, str)
+    def message_failed(self, message_id, error):
+        '''Слот обработчик ошибки отправки сообщения.'''
+        if message_id not in self.sending:
+            return
+        contact, message_text = self.sending.pop(message_id)
+        self.messages.warning(
+            self, 'Ошибка',
+            f'Сообщение для {contact} не доставлено: {error}\n{message_text}')
 
     @pyqtSlot(dict)
     def message(self, message):
@@ -367,6 +389,11 @@ class ClientMainWindow(QMainWindow):
                 'К сожалению собеседник был удалён с сервера.')
             self.set_disabled_input()
             self.current_chat = None
+        # Если собеседник сменил ключ, сохранённый ключ удалён -
+        # получаем новый.
+        elif self.current_chat and self.current_chat_key and \
+                self.database.get_pubkey(self.current_chat) != self.current_chat_key:
+            self.set_active_user()
         self.clients_list_update()
 
     def make_connection(self, trans_obj):
@@ -374,3 +401,5 @@ class ClientMainWindow(QMainWindow):
         trans_obj.new_message.connect(self.message)
         trans_obj.connection_lost.connect(self.connection_lost)
         trans_obj.message_205.connect(self.sig_205)
+        trans_obj.message_sent.connect(self.message_sent)
+        trans_obj.message_failed.connect(self.message_failed)
@@ -4,9 +4,14 @@ import time
 import logging
 import json
 import threading
+import collections
+import itertools
+import queue
+import errno
 import hashlib
 import hmac
 import binascii
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
 from PyQt5.QtCore import pyqtSignal, QObject
 
 sys.path.append('../../')
@@ -14,16 +19,30 @@ from common.utils import *
 from common.variables import *
 from common.errors import ServerError
 
-# Логер и объект блокировки для работы с сокетом.
+# Логер и объект блокировки для отправки в сокет.
 logger = logging.getLogger('client_dist')
 socket_lock = threading.Lock()
 
 
 class ClientTransport(threading.Thread, QObject):
+    '''
+    Класс - транспорт клиента.
+    Сокет читает отдельный поток reader: ответы на запросы он передаёт
+    ожидающим их потокам через Future по номеру запроса, остальные
+    сообщения сервера (сообщения пользователей, 205) - в очередь,
+    которую разбирает основной цикл транспорта run.
+    Сообщения пользователям отправляет поток sender из очереди outbox,
+    не дожидаясь подтверждения каждого: одновременно ожидают
+    подтверждения не более SEND_WINDOW сообщений.
+    '''
     # Сигналы новое сообщение и потеря соединения
     new_message = pyqtSignal(dict)
     message_205 = pyqtSignal()
     connection_lost = pyqtSignal()
+    # Сигналы результата отправки сообщения: номер сообщения
+    # и, при ошибке, её текст
+    message_sent = pyqtSignal(int)
+    message_failed = pyqtSignal(int, str)
 
     def __init__(self, port, ip_address, database, username, passwd, keys):
         # Вызываем конструкторы предков
@@ -40,12 +59,34 @@ class ClientTransport(threading.Thread, QObject):
         self.transport = None
         # Набор ключей для шифрования
         self.keys = keys
+        # Сообщения сервера, не являющиеся ответами на запросы,
+        # разбираются основным циклом. None - команда завершения.
+        self.pushes = queue.Queue()
+        # Запросы, ожидающие ответа {номер: Future}. Ответ без номера
+        # (сервер не возвращает номер) относится к самому раннему запросу.
+        self.requests = collections.OrderedDict()
+        self.requests_lock = threading.Lock()
+        self.request_ids = itertools.count(1)
+        # Очередь сообщений пользователям и число отправленных,
+        # но не подтверждённых сервером сообщений.
+        self.outbox = collections.deque()
+        self.in_flight = 0
+        self.outbox_ready = threading.Condition()
+        # Формат отправляемых кадров, выбирается сервером при авторизации.
+        self.codec = JSON_CODEC
+        # Флаг продолжения работы транспорта.
+        self.running = True
         # Устанавливаем соединение:
         self.connection_init(port, ip_address)
+        # Запускаем поток чтения сокета.
+        self.reader = threading.Thread(target=self.read_loop, daemon=True)
+        self.reader.start()
+        # Запускаем поток отправки сообщений.
+        self.sender = threading.Thread(target=self.send_loop, daemon=True)
+        self.sender.start()
         # Обновляем таблицы известных пользователей и контактов
         try:
-            self.user_list_update()
-            self.contacts_list_update()
+            self.lists_update()
         except OSError as err:
             if err.errno:
                 logger.critical(f'Потеряно соединение с сервером.')
@@ -55,8 +96,6 @@ class ClientTransport(threading.Thread, QObject):
         except json.JSONDecodeError:
             logger.critical(f'Потеряно соединение с сервером.')
             raise ServerError('Потеряно соединение с сервером!')
-            # Флаг продолжения работы транспорта.
-        self.running = True
 
     def connection_init(self, port, ip):
         '''Метод отвечающий за устанновку соединения с сервером.'''
@@ -108,7 +147,8 @@ class ClientTransport(threading.Thread, QObject):
                 USER: {
                     ACCOUNT_NAME: self.username,
                     PUBLIC_KEY: pubkey
-                }
+                },
+                CODECS: [BINARY_CODEC, JSON_CODEC, DEFLATE]
             }
             logger.debug(f"Presense message = {presense}")
             # Отправляем серверу приветственное сообщение.
@@ -123,14 +163,18 @@ class ClientTransport(threading.Thread, QObject):
                     elif ans[RESPONSE] == 511:
                         # Если всё нормально, то продолжаем процедуру
                         # авторизации.
+                        # Сервер, поддерживающий двоичный формат,
+                        # сообщает о его выборе.
+                        if ans.get(CODEC) == BINARY_CODEC:
+                            self.codec = BINARY_CODEC
                         ans_data = ans[DATA]
                         hash = hmac.new(passwd_hash_string, ans_data.encode('utf-8'), 'MD5')
                         digest = hash.digest()
                         my_ans = RESPONSE_511
                         my_ans[DATA] = binascii.b2a_base64(
                             digest).decode('ascii')
-                        send_message(self.transport, my_ans)
-                        self.process_server_ans(get_message(self.transport))
+                        send_message(self.transport, my_ans, self.codec)
+                        self.process_server_ans(self.get_response())
             except (OSError, json.JSONDecodeError) as err:
                 logger.debug(f'Connection error.', exc_info=err)
                 raise ServerError('Сбой соединения в процессе авторизации.')
@@ -146,8 +190,7 @@ class ClientTransport(threading.Thread, QObject):
             elif message[RESPONSE] == 400:
                 raise ServerError(f'{message[ERROR]}')
             elif message[RESPONSE] == 205:
-                self.user_list_update()
-                self.contacts_list_update()
+                self.notification_update(message)
                 self.message_205.emit()
             else:
                 logger.error(
@@ -161,8 +204,164 @@ class ClientTransport(threading.Thread, QObject):
                 f'Получено сообщение от пользователя {message[SENDER]}:{message[MESSAGE_TEXT]}')
             self.new_message.emit(message)
 
+    def get_response(self):
+        '''
+        Метод ожидающий ответ сервера при авторизации, до запуска
+        потока чтения. Сообщения, пришедшие раньше ответа, передаются
+        основному циклу.
+        '''
+        while True:
+            message = get_message(self.transport)
+            if RESPONSE in message and message[RESPONSE] != 205:
+                return message
+            self.pushes.put(message)
+
+    def request(self, message):
+        '''
+        Метод отправки запроса серверу и ожидания ответа.
+        При отсутствии ответа за REQUEST_TIMEOUT генерирует
+        TimeoutError (OSError без errno, как таймаут сокета).
+        :param message: словарь - запрос.
+        :return: словарь - ответ сервера.
+        '''
+        request_id, future = self.submit(message)
+        try:
+            return future.result(REQUEST_TIMEOUT)
+        except FutureTimeoutError:
+            self.cancel_request(request_id)
+            raise TimeoutError('Сервер не ответил на запрос.')
+
+    def submit(self, message):
+        '''
+        Метод отправки запроса серверу без ожидания ответа.
+        Запрос получает номер, если его нет; ответ с этим номером
+        передаёт поток чтения.
+        :param message: словарь - запрос.
+        :return: номер запроса и Future с ответом сервера.
+        '''
+        future = Future()
+        request_id = message.setdefault(REQUEST_ID, next(self.request_ids))
+        with socket_lock:
+            with self.requests_lock:
+                self.requests[request_id] = future
+            try:
+                send_message(self.transport, message, self.codec)
+            except OSError:
+                with self.requests_lock:
+                    self.requests.pop(request_id, None)
+                raise
+        return request_id, future
+
+    def cancel_request(self, request_id, err=None):
+        '''Метод прекращающий ожидание ответа на запрос.'''
+        with self.requests_lock:
+            future = self.requests.pop(request_id, None)
+        if future is not None and err is not None:
+            future.set_exception(err)
+
+    def resolve(self, message):
+        '''
+        Метод передающий ответ сервера ожидающему его запросу.
+        Возвращает False, если ожидающего запроса нет.
+        '''
+        with self.requests_lock:
+            request_id = message.get(REQUEST_ID)
+            if request_id is not None:
+                future = self.requests.pop(request_id, None)
+            elif self.requests:
+                future = self.requests.popitem(last=False)[1]
+            else:
+                future = None
+        if future is None:
+            return False
+        future.set_result(message)
+        return True
+
+    def fail_requests(self, err):
+        '''Метод завершающий ошибкой все ожидающие ответа запросы.'''
+        with self.requests_lock:
+            futures = list(self.requests.values())
+            self.requests.clear()
+        for future in futures:
+            future.set_exception(err)
+
+    def lists_update(self):
+        '''
+        Метод синхронизации списков пользователей и контактов с сервером.
+        Запрашивает изменения с сохранённой версии, если её нет или
+        сервер её не знает - загружает списки целиком.
+        '''
+        version = self.database.get_version()
+        if version is not None and self.changes_update(version):
+            return
+        users_version = self.user_list_update()
+        contacts_version = self.contacts_list_update()
+        if users_version is not None and contacts_version is not None:
+            # Пропущенные смены ключей неизвестны, сохранённые ключи
+            # запрашиваются заново.
+            self.database.pubkeys_clear()
+            self.database.set_version(min(users_version, contacts_version))
+
+    def changes_update(self, version):
+        '''
+        Метод запрашивающий изменения списков после версии version
+        и применяющий их к базе. Возвращает False, если сервер
+        не может выдать изменения.
+        '''
+        logger.debug(f'Запрос изменений списков с версии {version}')
+        req = {
+            ACTION: GET_CHANGES,
+            TIME: time.time(),
+            ACCOUNT_NAME: self.username,
+            VERSION: version
+        }
+        ans = self.request(req)
+        if not (RESPONSE in ans and ans[RESPONSE] == 202 and VERSION in ans):
+            logger.debug(f'Сервер не выдал изменения списков: {ans}')
+            return False
+        self.apply_changes(ans[LIST_INFO], ans[VERSION])
+        return True
+
+    def notification_update(self, message):
+        '''
+        Метод обработки уведомления 205 об изменении списков.
+        Если изменения в уведомлении отсчитаны от нашей версии, применяет
+        их сразу, уже полученные при синхронизации изменения пропускает,
+        иначе синхронизирует списки запросом к серверу.
+        '''
+        version = self.database.get_version()
+        if VERSION in message and LIST_INFO in message and \
+                message.get(BASE_VERSION) == version:
+            self.apply_changes(message[LIST_INFO], message[VERSION])
+        elif version and message.get(VERSION, version + 1) <= version:
+            logger.debug(f'Изменения версии {message[VERSION]} уже получены.')
+        else:
+            self.lists_update()
+
+    def apply_changes(self, changes, version):
+        '''Метод применяющий к базе изменения списков и сохраняющий их версию.'''
+        for kind, operation, name in changes:
+            if kind == 'user':
+                if operation == 'add':
+                    self.database.add_user(name)
+                else:
+                    self.database.del_user(name)
+                    self.database.del_pubkey(name)
+            elif kind == 'key':
+                self.database.del_pubkey(name)
+            elif kind == 'contact':
+                if operation == 'add':
+                    self.database.add_contact(name)
+                else:
+                    self.database.del_contact(name)
+        self.database.set_version(version)
+        logger.debug(f'Применено изменений списков: {len(changes)}')
+
     def contacts_list_update(self):
-        '''Метод обновляющий с сервера список контактов.'''
+        '''
+        Метод обновляющий с сервера список контактов.
+        Возвращает версию списков, если сервер её сообщил.
+        '''
         self.database.contacts_clear()
         logger.debug(f'Запрос контакт листа для пользователся {self.name}')
         req = {
@@ -171,44 +370,52 @@ class ClientTransport(threading.Thread, QObject):
             USER: self.username
         }
         logger.debug(f'Сформирован запрос {req}')
-        with socket_lock:
-            send_message(self.transport, req)
-            ans = get_message(self.transport)
+        ans = self.request(req)
         logger.debug(f'Получен ответ {ans}')
         if RESPONSE in ans and ans[RESPONSE] == 202:
             for contact in ans[LIST_INFO]:
                 self.database.add_contact(contact)
+            return ans.get(VERSION)
         else:
             logger.error('Не удалось обновить список контактов.')
 
     def user_list_update(self):
-        '''Метод обновляющий с сервера список пользователей.'''
+        '''
+        Метод обновляющий с сервера список пользователей.
+        Возвращает версию списков, если сервер её сообщил.
+        '''
         logger.debug(f'Запрос списка известных пользователей {self.username}')
         req = {
             ACTION: USERS_REQUEST,
             TIME: time.time(),
             ACCOUNT_NAME: self.username
         }
-        with socket_lock:
-            send_message(self.transport, req)
-            ans = get_message(self.transport)
+        ans = self.request(req)
         if RESPONSE in ans and ans[RESPONSE] == 202:
             self.database.add_users(ans[LIST_INFO])
+            return ans.get(VERSION)
         else:
             logger.error('Не удалось обновить список известных пользователей.')
 
     def key_request(self, user):
-        '''Метод запрашивающий с сервера публичный ключ пользователя.'''
+        '''
+        Метод возвращающий публичный ключ пользователя.
+        Ключ берётся из базы, а при его отсутствии запрашивается
+        с сервера и сохраняется. Сохранённый ключ удаляется при
+        получении от сервера уведомления о смене ключа.
+        '''
+        pubkey = self.database.get_pubkey(user)
+        if pubkey:
+            return pubkey
         logger.debug(f'Запрос публичного ключа для {user}')
         req = {
             ACTION: PUBLIC_KEY_REQUEST,
             TIME: time.time(),
             ACCOUNT_NAME: user
         }
-        with socket_lock:
-            send_message(self.transport, req)
-            ans = get_message(self.transport)
+        ans = self.request(req)
         if RESPONSE in ans and ans[RESPONSE] == 511:
+            self.database.save_pubkey(user, ans[DATA])
             return ans[DATA]
         else:
             logger.error(f'Не удалось получить ключ собеседника{user}.')
@@ -222,9 +429,7 @@ class ClientTransport(threading.Thread, QObject):
             USER: self.username,
             ACCOUNT_NAME: contact
         }
-        with socket_lock:
-            send_message(self.transport, req)
-            self.process_server_ans(get_message(self.transport))
+        self.process_server_ans(self.request(req))
 
     def remove_contact(self, contact):
         '''Метод отправляющий на сервер сведения о удалении контакта.'''
@@ -235,12 +440,17 @@ class ClientTransport(threading.Thread, QObject):
             USER: self.username,
             ACCOUNT_NAME: contact
         }
-        with socket_lock:
-            send_message(self.transport, req)
-            self.process_server_ans(get_message(self.transport))
+        self.process_server_ans(self.request(req))
 
     def transport_shutdown(self):
-        '''Метод уведомляющий сервер о завершении работы клиента.'''
+        '''
+        Метод уведомляющий сервер о завершении работы клиента.
+        Перед этим ожидает отправки и подтверждения очереди сообщений.
+        '''
+        with self.outbox_ready:
+            self.outbox_ready.wait_for(
+                lambda: not self.running or not (self.outbox or self.in_flight),
+                REQUEST_TIMEOUT)
         self.running = False
         message = {
             ACTION: EXIT,
@@ -249,55 +459,152 @@ class ClientTransport(threading.Thread, QObject):
         }
         with socket_lock:
             try:
-                send_message(self.transport, message)
+                send_message(self.transport, message, self.codec)
             except OSError:
                 pass
         logger.debug('Транспорт завершает работу.')
+        self.pushes.put(None)
+        with self.outbox_ready:
+            self.outbox_ready.notify()
         time.sleep(0.5)
 
     def send_message(self, to, message):
-        '''Метод отправляющий на сервер сообщения для пользователя.'''
+        '''
+        Метод ставящий в очередь отправки сообщение для пользователя.
+        Результат отправки сообщается сигналами message_sent
+        и message_failed.
+        :return: номер сообщения.
+        '''
         message_dict = {
             ACTION: MESSAGE,
             SENDER: self.username,
             DESTINATION: to,
             TIME: time.time(),
-            MESSAGE_TEXT: message
+            MESSAGE_TEXT: message,
+            REQUEST_ID: next(self.request_ids)
         }
         logger.debug(f'Сформирован словарь сообщения: {message_dict}')
-        # Необходимо дождаться освобождения сокета для отправки сообщения
-        with socket_lock:
-            send_message(self.transport, message_dict)
-            self.process_server_ans(get_message(self.transport))
-            logger.info(f'Отправлено сообщение для пользователя {to}')
+        with self.outbox_ready:
+            self.outbox.append(message_dict)
+            self.outbox_ready.notify()
+        return message_dict[REQUEST_ID]
 
-    def run(self):
-        '''Метод содержащий основной цикл работы транспортного потока.'''
-        logger.debug('Запущен процесс - приёмник собщений с сервера.')
+    def send_loop(self):
+        '''
+        Метод - цикл потока отправки сообщений пользователям.
+        Отправляет сообщения из очереди, пока число ожидающих
+        подтверждения меньше SEND_WINDOW. Сообщение, не подтверждённое
+        сервером за REQUEST_TIMEOUT, считается не доставленным.
+        '''
+        # Сроки подтверждения отправленных сообщений {номер: срок}.
+        # Срок отсчитывается от отправки, поэтому порядок словаря -
+        # это порядок сроков.
+        sent = collections.OrderedDict()
         while self.running:
-            # Отдыхаем секунду и снова пробуем захватить сокет.
-            # если не сделать тут задержку, то отправка может достаточно долго
-            # ждать освобождения сокета.
-            time.sleep(1)
-            message = None
-            with socket_lock:
-                try:
-                    self.transport.settimeout(0.5)
-                    message = get_message(self.transport)
-                except OSError as err:
-                    if err.errno:
-                        logger.critical(f'Потеряно соединение с сервером.')
-                        self.running = False
-                        self.connection_lost.emit()
-                # Проблемы с соединением
-                except (ConnectionError, ConnectionAbortedError, ConnectionResetError, json.JSONDecodeError, TypeError):
-                    logger.debug(f'Потеряно соединение с сервером.')
+            with self.outbox_ready:
+                timeout = self.expire_sent(sent)
+                if not self.outbox or self.in_flight >= SEND_WINDOW:
+                    self.outbox_ready.wait(timeout)
+                    continue
+                message = self.outbox.popleft()
+                self.in_flight += 1
+                message_id = message[REQUEST_ID]
+                sent[message_id] = time.monotonic() + REQUEST_TIMEOUT
+            try:
+                _, future = self.submit(message)
+            except OSError as err:
+                self.message_done(message_id, sent, err=err)
+                continue
+            future.add_done_callback(
+                lambda future, message_id=message_id:
+                self.message_done(message_id, sent, future))
+            logger.info(
+                f'Отправлено сообщение для пользователя {message[DESTINATION]}')
+        # Неотправленные к моменту завершения сообщения не доставлены.
+        with self.outbox_ready:
+            unsent = list(self.outbox)
+            self.outbox.clear()
+        for message in unsent:
+            self.message_failed.emit(
+                message[REQUEST_ID], 'Соединение с сервером закрыто.')
+
+    def expire_sent(self, sent):
+        '''
+        Метод отменяющий сообщения, не подтверждённые сервером в срок.
+        Вызывается под блокировкой outbox_ready.
+        Возвращает время до ближайшего срока, но не более REQUEST_TIMEOUT.
+        '''
+        now = time.monotonic()
+        while sent:
+            message_id, deadline = next(iter(sent.items()))
+            if deadline > now:
+                return deadline - now
+            del sent[message_id]
+            self.cancel_request(
+                message_id, TimeoutError('Сервер не подтвердил сообщение.'))
+        return REQUEST_TIMEOUT
+
+    def message_done(self, message_id, sent, future=None, err=None):
+        '''
+        Метод обработки результата отправки сообщения: освобождает место
+        в окне отправки и сообщает результат сигналом.
+        '''
+        with self.outbox_ready:
+            sent.pop(message_id, None)
+            self.in_flight -= 1
+            self.outbox_ready.notify()
+        if future is not None:
+            err = future.exception()
+        if err is None:
+            ans = future.result()
+            if ans.get(RESPONSE) == 200:
+                self.message_sent.emit(message_id)
+                return
+            err = ans.get(ERROR, f'Код ответа {ans.get(RESPONSE)}')
+        logger.error(f'Сообщение {message_id} не доставлено: {err}')
+        self.message_failed.emit(message_id, str(err))
+
+    def read_loop(self):
+        '''
+        Метод - цикл потока чтения сокета.
+        Ответы на запросы передаёт ожидающим потокам, остальные
+        сообщения - основному циклу. Таймаут сокета ограничивает
+        только отправку, при чтении он пропускается.
+        '''
+        logger.debug('Запущен поток чтения сообщений с сервера.')
+        while self.running:
+            try:
+                message = get_message(self.transport)
+            except socket.timeout:
+                continue
+            except (OSError, json.JSONDecodeError, TypeError) as err:
+                if self.running:
+                    logger.critical(f'Потеряно соединение с сервером.')
                     self.running = False
                     self.connection_lost.emit()
-                finally:
-                    self.transport.settimeout(5)
+                self.fail_requests(ConnectionResetError(
+                    errno.ECONNRESET, 'Потеряно соединение с сервером.'))
+                self.pushes.put(None)
+                return
+            logger.debug(f'Принято сообщение с сервера: {message}')
+            if RESPONSE in message and message[RESPONSE] != 205 \
+                    and self.resolve(message):
+                continue
+            self.pushes.put(message)
 
-            # Если сообщение получено, то вызываем функцию обработчик:
-            if message:
-                logger.debug(f'Принято сообщение с сервера: {message}')
+    def run(self):
+        '''
+        Метод содержащий основной цикл работы транспортного потока:
+        разбор сообщений пользователей и уведомлений сервера.
+        '''
+        logger.debug('Запущен процесс - приёмник собщений с сервера.')
+        while True:
+            message = self.pushes.get()
+            if message is None:
+                break
+            try:
                 self.process_server_ans(message)
+            except ServerError as err:
+                logger.error(f'Ошибка сервера: {err}')
+            except (OSError, json.JSONDecodeError) as err:
+                logger.error(f'Не удалось обработать сообщение сервера: {err}')
@@ -0,0 +1,267 @@
+import binascii
+import struct
+import zlib
+import sys
+sys.path.append('../../')
+from common.variables import *
+
+# Первый байт полезной нагрузки двоичного и сжатого кадров. JSON кадр
+# всегда начинается с '{', поэтому формат кадра определяется по первому
+# байту.
+BINARY_MARKER = 0x01
+COMPRESSED_MARKER = 0x02
+
+# Коды ключей протокола. Коды определяются позицией в списке, поэтому
+# новые ключи добавляются только в конец.
+KEYS = (ACTION, TIME, USER, ACCOUNT_NAME, SENDER, DESTINATION, DATA,
+        PUBLIC_KEY, RESPONSE, ERROR, MESSAGE_TEXT, LIST_INFO, CODECS, CODEC,
+        COMPRESSION, VERSION, BASE_VERSION, REQUEST_ID)
+KEY_CODES = {key: code for code, key in enumerate(KEYS, 1)}
+
+# Коды часто передаваемых строковых значений (действия, форматы).
+WORDS = (PRESENCE, MESSAGE, EXIT, GET_CONTACTS, REMOVE_CONTACT, ADD_CONTACT,
+         USERS_REQUEST, PUBLIC_KEY_REQUEST, JSON_CODEC, BINARY_CODEC, DEFLATE,
+         GET_CHANGES)
+WORD_CODES = {word: code for code, word in enumerate(WORDS)}
+
+# Поля, в которых передаются base64 строки и открытые ключи PEM.
+# Их значения передаются исходными байтами.
+BYTES_FIELDS = frozenset((MESSAGE_TEXT, DATA, PUBLIC_KEY))
+
+PEM_HEADER = '-----BEGIN PUBLIC KEY-----\n'
+PEM_FOOTER = '\n-----END PUBLIC KEY-----'
+
+# Типы значений.
+T_NONE, T_TRUE, T_FALSE, T_INT, T_FLOAT, T_STR, T_WORD, T_BASE64, \
+    T_PEM, T_LIST, T_DICT, T_BIGINT = range(12)
+
+LENGTH = struct.Struct('!I')
+INT = struct.Struct('!q')
+FLOAT = struct.Struct('!d')
+
+# Предельная вложенность списков и словарей.
+MAX_DEPTH = 32
+
+
+def b64(raw):
+    '''Функция кодирования байтов в base64 строку без перевода строки.'''
+    return binascii.b2a_base64(raw, newline=False).decode('ascii')
+
+
+def pack_base64(value):
+    '''
+    Функция преобразования base64 строки в байты.
+    Возвращает None, если строка не восстанавливается из байтов в точности.
+    '''
+    try:
+        raw = binascii.a2b_base64(value)
+    except (binascii.Error, ValueError):
+        return None
+    return raw if b64(raw) == value else None
+
+
+def unpack_pem(raw):
+    '''Функция восстановления открытого ключа PEM из байтов DER.'''
+    body = b64(raw)
+    lines = [body[i:i + 64] for i in range(0, len(body), 64)]
+    return PEM_HEADER + '\n'.join(lines) + PEM_FOOTER
+
+
+def pack_pem(value):
+    '''
+    Функция преобразования открытого ключа PEM в байты DER.
+    Возвращает None, если строка не восстанавливается в точности.
+    '''
+    if not (value.startswith(PEM_HEADER) and value.endswith(PEM_FOOTER)):
+        return None
+    body = value[len(PEM_HEADER):-len(PEM_FOOTER)].replace('\n', '')
+    raw = pack_base64(body)
+    if raw is None or unpack_pem(raw) != value:
+        return None
+    return raw
+
+
+def write_bytes(out, tag, raw):
+    '''Функция записи значения с длиной.'''
+    out.append(tag)
+    out += LENGTH.pack(len(raw))
+    out += raw
+
+
+def write_value(out, value, depth, field=None):
+    '''Функция записи значения в буфер.'''
+    if depth > MAX_DEPTH:
+        raise ValueError('Превышена вложенность сообщения.')
+    if value is None:
+        out.append(T_NONE)
+    elif value is True:
+        out.append(T_TRUE)
+    elif value is False:
+        out.append(T_FALSE)
+    elif isinstance(value, str):
+        if value in WORD_CODES:
+            out.append(T_WORD)
+            out.append(WORD_CODES[value])
+            return
+        if field in BYTES_FIELDS:
+            raw = pack_pem(value)
+            if raw is not None:
+                write_bytes(out, T_PEM, raw)
+                return
+            raw = pack_base64(value)
+            if raw is not None:
+                write_bytes(out, T_BASE64, raw)
+                return
+        write_bytes(out, T_STR, value.encode(ENCODING))
+    elif isinstance(value, int):
+        if -2 ** 63 <= value < 2 ** 63:
+            out.append(T_INT)
+            out += INT.pack(value)
+        else:
+            write_bytes(out, T_BIGINT, str(value).encode('ascii'))
+    elif isinstance(value, float):
+        out.append(T_FLOAT)
+        out += FLOAT.pack(value)
+    elif isinstance(value, (list, tuple)):
+        out.append(T_LIST)
+        out += LENGTH.pack(len(value))
+        for item in value:
+            write_value(out, item, depth + 1, field)
+    elif isinstance(value, dict):
+        out.append(T_DICT)
+        out += LENGTH.pack(len(value))
+        for key, item in value.items():
+            code = KEY_CODES.get(key)
+            if code:
+                out.append(code)
+            else:
+                if not isinstance(key, str):
+                    raise TypeError('Ключ сообщения должен быть строкой.')
+                write_bytes(out, 0, key.encode(ENCODING))
+            write_value(out, item, depth + 1, key)
+    else:
+        raise TypeError(f'Тип {type(value).__name__} не поддерживается.')
+
+
+def read_length(data, offset):
+    '''Функция чтения длины, возвращает длину и новое смещение.'''
+    length, = LENGTH.unpack_from(data, offset)
+    return length, offset + LENGTH.size
+
+
+def read_value(data, offset, depth):
+    '''Функция чтения значения, возвращает значение и новое смещение.'''
+    if depth > MAX_DEPTH:
+        raise ValueError('Превышена вложенность сообщения.')
+    tag = data[offset]
+    offset += 1
+    if tag == T_NONE:
+        return None, offset
+    if tag == T_TRUE:
+        return True, offset
+    if tag == T_FALSE:
+        return False, offset
+    if tag == T_INT:
+        return INT.unpack_from(data, offset)[0], offset + INT.size
+    if tag == T_FLOAT:
+        return FLOAT.unpack_from(data, offset)[0], offset + FLOAT.size
+    if tag == T_WORD:
+        return WORDS[data[offset]], offset + 1
+    if tag in (T_STR, T_BASE64, T_PEM, T_BIGINT):
+        length, offset = read_length(data, offset)
+        end = offset + length
+        if end > len(data):
+            raise ValueError('Неполное значение.')
+        raw = bytes(data[offset:end])
+        if tag == T_STR:
+            return raw.decode(ENCODING), end
+        if tag == T_BASE64:
+            return b64(raw), end
+        if tag == T_PEM:
+            return unpack_pem(raw), end
+        return int(raw.decode('ascii')), end
+    if tag == T_LIST:
+        count, offset = read_length(data, offset)
+        items = []
+        for _ in range(count):
+            item, offset = read_value(data, offset, depth + 1)
+            items.append(item)
+        return items, offset
+    if tag == T_DICT:
+        count, offset = read_length(data, offset)
+        result = {}
+        for _ in range(count):
+            code = data[offset]
+            offset += 1
+            if code:
+                key = KEYS[code - 1]
+            else:
+                length, offset = read_length(data, offset)
+                key = bytes(data[offset:offset + length]).decode(ENCODING)
+                offset += length
+            result[key], offset = read_value(data, offset, depth + 1)
+        return result, offset
+    raise ValueError(f'Неизвестный тип значения {tag}.')
+
+
+def dumps(message):
+    '''
+    Функция упаковки словаря в двоичный формат.
+    :param message: словарь для передачи.
+    :return: байты полезной нагрузки кадра.
+    '''
+    out = bytearray((BINARY_MARKER,))
+    write_value(out, message, 0)
+    return bytes(out)
+
+
+def loads(payload):
+    '''
+    Функция разбора двоичной полезной нагрузки кадра.
+    Любая ошибка формата приводит к TypeError, как и для JSON кадра,
+    не содержащего словаря.
+    :param payload: байты полезной нагрузки, начиная с BINARY_MARKER.
+    :return: словарь - сообщение.
+    '''
+    try:
+        message, offset = read_value(memoryview(payload), 1, 0)
+    except (ValueError, IndexError, struct.error, UnicodeDecodeError) as err:
+        raise TypeError(f'Повреждённый двоичный кадр: {err}')
+    if offset != len(payload) or not isinstance(message, dict):
+        raise TypeError('Повреждённый двоичный кадр.')
+    return message
+
+
+def deflate(compressor, payload):
+    '''
+    Функция сжатия полезной нагрузки кадра в поток сжатия соединения.
+    Поток общий для всех кадров соединения, поэтому повторяющиеся
+    данные (списки пользователей) сжимаются лучше. Каждый кадр
+    завершается Z_SYNC_FLUSH и распаковывается сразу по получении.
+    :param compressor: объект zlib.compressobj соединения.
+    :param payload: байты полезной нагрузки.
+    :return: байты сжатой полезной нагрузки, начиная с COMPRESSED_MARKER.
+    '''
+    return bytes((COMPRESSED_MARKER,)) + compressor.compress(payload) + \
+        compressor.flush(zlib.Z_SYNC_FLUSH)
+
+
+def inflate(decompressor, payload):
+    '''
+    Функция распаковки сжатой полезной нагрузки кадра.
+    :param decompressor: объект zlib.decompressobj соединения.
+    :param payload: байты сжатой полезной нагрузки, начиная с COMPRESSED_MARKER.
+    :return: байты исходной полезной нагрузки.
+    '''
+    try:
+        data = decompressor.decompress(memoryview(payload)[1:], MAX_FRAME_LENGTH)
+    except zlib.error as err:
+        raise TypeError(f'Повреждённый сжатый кадр: {err}')
+    if decompressor.unconsumed_tail:
+        raise TypeError('Превышен максимальный размер сообщения.')
+    return data
+
+
+def is_compressed(frame):
+    '''Функция проверяющая, сжат ли кадр (с заголовком длины).'''
+    return frame[4:5] == bytes((COMPRESSED_MARKER,))
@@ -1,9 +1,12 @@
-import socket
+import functools
+import itertools
 import logging
+import reprlib
 import sys
 sys.path.append('../../')
 import logs.config_client_log
 import logs.config_server_log
+from common.variables import LOG_ARG_LENGTH
 
 
 # метод определения модуля, источника запуска.
@@ -15,20 +18,49 @@ else:
     logger = logging.getLogger('client_dist')
 
 
-def log(func_to_log):
+# Представление параметров вызова для лога с ограничением длины.
+arg_repr = reprlib.Repr()
+arg_repr.maxstring = arg_repr.maxother = LOG_ARG_LENGTH
+arg_repr.maxdict = arg_repr.maxlist = arg_repr.maxtuple = 16
+
+
+class LazyRepr:
+    """
+    Класс - отложенное представление объекта для лога.
+    repr строится только при форматировании записи, то есть только
+    если запись действительно будет выведена.
+    """
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return arg_repr.repr(self.value)
+
+
+def log(func_to_log=None, *, sample=1):
     """
     Декоратор, выполняющий логирование вызовов функций.
     Сохраняет события типа debug, содержащие
     информацию о имени вызываемой функиции, параметры с которыми
     вызывается функция, и модуль, вызывающий функцию.
+    Если уровень debug отключён, вызов не формирует запись вовсе.
+    Применяется как @log или @log(sample=N) - тогда записывается
+    каждый N-й вызов.
     """
+    if func_to_log is None:
+        return functools.partial(log, sample=sample)
+    calls = itertools.count()
 
+    @functools.wraps(func_to_log)
     def log_saver(*args, **kwargs):
-        logger.debug(
-            f'Была вызвана функция {func_to_log.__name__} c параметрами {args} , {kwargs}. '
-            f'Вызов из модуля {func_to_log.__module__}')
-        ret = func_to_log(*args, **kwargs)
-        return ret
+        if logger.isEnabledFor(logging.DEBUG) and next(calls) % sample == 0:
+            logger.debug(
+                'Была вызвана функция %s c параметрами %s , %s. Вызов из модуля %s',
+                func_to_log.__name__, LazyRepr(args), LazyRepr(kwargs),
+                func_to_log.__module__)
+        return func_to_log(*args, **kwargs)
 
     return log_saver
 
@@ -36,8 +68,8 @@ def log(func_to_log):
 def login_required(func):
     """
     Декоратор, проверяющий, что клиент авторизован на сервере.
-    Проверяет, что передаваемый объект сокета находится в
-    списке авторизованных клиентов.
+    Проверяет, что сессия передаваемого объекта сокета
+    отмечена как авторизованная.
     За исключением передачи словаря-запроса
     на авторизацию. Если клиент не авторизован,
     генерирует исключение TypeError
@@ -62,14 +94,13 @@ def login_required(func):
         from common.variables import ACTION, PRESENCE
         if isinstance(args[0], MessageProcessor):
             found = False
-            for arg in args:
-                if isinstance(arg, socket.socket):
-                    # Проверяем, что данный сокет есть в списке names класса
-                    # MessageProcessor
-                    for client in args[0].names:
-                        # args[0].names = {'test1': <socket.socket fd=25, family=AddressFamily.AF_INET, type=SocketKind.SOCK_STREAM, proto=0, laddr=('127.0.0.1', 7777), raddr=('127.0.0.1', 52420)>}
-                        if args[0].names[client] == arg:
-                            found = True
+            for arg in args[1:]:
+                # Клиент - это сокет, либо объект соединения asyncio.
+                if not isinstance(arg, dict):
+                    # Проверяем по сессии клиента, что он авторизован.
+                    # args[0].sessions = {<socket.socket fd=25, ...>: <ClientSession test1 ...>}
+                    if args[0].is_authorized(arg):
+                        found = True
 
             # Теперь надо проверить, что передаваемые аргументы не presence
             # сообщение. Если presence, то разрешаем
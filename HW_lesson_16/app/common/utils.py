@@ -1,37 +1,159 @@
+import collections
+import errno
 import json
+import struct
 import sys
+import weakref
+import zlib
 
 sys.path.append('../../')
 from common.variables import *
 from common.decos import log
+from common import codec
 
-@log
-def get_message(client):
+# Заголовок кадра: длина полезной нагрузки (4 байта, сетевой порядок).
+FRAME_HEADER = struct.Struct('!I')
+
+# Буферы приёма, привязанные к сокетам. Запись удаляется автоматически
+# вместе с объектом сокета.
+_decoders = weakref.WeakKeyDictionary()
+
+
+class FrameDecoder:
     '''
-    Функция приёма сообщений от удалённых компьютеров.
-    Принимает сообщения JSON, декодирует полученное сообщение
-    и проверяет что получен словарь.
-    :param client: сокет для передачи данных.
+    Класс - потоковый разборщик кадров протокола.
+    Накапливает байты, прочитанные из сокета, и выделяет из них
+    полные кадры вида <длина><JSON или двоичный формат>. Одно чтение из сокета может
+    дать ноль, один или несколько кадров, неполный кадр остаётся
+    в буфере до следующего чтения.
+    '''
+
+    def __init__(self):
+        self.buffer = bytearray()
+        # Разобранные, но ещё не забранные сообщения.
+        self.messages = collections.deque()
+        # Поток распаковки сжатых кадров, создаётся при первом из них.
+        self.decompressor = None
+
+    def feed(self, data):
+        '''
+        Метод добавляющий принятые байты в буфер и разбирающий
+        все полные кадры.
+        :param data: байты, прочитанные из сокета.
+        :return: количество новых разобранных сообщений.
+        '''
+        self.buffer += data
+        offset = 0
+        count = 0
+        while len(self.buffer) - offset >= FRAME_HEADER.size:
+            length, = FRAME_HEADER.unpack_from(self.buffer, offset)
+            # Слишком длинный кадр - признак испорченного потока.
+            if length > MAX_FRAME_LENGTH:
+                raise TypeError
+            end = offset + FRAME_HEADER.size + length
+            if len(self.buffer) < end:
+                break
+            payload = bytes(self.buffer[offset + FRAME_HEADER.size:end])
+            if payload[:1] == bytes((codec.COMPRESSED_MARKER,)):
+                if self.decompressor is None:
+                    self.decompressor = zlib.decompressobj()
+                payload = codec.inflate(self.decompressor, payload)
+            self.messages.append(decode_message(payload))
+            offset = end
+            count += 1
+        if offset:
+            del self.buffer[:offset]
+        return count
+
+
+def encode_message(message, fmt=JSON_CODEC, compressor=None):
+    '''
+    Функция упаковки словаря в кадр: заголовок с длиной и JSON
+    либо двоичный формат common.codec.
+    :param message: словарь для передачи.
+    :param fmt: формат кадра, JSON_CODEC или BINARY_CODEC.
+    :param compressor: поток сжатия соединения, если сжатие согласовано.
+    Кадры короче COMPRESS_THRESHOLD не сжимаются.
+    :return: байты кадра.
+    '''
+    if fmt == BINARY_CODEC:
+        payload = codec.dumps(message)
+    else:
+        payload = json.dumps(message).encode(ENCODING)
+    if compressor is not None and len(payload) >= COMPRESS_THRESHOLD:
+        payload = codec.deflate(compressor, payload)
+    if len(payload) > MAX_FRAME_LENGTH:
+        raise ValueError('Превышен максимальный размер сообщения.')
+    return FRAME_HEADER.pack(len(payload)) + payload
+
+
+def decode_message(payload):
+    '''
+    Функция разбора полезной нагрузки кадра.
+    Формат определяется по первому байту, поэтому принимаются кадры
+    в любом формате. Декодирует JSON и проверяет, что получен словарь.
+    Любая ошибка формата приводит к TypeError.
+    :param payload: байты полезной нагрузки кадра.
     :return: словарь - сообщение.
     '''
-    encoded_response = client.recv(MAX_PACKAGE_LENGTH)
-    json_response = encoded_response.decode(ENCODING)
-    response = json.loads(json_response)
+    if payload[:1] == bytes((codec.BINARY_MARKER,)):
+        return codec.loads(payload)
+    # Неверная кодировка, испорченный JSON и слишком глубокая вложенность -
+    # ошибки протокола, как и кадр, не содержащий словаря.
+    try:
+        response = json.loads(payload.decode(ENCODING))
+    except (ValueError, RecursionError) as err:
+        raise TypeError(f'Повреждённый кадр: {err}')
     if isinstance(response, dict):
         return response
     else:
         raise TypeError
 
 
-@log
-def send_message(sock, message):
+def get_decoder(sock):
+    '''Функция возвращающая буфер приёма, связанный с сокетом.'''
+    decoder = _decoders.get(sock)
+    if decoder is None:
+        decoder = _decoders[sock] = FrameDecoder()
+    return decoder
+
+
+def receive(sock):
+    '''
+    Функция чтения очередной порции байтов из сокета.
+    При закрытии соединения удалённой стороной
+    генерирует ConnectionResetError.
+    '''
+    data = sock.recv(MAX_PACKAGE_LENGTH)
+    if not data:
+        raise ConnectionResetError(
+            errno.ECONNRESET, 'Соединение закрыто удалённой стороной.')
+    return data
+
+
+@log(sample=LOG_SAMPLE)
+def get_message(client):
+    '''
+    Функция приёма сообщений от удалённых компьютеров.
+    Возвращает очередное сообщение из буфера сокета, при необходимости
+    дочитывая данные из сокета до получения полного кадра.
+    :param client: сокет для передачи данных.
+    :return: словарь - сообщение.
+    '''
+    decoder = get_decoder(client)
+    while not decoder.messages:
+        decoder.feed(receive(client))
+    return decoder.messages.popleft()
+
+
+@log(sample=LOG_SAMPLE)
+def send_message(sock, message, fmt=JSON_CODEC):
     '''
     Функция отправки словарей через сокет.
-    Кодирует словарь в формат JSON и отправляет через сокет.
+    Упаковывает словарь в кадр и отправляет его через сокет целиком.
     :param sock: сокет для передачи
     :param message: словарь для передачи
+    :param fmt: формат кадра, JSON_CODEC или BINARY_CODEC
     :return: ничего не возвращает
     '''
-    js_message = json.dumps(message)
-    encoded_message = js_message.encode(ENCODING)
-    sock.send(encoded_message)
+    sock.sendall(encode_message(message, fmt))
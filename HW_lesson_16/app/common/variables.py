@@ -5,13 +5,83 @@ DEFAULT_PORT = 7777
 # IP адрес по умолчанию для подключения клиента
 DEFAULT_IP_ADDRESS = '127.0.0.1'
 # Максимальная очередь подключений
-MAX_CONNECTIONS = 5
-# Максимальная длина сообщения в байтах
-MAX_PACKAGE_LENGTH = 10240
+MAX_CONNECTIONS = 512
+# Размер блока, читаемого из сокета за один вызов recv
+MAX_PACKAGE_LENGTH = 65536
+# Максимальная длина одного сообщения (кадра) в байтах
+MAX_FRAME_LENGTH = 16 * 1024 * 1024
+# Время на авторизацию клиента после подключения, в секундах
+AUTH_TIMEOUT = 5
+# Время ожидания клиентом ответа сервера на запрос, в секундах
+REQUEST_TIMEOUT = 5
+# Число отправленных клиентом сообщений, ожидающих подтверждения
+SEND_WINDOW = 32
+# Кадры короче этого размера (байты) не сжимаются
+COMPRESS_THRESHOLD = 1024
+# Изменения списков за это время (секунды) рассылаются одним уведомлением
+NOTIFY_DELAY = 0.2
+# Статистика сообщений записывается в базу пакетом раз в указанное
+# число сообщений или раз в указанное число секунд
+STAT_FLUSH_COUNT = 500
+STAT_FLUSH_INTERVAL = 1.0
+
+# Число последних записей журнала изменений списков, хранимых сервером.
+# Клиент с более старой версией списков загружает их целиком
+CHANGES_JOURNAL_LIMIT = 10000
+
+# Пауза перед перезапуском аварийно завершившегося процесса сервера, секунды
+WORKER_RESTART_DELAY = 1.0
+
+# Предел объёма неотправленных данных между процессами сервера
+BUS_HIGH_WATER = 64 * 1024 * 1024
+
+# Число отложенных сообщений, доставляемых пользователю за один раз
+OFFLINE_BATCH = 100
+
+# Сеансовый ключ шифрования сообщений собеседнику заменяется после
+# указанного числа сообщений или времени жизни (секунды)
+SESSION_KEY_MESSAGES = 100
+SESSION_KEY_LIFETIME = 3600
+# Число расшифрованных сеансовых ключей, хранимых клиентом
+SESSION_KEYS_CACHE = 256
+
+# Журнал событий сервера: размер буфера (байты), период записи
+# (секунды), размер файла до ротации (байты) и число старых файлов
+EVENTS_BUFFER = 64 * 1024
+EVENTS_FLUSH_INTERVAL = 1.0
+EVENTS_MAX_BYTES = 64 * 1024 * 1024
+EVENTS_BACKUPS = 5
+
+# Границы корзин гистограмм времени в метриках сервера, секунды
+METRICS_BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+                   0.05, 0.1, 0.25, 0.5, 1.0)
+
+# Профилирование сервера по команде: длительность по умолчанию
+# и период снятия стеков в режиме выборки, секунды
+PROFILE_SECONDS = 30
+PROFILE_INTERVAL = 0.005
+
+# Параметры SQLite базы сервера: объём отображения файла в память
+# (байты) и кэш страниц (отрицательное значение - в килобайтах)
+SQLITE_MMAP_SIZE = 64 * 1024 * 1024
+SQLITE_CACHE_SIZE = -16384
+
+# Предел объёма неотправленных данных для одного клиента на сервере
+OUTBOUND_HIGH_WATER = 4 * 1024 * 1024
+# Действие при превышении предела: disconnect - отключить клиента,
+# drop - отбрасывать новые сообщения, пока очередь не освободится
+OVERFLOW_POLICY = 'disconnect'
 # Кодировка проекта
 ENCODING = 'utf-8'
 # Текущий уровень логирования
 LOGGING_LEVEL = logging.DEBUG
+# Декоратор log записывает каждый LOG_SAMPLE-й вызов функций приёма
+# и отправки сообщений, параметры вызова обрезаются до LOG_ARG_LENGTH
+# символов
+LOG_SAMPLE = 1
+LOG_ARG_LENGTH = 200
+# Размер очереди записей лога, при переполнении записи отбрасываются
+LOG_QUEUE_SIZE = 10000
 # База данных для хранения данных сервера:
 SERVER_CONFIG = 'server_dist+++.ini'
 
@@ -38,6 +108,25 @@ REMOVE_CONTACT = 'remove'
 ADD_CONTACT = 'add'
 USERS_REQUEST = 'get_users'
 PUBLIC_KEY_REQUEST = 'pubkey_need'
+# Запрос изменений списков пользователей и контактов с указанной версии
+GET_CHANGES = 'get_changes'
+VERSION = 'version'
+# Версия, от которой отсчитаны изменения в уведомлении 205
+BASE_VERSION = 'base_version'
+# Номер запроса клиента, сервер возвращает его в ответе
+REQUEST_ID = 'request_id'
+# Уведомление процессов сервера об изменении списков (только шина)
+LISTS_CHANGED = 'lists_changed'
+# Форматы кадров: клиент перечисляет поддерживаемые в presence (codecs),
+# сервер сообщает выбранный в ответе 511 (codec)
+CODECS = 'codecs'
+CODEC = 'codec'
+JSON_CODEC = 'json'
+BINARY_CODEC = 'binary'
+# Сжатие кадров: клиент указывает DEFLATE в codecs, сервер подтверждает
+# ключом compression в ответе 511
+COMPRESSION = 'compression'
+DEFLATE = 'deflate'
 
 # Словари - ответы:
 # 200
@@ -3,6 +3,7 @@ import os
 sys.path.append('../../')
 import logging
 from common.variables import LOGGING_LEVEL
+from logs.log_queue import start_queue_logging
 
 # создаём формировщик логов (formatter):
 client_formatter = logging.Formatter('%(asctime)s %(levelname)s %(filename)s %(message)s')
@@ -18,10 +19,10 @@ steam.setLevel(logging.INFO)
 log_file = logging.FileHandler(path, encoding='utf8')
 log_file.setFormatter(client_formatter)
 
-# создаём регистратор и настраиваем его
+# создаём регистратор и настраиваем его, запись в файл и консоль
+# выполняется в отдельном потоке
 logger = logging.getLogger('client_dist')
-logger.addHandler(steam)
-logger.addHandler(log_file)
+queue_handler = start_queue_logging(logger, steam, log_file)
 logger.setLevel(LOGGING_LEVEL)
 
 # отладка
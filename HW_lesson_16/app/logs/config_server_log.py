@@ -4,6 +4,7 @@ import logging
 import logging.handlers
 import os
 from common.variables import LOGGING_LEVEL
+from logs.log_queue import start_queue_logging
 
 # создаём формировщик логов (formatter):
 server_formatter = logging.Formatter('%(asctime)s %(levelname)s %(filename)s %(message)s')
@@ -19,10 +20,10 @@ steam.setLevel(logging.INFO)
 log_file = logging.handlers.TimedRotatingFileHandler(path, encoding='utf8', interval=1, when='D')
 log_file.setFormatter(server_formatter)
 
-# создаём регистратор и настраиваем его
+# создаём регистратор и настраиваем его, запись в файл и консоль
+# выполняется в отдельном потоке
 logger = logging.getLogger('server_dist')
-logger.addHandler(steam)
-logger.addHandler(log_file)
+queue_handler = start_queue_logging(logger, steam, log_file)
 logger.setLevel(LOGGING_LEVEL)
 
 # отладка
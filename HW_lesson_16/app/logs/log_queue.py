@@ -0,0 +1,99 @@
+import atexit
+import logging
+import logging.handlers
+import queue
+import sys
+sys.path.append('../../')
+from common.variables import LOG_QUEUE_SIZE
+
+# Типы аргументов записи, которые безопасно форматировать в другом потоке.
+SCALARS = (str, bytes, int, float, type(None))
+# Форматтер, переводящий трассировку исключения в текст.
+TRACEBACKS = logging.Formatter()
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    '''
+    Класс - обработчик, передающий записи лога в ограниченную очередь.
+    Если очередь заполнена, запись отбрасывается и учитывается
+    в счётчике dropped, поток, пишущий в лог, никогда не ждёт.
+    Число отброшенных записей выводится в лог отдельной записью,
+    как только в очереди появится место.
+    '''
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        # Отброшено записей всего и с последнего сообщения об отбросе.
+        self.dropped = 0
+        self.unreported = 0
+
+    def prepare(self, record):
+        '''
+        Метод подготовки записи к передаче в очередь.
+        Неизменяемые аргументы (строки, числа) передаются как есть,
+        и запись форматирует поток QueueListener. Если среди аргументов
+        есть другие объекты (словари, сокеты, LazyRepr), сообщение
+        формируется здесь: к моменту записи объект может измениться
+        или быть закрыт. Трассировка исключения также переводится
+        в текст, чтобы запись не удерживала кадры стека.
+        '''
+        args = record.args
+        if args and not (isinstance(args, tuple) and all(
+                isinstance(arg, SCALARS) for arg in args)):
+            record.msg = record.getMessage()
+            record.args = None
+        if record.exc_info:
+            record.exc_text = TRACEBACKS.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        '''Метод помещающий запись в очередь без ожидания.'''
+        if self.unreported:
+            report = logging.LogRecord(
+                record.name, logging.WARNING, __file__, 0,
+                'Очередь лога переполнена, отброшено записей: %d',
+                (self.unreported,), None)
+            try:
+                self.queue.put_nowait(report)
+            except queue.Full:
+                self.drop()
+                return
+            self.unreported = 0
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.drop()
+
+    def drop(self):
+        '''Метод учёта отброшенной записи.'''
+        self.dropped += 1
+        self.unreported += 1
+
+
+class FlushingQueueListener(logging.handlers.QueueListener):
+    '''
+    Класс - поток записи лога из очереди.
+    При остановке дожидается места в очереди для команды завершения,
+    поэтому все принятые записи дописываются.
+    '''
+
+    def enqueue_sentinel(self):
+        self.queue.put(self._sentinel)
+
+
+def start_queue_logging(logger, *handlers):
+    '''
+    Функция подключающая к логеру обработчики через очередь.
+    Обработчики (запись в файл, вывод в консоль) работают в потоке
+    QueueListener, при завершении программы очередь дописывается.
+    :return: обработчик очереди, подключённый к логеру.
+    '''
+    log_queue = queue.Queue(LOG_QUEUE_SIZE)
+    handler = DroppingQueueHandler(log_queue)
+    listener = FlushingQueueListener(
+        log_queue, *handlers, respect_handler_level=True)
+    logger.addHandler(handler)
+    listener.start()
+    atexit.register(listener.stop)
+    return handler
@@ -9,7 +9,10 @@ from common.variables import *
 from common.utils import *
 from common.decos import log
 from server.core import MessageProcessor
+from server.async_core import AsyncMessageProcessor
 from server.database import ServerStorage
+from server.workers import WorkerPool
+from server.profiling import Profiler
 from server.main_window import MainWindow
 from PyQt5.QtWidgets import QApplication
 from PyQt5.QtCore import Qt
@@ -26,12 +29,16 @@ def arg_parser(default_port, default_address):
     parser.add_argument('-p', default=default_port, type=int, nargs='?')
     parser.add_argument('-a', default=default_address, nargs='?')
     parser.add_argument('--no_gui', action='store_true')
+    parser.add_argument('--asyncio', action='store_true')
+    parser.add_argument('--workers', default=1, type=int)
     namespace = parser.parse_args(sys.argv[1:])
     listen_address = namespace.a
     listen_port = namespace.p
     gui_flag = namespace.no_gui
+    async_flag = namespace.asyncio
+    workers = namespace.workers
     logger.debug('Аргументы успешно загружены.')
-    return listen_address, listen_port, gui_flag
+    return listen_address, listen_port, gui_flag, async_flag, workers
 
 
 @log
@@ -49,6 +56,10 @@ def config_load():
         config.set('SETTINGS', 'Listen_Address', '')
         config.set('SETTINGS', 'Database_path', '')
         config.set('SETTINGS', 'Database_file', 'server_database.db3')
+        config.set('SETTINGS', 'Outbound_limit', str(OUTBOUND_HIGH_WATER))
+        config.set('SETTINGS', 'Overflow_policy', OVERFLOW_POLICY)
+        config.set('SETTINGS', 'Events_log', '')
+        config.set('SETTINGS', 'Metrics_port', '0')
         return config
 
 
@@ -59,30 +70,74 @@ def main():
 
     # Загрузка параметров командной строки, если нет параметров, то задаём
     # значения по умоланию.
-    listen_address, listen_port, gui_flag = arg_parser(
+    listen_address, listen_port, gui_flag, async_flag, workers = arg_parser(
         config['SETTINGS']['Default_port'], config['SETTINGS']['Listen_Address'])
 
     # Инициализация базы данных
-    database = ServerStorage(
-        os.path.join(
-            config['SETTINGS']['Database_path'],
-            config['SETTINGS']['Database_file']))
-
-    # Создание экземпляра класса - сервера и его запуск:
-    server = MessageProcessor(listen_address, listen_port, database)
+    database_path = os.path.join(
+        config['SETTINGS']['Database_path'],
+        config['SETTINGS']['Database_file'])
+    database = ServerStorage(database_path)
+
+    # Создание экземпляра класса - сервера и его запуск. По флагу --asyncio
+    # используется обработчик на asyncio вместо обработчика на селекторах.
+    # Предел очереди отправки клиента, файл журнала событий (пустое
+    # значение - журнал не ведётся) и порт HTTP сервера метрик (0 - метрики
+    # не выдаются) задаются в файле конфигурации.
+    options = dict(
+        outbound_limit=config['SETTINGS'].getint(
+            'Outbound_limit', OUTBOUND_HIGH_WATER),
+        overflow_policy=config['SETTINGS'].get(
+            'Overflow_policy', OVERFLOW_POLICY),
+        events_log=config['SETTINGS'].get('Events_log', ''),
+        metrics_port=config['SETTINGS'].getint('Metrics_port', 0))
+    # По параметру --workers без GUI сервер запускается в несколько
+    # процессов, слушающих один порт.
+    if workers > 1 and gui_flag:
+        if async_flag:
+            logger.warning(
+                'Параметр --asyncio не поддерживается с --workers, процессы используют обработчик на селекторах.')
+        pool = WorkerPool(
+            workers, listen_address, listen_port, database_path, **options)
+        pool.start()
+        while True:
+            command = input('Введите exit для завершения работы сервера.')
+            if command == 'exit':
+                pool.stop()
+                return
+    elif workers > 1:
+        logger.warning('Параметр --workers поддерживается только с --no_gui.')
+
+    if async_flag:
+        server = AsyncMessageProcessor(
+            listen_address, listen_port, database, **options)
+    else:
+        server = MessageProcessor(
+            listen_address, listen_port, database, **options)
     server.daemon = True
     server.start()
 
     # Если  указан параметр без GUI то запускаем простенький обработчик
-    # консольного ввода
+    # консольного ввода. Команда profile [секунды] [cprofile|sample]
+    # запускает профилирование сервера.
     if gui_flag:
+        profiler = Profiler(server)
         while True:
             command = input('Введите exit для завершения работы сервера.')
             if command == 'exit':
                 # Если выход, то завершаем основной цикл сервера.
-                server.running = False
+                server.stop()
                 server.join()
                 break
+            elif command.startswith('profile'):
+                args = command.split()[1:]
+                try:
+                    seconds = float(args[0]) if args else PROFILE_SECONDS
+                    mode = args[1] if len(args) > 1 else 'cprofile'
+                    if not profiler.start(seconds, mode):
+                        print('Профилирование уже запущено.')
+                except ValueError as err:
+                    print(f'Ошибка: {err}')
 
     # Если не указан запуск без GUI, то запускаем GUI:
     else:
@@ -94,8 +149,10 @@ def main():
         # Запускаем GUI
         server_app.exec_()
 
-        # По закрытию окон останавливаем обработчик сообщений
-        server.running = False
+        # По закрытию окон останавливаем обработчик сообщений и ждём
+        # записи накопленной статистики
+        server.stop()
+        server.join()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,71 @@
+class Action:
+    '''
+    Класс - описание действия протокола JIM.
+    Хранит обработчик, обязательные поля сообщения, обязательные поля
+    вложенных словарей и поле, в котором клиент указывает своё имя.
+    '''
+
+    def __init__(self, handler, required, owner, nested=None):
+        self.handler = handler
+        self.required = tuple(required)
+        self.owner = owner
+        self.nested = dict(nested or {})
+
+    def accepts(self, message, name):
+        '''
+        Метод проверки сообщения перед вызовом обработчика.
+        Проверяет наличие обязательных полей, то, что вложенные поля
+        являются словарями с обязательными ключами, и, если задано поле
+        владельца, что клиент действует от своего имени.
+        :param message: словарь - сообщение.
+        :param name: имя авторизованного пользователя клиента или None.
+        '''
+        for field in self.required:
+            if field not in message:
+                return False
+        for field, required in self.nested.items():
+            value = message.get(field)
+            if not isinstance(value, dict):
+                return False
+            for key in required:
+                if key not in value:
+                    return False
+        return self.owner is None or message[self.owner] == name
+
+
+class ActionRegistry:
+    '''
+    Класс - реестр обработчиков действий протокола JIM.
+    Сопоставляет значение поля action с обработчиком, поэтому
+    выбор обработчика - это один поиск в словаре.
+    Обработчик вызывается как handler(processor, message, client).
+
+    Пример регистрации действия из подключаемого модуля:
+
+        @MessageProcessor.actions.register('ping', required=(TIME,))
+        def ping(processor, message, client):
+            processor.send(client, RESPONSE_200)
+    '''
+
+    def __init__(self):
+        self.actions = dict()
+
+    def register(self, action, required=(), owner=None, nested=None):
+        '''
+        Декоратор регистрации обработчика действия.
+        :param action: значение поля action.
+        :param required: обязательные поля сообщения.
+        :param owner: поле с именем отправителя, которое должно совпадать
+        с именем авторизованного клиента.
+        :param nested: словарь {поле: обязательные ключи} для полей,
+        значение которых - словарь.
+        '''
+        def decorator(handler):
+            self.actions[action] = Action(handler, required, owner, nested)
+            return handler
+
+        return decorator
+
+    def get(self, action):
+        '''Метод возвращающий описание действия или None.'''
+        return self.actions.get(action)
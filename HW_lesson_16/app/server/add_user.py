@@ -79,7 +79,7 @@ class RegisterUser(QDialog):
             self.messages.information(
                 self, 'Успех', 'Пользователь успешно зарегистрирован.')
             # Рассылаем клиентам сообщение о необходимости обновить справочники
-            self.server.service_update_lists()
+            self.server.call_threadsafe(self.server.service_update_lists)
             self.close()
 
 
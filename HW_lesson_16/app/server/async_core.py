@@ -0,0 +1,238 @@
+import asyncio
+import logging
+import json
+import time
+import sys
+sys.path.append('../../')
+from common.variables import *
+from common.utils import FrameDecoder, encode_message
+from server.core import MessageProcessor
+from server.session import ClientSession
+from server import metrics
+
+# Загрузка логера
+logger = logging.getLogger('server_dist')
+
+
+class StreamClient:
+    '''
+    Класс - соединение клиента в asyncio сервере.
+    Заменяет собой сокет: хранит потоки чтения и записи,
+    буфер приёма кадров и адрес клиента.
+    '''
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.decoder = FrameDecoder()
+        self.peername = writer.get_extra_info('peername')
+
+    def __repr__(self):
+        return f'<StreamClient {self.peername}>'
+
+    def getpeername(self):
+        '''Метод возвращающий адрес клиента, аналогично сокету.'''
+        return self.peername[:2]
+
+    async def get_messages(self):
+        '''
+        Метод ожидающий очередную порцию данных.
+        Возвращает все полные сообщения, принятые за одно чтение,
+        либо уже разобранные ранее, если они есть.
+        '''
+        if not self.decoder.messages:
+            data = await self.reader.read(MAX_PACKAGE_LENGTH)
+            if not data:
+                raise ConnectionResetError('Соединение закрыто удалённой стороной.')
+            metrics.bytes_received.inc(len(data))
+            self.decoder.feed(data)
+        messages = list(self.decoder.messages)
+        self.decoder.messages.clear()
+        return messages
+
+    async def get_message(self):
+        '''Метод ожидающий одно полное сообщение.'''
+        while not self.decoder.messages:
+            data = await self.reader.read(MAX_PACKAGE_LENGTH)
+            if not data:
+                raise ConnectionResetError('Соединение закрыто удалённой стороной.')
+            metrics.bytes_received.inc(len(data))
+            self.decoder.feed(data)
+        return self.decoder.messages.popleft()
+
+
+class AsyncMessageProcessor(MessageProcessor):
+    '''
+    Обработчик сообщений сервера на asyncio.
+    Каждое подключение обслуживается отдельной сопрограммой,
+    разбор сообщений JIM общий с MessageProcessor.
+    '''
+
+    def __init__(self, listen_address, listen_port, database, **kwargs):
+        # Цикл событий и событие остановки создаются в потоке сервера.
+        self.loop = None
+        self.stopped = None
+        # Сопрограммы, обслуживающие подключения.
+        self.handlers = set()
+        super().__init__(listen_address, listen_port, database, **kwargs)
+
+    def run(self):
+        '''Метод основной цикл потока.'''
+        asyncio.run(self.serve())
+
+    async def serve(self):
+        '''Сопрограмма запуска сервера и ожидания его остановки.'''
+        self.loop = asyncio.get_running_loop()
+        self.stopped = asyncio.Event()
+        logger.info(
+            f'Запущен asyncio сервер, порт для подключений: {self.port} , адрес с которого принимаются подключения: {self.addr}. Если адрес не указан, принимаются соединения с любых адресов.')
+        server = await asyncio.start_server(
+            self.serve_client, self.addr or None, self.port,
+            reuse_address=True, backlog=MAX_CONNECTIONS)
+        # Поручения, переданные до запуска цикла.
+        while self.tasks:
+            func, args = self.tasks.popleft()
+            func(*args)
+        statistics = asyncio.create_task(self.flush_statistics())
+        async with server:
+            if self.running:
+                await self.stopped.wait()
+        statistics.cancel()
+        # Закрываем соединения и дожидаемся завершения их сопрограмм.
+        for client in list(self.sessions):
+            self.remove_client(client)
+        await asyncio.gather(statistics, *self.handlers, return_exceptions=True)
+        self.database.flush_statistics()
+        if self.events:
+            self.events.close()
+        if self.metrics_server:
+            self.metrics_server.shutdown()
+            self.metrics_server.server_close()
+
+    async def flush_statistics(self):
+        '''
+        Сопрограмма периодической записи накопленной статистики
+        и журнала событий.
+        '''
+        while True:
+            timeouts = [timeout for timeout in (
+                self.database.flush_statistics(force=False),
+                self.events.flush(force=False) if self.events else None)
+                if timeout is not None]
+            await asyncio.sleep(
+                min(timeouts) if timeouts else self.database.stat_flush_interval)
+
+    def service_update_lists(self):
+        '''Метод планирующий рассылку уведомлений 205 через NOTIFY_DELAY секунд.'''
+        if self.notify_at is None:
+            self.notify_at = self.loop.call_later(NOTIFY_DELAY, self.notify_clients)
+
+    def stop(self):
+        '''Метод останавливающий сервер из любого потока.'''
+        self.running = False
+        self.call_threadsafe(self.stopped.set)
+
+    def call_threadsafe(self, func, *args):
+        '''Метод передающий вызов на выполнение в цикл событий сервера.'''
+        if self.loop:
+            try:
+                self.loop.call_soon_threadsafe(func, *args)
+            except RuntimeError:
+                # Цикл событий уже завершён.
+                pass
+        else:
+            self.tasks.append((func, args))
+
+    async def serve_client(self, reader, writer):
+        '''Сопрограмма, обслуживающая одно подключение.'''
+        client = StreamClient(reader, writer)
+        logger.info(f'Установлено соедение с ПК {client.peername}')
+        self.event('connect', peer=client.getpeername())
+        metrics.connections_total.inc()
+        self.sessions[client] = ClientSession(client)
+        handler = asyncio.current_task()
+        self.handlers.add(handler)
+        try:
+            # Авторизация должна завершиться за AUTH_TIMEOUT с момента
+            # подключения.
+            await asyncio.wait_for(self.serve_handshake(client), AUTH_TIMEOUT)
+            while client in self.sessions:
+                messages = await client.get_messages()
+                self.received_at = time.monotonic()
+                started = time.perf_counter()
+                for message in messages:
+                    self.process_client_message(message, client)
+                    # Клиент мог быть отключён при обработке.
+                    if client not in self.sessions:
+                        break
+                metrics.loop_seconds.observe(time.perf_counter() - started)
+        except asyncio.TimeoutError:
+            logger.info(f'Клиент {client} не завершил авторизацию вовремя.')
+            self.auth_event(ok=False, reason='timeout')
+        except (OSError, json.JSONDecodeError, TypeError) as err:
+            logger.debug(f'Getting data from client exception.', exc_info=err)
+        except (KeyError, ValueError) as err:
+            # Ошибка обработки сообщения отключает только этого клиента.
+            logger.error(f'Ошибка обработки сообщения клиента {client}: {err!r}')
+        finally:
+            self.remove_client(client)
+            self.handlers.discard(handler)
+
+    async def serve_handshake(self, client):
+        '''Сопрограмма приёма сообщений до завершения авторизации.'''
+        while client in self.sessions and not self.is_authorized(client):
+            self.handle_message(await client.get_message(), client)
+
+    def offline_round(self, client):
+        '''Метод запускающий сопрограмму доставки отложенных сообщений.'''
+        handler = self.loop.create_task(self.serve_offline(client))
+        self.handlers.add(handler)
+        handler.add_done_callback(self.handlers.discard)
+
+    async def serve_offline(self, client):
+        '''
+        Сопрограмма доставки отложенных сообщений по пачкам.
+        Перед каждой следующей пачкой дожидается полной отправки буфера
+        транспорта клиента и удаляет отправленные сообщения из базы.
+        '''
+        # С нулевым пределом буфера drain ждёт, пока буфер не опустеет.
+        client.writer.transport.set_write_buffer_limits(0)
+        try:
+            while True:
+                more = self.deliver_offline(client)
+                await client.writer.drain()
+                if client not in self.sessions:
+                    return
+                self.offline_sent(client)
+                if not more:
+                    return
+        except OSError as err:
+            logger.debug(f'Sending data to client exception.', exc_info=err)
+
+    def send(self, client, message):
+        '''
+        Метод отправки сообщения клиенту через буфер транспорта.
+        Буфер транспорта ограничен так же, как очередь MessageProcessor.
+        '''
+        session = self.sessions.get(client)
+        if session is None:
+            return None
+        transport = client.writer.transport
+        if transport.get_write_buffer_size() >= self.outbound_limit:
+            self.overflow(client)
+            return None
+        frame = encode_message(
+            self.correlate(client, message), session.codec, session.compressor)
+        client.writer.write(frame)
+        metrics.bytes_sent.inc(len(frame))
+        return len(frame)
+
+    def queue_depth(self, client):
+        '''Метод возвращающий объём данных в буфере транспорта клиента.'''
+        if client not in self.sessions:
+            return None
+        return client.writer.transport.get_write_buffer_size()
+
+    def close_client(self, client):
+        '''Метод закрывающий соединение клиента.'''
+        client.writer.close()
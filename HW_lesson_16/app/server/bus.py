@@ -0,0 +1,215 @@
+import logging
+import os
+import selectors
+import socket
+import json
+import sys
+sys.path.append('../../')
+from common.variables import *
+from common.utils import FrameDecoder, encode_message
+from server.outbound import OutboundQueue
+
+# Загрузка логера
+logger = logging.getLogger('server_dist')
+
+
+def socket_path(path, worker):
+    '''Функция возвращающая путь сокета шины процесса worker в каталоге path.'''
+    return os.path.join(path, f'worker-{worker}.sock')
+
+
+class RoutingBus:
+    '''
+    Класс - шина пересылки сообщений между процессами сервера.
+    Каждый процесс слушает свой Unix сокет в общем каталоге и по мере
+    необходимости подключается к сокетам других процессов. Сообщение
+    для пользователя, подключённого к другому процессу, передаётся
+    этому процессу кадром в двоичном формате.
+    Принадлежность пользователей процессам хранится в общем словаре
+    registry {имя: номер процесса} (словарь multiprocessing.Manager).
+    Об изменении списков процессы сообщают друг другу служебным
+    сообщением LISTS_CHANGED.
+    Все операции с сокетами выполняются в потоке MessageProcessor
+    через его селектор.
+    '''
+
+    def __init__(self, worker, path, registry):
+        # Номер процесса, каталог сокетов шины и общий реестр имён.
+        self.worker = worker
+        self.path = path
+        self.registry = registry
+        self.selector = None
+        self.deliver = None
+        self.listener = None
+        # Исходящие соединения {номер процесса: сокет} и их очереди.
+        self.peers = dict()
+        self.queues = dict()
+        # Буферы приёма входящих соединений.
+        self.decoders = dict()
+
+    def address(self, worker):
+        '''Метод возвращающий путь сокета процесса.'''
+        return socket_path(self.path, worker)
+
+    def start(self, selector, deliver):
+        '''
+        Метод запуска шины.
+        :param selector: селектор основного цикла сервера.
+        :param deliver: функция доставки пересланного сообщения.
+        '''
+        self.selector = selector
+        self.deliver = deliver
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(self.address(self.worker))
+        self.listener.listen(MAX_CONNECTIONS)
+        self.listener.setblocking(False)
+        self.selector.register(
+            self.listener, selectors.EVENT_READ, self.accept_peers)
+
+    def close(self):
+        '''Метод закрывающий все сокеты шины.'''
+        for sock in list(self.decoders) + list(self.queues):
+            sock.close()
+        self.decoders.clear()
+        self.queues.clear()
+        self.peers.clear()
+        if self.listener:
+            self.listener.close()
+            os.unlink(self.address(self.worker))
+
+    def claim(self, name):
+        '''Метод закрепляющий имя за процессом. False - имя уже занято.'''
+        return self.registry.setdefault(name, self.worker) == self.worker
+
+    def release(self, name):
+        '''Метод освобождающий имя, закреплённое за процессом.'''
+        if self.registry.get(name) == self.worker:
+            self.registry.pop(name, None)
+
+    def owner(self, name):
+        '''Метод возвращающий номер процесса пользователя или None.'''
+        return self.registry.get(name)
+
+    def forward(self, name, message):
+        '''
+        Метод пересылки сообщения процессу, к которому подключён
+        пользователь name.
+        Возвращает False, если пользователь не подключён к другому
+        процессу или процесс недоступен.
+        '''
+        worker = self.owner(name)
+        if worker is None or worker == self.worker:
+            return False
+        return self.push(worker, message)
+
+    def broadcast(self, message):
+        '''
+        Метод рассылки служебного сообщения всем остальным процессам,
+        сокеты которых есть в каталоге шины.
+        '''
+        for entry in os.listdir(self.path):
+            root, ext = os.path.splitext(entry)
+            if ext != '.sock' or not root.startswith('worker-'):
+                continue
+            worker = int(root[len('worker-'):])
+            if worker != self.worker:
+                self.push(worker, message)
+
+    def push(self, worker, message):
+        '''
+        Метод постановки сообщения в очередь процесса worker.
+        При необходимости открывает соединение с процессом.
+        Возвращает False, если процесс недоступен или очередь переполнена.
+        '''
+        sock = self.peers.get(worker)
+        if sock is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.connect(self.address(worker))
+            except OSError as err:
+                logger.error(f'Процесс {worker} недоступен: {err}')
+                sock.close()
+                return False
+            sock.setblocking(False)
+            self.peers[worker] = sock
+            self.queues[sock] = OutboundQueue(BUS_HIGH_WATER)
+            # Чтение нужно только для обнаружения закрытия соединения.
+            self.selector.register(sock, selectors.EVENT_READ, self.serve_peer)
+        queue = self.queues[sock]
+        was_empty = not queue
+        if not queue.push(encode_message(message, BINARY_CODEC)):
+            logger.warning(
+                f'Очередь пересылки процессу {worker} переполнена, сообщение отброшено.')
+            return False
+        if was_empty:
+            self.flush(sock)
+        return True
+
+    def accept_peers(self, sock, mask):
+        '''Обработчик подключений других процессов.'''
+        while True:
+            try:
+                peer, _ = sock.accept()
+            except BlockingIOError:
+                return
+            peer.setblocking(False)
+            self.decoders[peer] = FrameDecoder()
+            self.selector.register(peer, selectors.EVENT_READ, self.receive)
+
+    def receive(self, sock, mask):
+        '''Обработчик входящего соединения: доставляет пересланные сообщения.'''
+        decoder = self.decoders[sock]
+        try:
+            data = sock.recv(MAX_PACKAGE_LENGTH)
+            if not data:
+                raise ConnectionResetError
+            decoder.feed(data)
+        except BlockingIOError:
+            return
+        except (OSError, json.JSONDecodeError, TypeError) as err:
+            logger.debug(f'Routing bus exception.', exc_info=err)
+            self.disconnect(sock)
+            return
+        while decoder.messages:
+            self.deliver(decoder.messages.popleft())
+
+    def serve_peer(self, sock, mask):
+        '''Обработчик исходящего соединения: отправка и обнаружение закрытия.'''
+        if mask & selectors.EVENT_READ:
+            try:
+                if not sock.recv(MAX_PACKAGE_LENGTH):
+                    raise ConnectionResetError
+            except BlockingIOError:
+                pass
+            except OSError:
+                self.disconnect(sock)
+                return
+        if mask & selectors.EVENT_WRITE:
+            self.flush(sock)
+
+    def flush(self, sock):
+        '''Метод отправляющий накопленные для процесса данные.'''
+        queue = self.queues[sock]
+        try:
+            queue.send(sock)
+        except BlockingIOError:
+            pass
+        except OSError as err:
+            logger.debug(f'Routing bus exception.', exc_info=err)
+            self.disconnect(sock)
+            return
+        events = selectors.EVENT_READ
+        if queue:
+            events |= selectors.EVENT_WRITE
+        if self.selector.get_key(sock).events != events:
+            self.selector.modify(sock, events, self.serve_peer)
+
+    def disconnect(self, sock):
+        '''Метод закрывающий соединение с другим процессом.'''
+        self.selector.unregister(sock)
+        sock.close()
+        self.decoders.pop(sock, None)
+        if self.queues.pop(sock, None) is not None:
+            for worker, peer in list(self.peers.items()):
+                if peer is sock:
+                    del self.peers[worker]
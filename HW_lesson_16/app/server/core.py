@@ -1,18 +1,27 @@
 import threading
+import time
+import collections
 import logging
-import select
+import selectors
 import socket
 import json
 import hmac
 import binascii
 import os
+import zlib
 import sys
 sys.path.append('../../')
 from common.metaclasses import ServerMaker
 from common.descryptors import Port
 from common.variables import *
-from common.utils import send_message, get_message
+from common.utils import encode_message, get_decoder, receive
+from common import codec
 from common.decos import login_required
+from server.outbound import OutboundQueue
+from server.session import ClientSession, AWAITING_PRESENCE, CHALLENGED, AUTHENTICATED
+from server.actions import ActionRegistry
+from server.events import EventLog
+from server import metrics
 
 # Загрузка логера
 logger = logging.getLogger('server_dist')
@@ -21,31 +30,90 @@ logger = logging.getLogger('server_dist')
 class MessageProcessor(threading.Thread):
     port = Port()
 
-    def __init__(self, listen_address, listen_port, database):
+    def __init__(self, listen_address, listen_port, database,
+                 outbound_limit=OUTBOUND_HIGH_WATER, overflow_policy=OVERFLOW_POLICY,
+                 bus=None, events_log=None, metrics_port=0):
         # Параметры подключения
         self.addr = listen_address
         self.port = listen_port
 
+        # Предел очереди отправки клиента и действие при его превышении.
+        self.outbound_limit = outbound_limit
+        self.overflow_policy = overflow_policy
+
         # База данных сервера
         self.database = database
 
         # Сокет, через который будет осуществляться работа
         self.sock = None
 
-        # Список подключённых клиентов.
-        self.clients = []
+        # Селектор (epoll в Linux), ожидающий событий на всех сокетах сразу.
+        self.selector = None
+
+        # Сессии подключённых клиентов {сокет: ClientSession}. Сессия
+        # хранит имя пользователя и очередь исходящих кадров; сокет
+        # регистрируется на запись только пока его очередь не пуста.
+        self.sessions = dict()
 
-        # Сокеты
-        self.listen_sockets = None
-        self.error_sockets = None
+        # Поручения из других потоков (GUI), выполняемые в потоке сервера,
+        # и пара сокетов для пробуждения основного цикла. Пара создаётся
+        # при запуске цикла и закрывается при его остановке.
+        self.tasks = collections.deque()
+        self.wakeup_reader = None
+        self.wakeup_writer = None
 
         # Флаг продолжения работы
         self.running = True
 
-        # Словарь содержащий сопоставленные имена и соответствующие им сокеты.
-        # {'test1': <socket.socket fd=25, family=AddressFamily.AF_INET, type=SocketKind.SOCK_STREAM, proto=0, laddr=('127.0.0.1', 7777), raddr=('127.0.0.1', 52420)>}
+        # Сроки завершения авторизации {сокет: время}. Срок отсчитывается
+        # от подключения, поэтому порядок словаря - это порядок сроков.
+        self.handshakes = dict()
+
+        # Словарь сессий авторизованных пользователей по именам.
+        # {'test1': <ClientSession test1 <socket.socket fd=25, ...>>}
         self.names = dict()
 
+        # Версия списков, о которой клиенты уже уведомлены, и срок
+        # ближайшей рассылки уведомлений 205.
+        self.notified_version = database.get_version()
+        self.notify_at = None
+
+        # Клиент, чей запрос сейчас обрабатывается, и номер запроса:
+        # номер добавляется в ответы этому клиенту.
+        self.requester = None
+        self.request_id = None
+
+        # Шина пересылки сообщений другим процессам сервера (RoutingBus)
+        # при запуске в несколько процессов, иначе None.
+        self.bus = bus
+
+        # Журнал событий (EventLog) или None, если он не ведётся. Каждый
+        # процесс сервера пишет свой файл.
+        self.events = None
+        if events_log:
+            if bus:
+                root, ext = os.path.splitext(events_log)
+                events_log = f'{root}-{bus.worker}{ext}'
+            self.events = EventLog(events_log)
+        # Время приёма обрабатываемых сообщений, от него отсчитывается
+        # задержка доставки.
+        self.received_at = time.monotonic()
+
+        # HTTP сервер метрик или None, если порт не задан. Процессы
+        # сервера слушают порты metrics_port + номер процесса.
+        self.metrics_server = None
+        if metrics_port:
+            if bus:
+                metrics_port += bus.worker
+            self.metrics_server = metrics.start_http_server(metrics_port)
+        metrics.connections.set_function(lambda: len(self.sessions))
+        metrics.directory_size.set_function(
+            lambda: self.database.directory_stats()['size'])
+        metrics.directory_hits.set_function(
+            lambda: self.database.directory_stats()['hits'])
+        metrics.directory_misses.set_function(
+            lambda: self.database.directory_stats()['misses'])
+
         # Конструктор предка
         super().__init__()
 
@@ -54,49 +122,317 @@ class MessageProcessor(threading.Thread):
         # Инициализация Сокета
         self.init_socket()
 
-        # Основной цикл программы сервера
+        # Основной цикл программы сервера: ждём событий на любом из
+        # сокетов и вызываем связанный с сокетом обработчик.
         while self.running:
-            # Ждём подключения, если таймаут вышел, ловим исключение.
+            # Ждём событий не дольше, чем до ближайшего срока авторизации
+            # или записи статистики.
+            timeout = self.housekeeping()
             try:
-                client, client_address = self.sock.accept()
-            except OSError:
+                events = self.selector.select(timeout)
+            except OSError as err:
+                logger.error(f'Ошибка работы с сокетами: {err.errno}')
+                continue
+            started = time.perf_counter()
+            for key, mask in events:
+                key.data(key.fileobj, mask)
+            if events:
+                metrics.loop_seconds.observe(time.perf_counter() - started)
+
+        self.close_sockets()
+
+    def stop(self):
+        '''Метод останавливающий основной цикл сервера из любого потока.'''
+        self.running = False
+        self.wakeup()
+
+    def wakeup(self):
+        '''Метод пробуждающий основной цикл сервера.'''
+        if self.wakeup_writer is None:
+            # Цикл ещё не запущен: поручения выполнятся при запуске.
+            return
+        try:
+            self.wakeup_writer.send(b'\0')
+        except OSError:
+            # Буфер заполнен - цикл и так будет разбужен, либо цикл
+            # уже остановлен и сокеты закрыты.
+            pass
+
+    def call_threadsafe(self, func, *args):
+        '''
+        Метод передающий вызов на выполнение в поток сервера.
+        Используется GUI для действий с сокетами клиентов.
+        '''
+        self.tasks.append((func, args))
+        self.wakeup()
+
+    def run_tasks(self, sock, mask):
+        '''Обработчик пробуждения: выполняет поручения других потоков.'''
+        try:
+            while sock.recv(MAX_PACKAGE_LENGTH):
                 pass
-            else:
-                logger.info(f'Установлено соедение с ПК {client_address}')
-                client.settimeout(5)
-                self.clients.append(client)
-
-            recv_data_lst = []
-            send_data_lst = []
-            err_lst = []
-            # Проверяем на наличие ждущих клиентов
+        except BlockingIOError:
+            pass
+        while self.tasks:
+            func, args = self.tasks.popleft()
+            func(*args)
+
+    def accept_clients(self, sock, mask):
+        '''Обработчик готовности слушающего сокета: принимает подключения.'''
+        while True:
             try:
-                if self.clients:
-                    recv_data_lst, self.listen_sockets, self.error_sockets = select.select(
-                        self.clients, self.clients, [], 0)
+                client, client_address = sock.accept()
+            except BlockingIOError:
+                return
             except OSError as err:
-                logger.error(f'Ошибка работы с сокетами: {err.errno}')
+                logger.error(f'Ошибка приёма подключения: {err}')
+                return
+            logger.info(f'Установлено соедение с ПК {client_address}')
+            self.event('connect', peer=client_address)
+            metrics.connections_total.inc()
+            client.setblocking(False)
+            self.sessions[client] = ClientSession(
+                client, OutboundQueue(self.outbound_limit))
+            self.handshakes[client] = time.monotonic() + AUTH_TIMEOUT
+            self.selector.register(
+                client, selectors.EVENT_READ, self.serve_client)
+
+    def serve_client(self, client, mask):
+        '''Обработчик событий клиентского сокета.'''
+        if mask & selectors.EVENT_WRITE:
+            self.flush(client)
+        if mask & selectors.EVENT_READ and client in self.sessions:
+            # За одно чтение может прийти несколько сообщений,
+            # обрабатываем их все по порядку.
+            try:
+                data = receive(client)
+                self.received_at = time.monotonic()
+                metrics.bytes_received.inc(len(data))
+                decoder = get_decoder(client)
+                decoder.feed(data)
+                messages = list(decoder.messages)
+                decoder.messages.clear()
+                for message in messages:
+                    self.handle_message(message, client)
+                    # Клиент мог быть отключён при обработке.
+                    if client not in self.sessions:
+                        break
+            except BlockingIOError:
+                pass
+            except (OSError, json.JSONDecodeError, TypeError) as err:
+                logger.debug(f'Getting data from client exception.', exc_info=err)
+                self.remove_client(client)
+            except (KeyError, ValueError) as err:
+                # Ошибка обработки сообщения отключает только этого клиента.
+                logger.error(f'Ошибка обработки сообщения клиента {client}: {err!r}')
+                self.remove_client(client)
+
+    def handle_message(self, message, client):
+        '''
+        Метод передающий сообщение обработчику по состоянию сессии:
+        ответ на запрос 511 проверяется complete_auth, остальные
+        сообщения разбирает process_client_message.
+        '''
+        if self.sessions[client].state == CHALLENGED:
+            self.complete_auth(client, message)
+        else:
+            self.process_client_message(message, client)
+
+    def housekeeping(self):
+        '''
+        Метод периодических работ основного цикла: отключение клиентов
+        с истёкшим сроком авторизации, запись накопленной статистики
+        и рассылка уведомлений об изменении списков.
+        Возвращает время до ближайшей работы или None.
+        '''
+        timeouts = [timeout for timeout in (
+            self.expire_handshakes(),
+            self.database.flush_statistics(force=False),
+            self.events.flush(force=False) if self.events else None,
+            self.notify_if_due()) if timeout is not None]
+        return min(timeouts) if timeouts else None
+
+    def expire_handshakes(self):
+        '''
+        Метод отключающий клиентов, не завершивших авторизацию в срок.
+        Возвращает время до ближайшего срока или None.
+        '''
+        now = time.monotonic()
+        while self.handshakes:
+            client, deadline = next(iter(self.handshakes.items()))
+            if deadline > now:
+                return deadline - now
+            logger.info(f'Клиент {client} не завершил авторизацию вовремя.')
+            self.auth_event(ok=False, reason='timeout')
+            self.remove_client(client)
+        return None
+
+    def send(self, client, message):
+        '''
+        Метод отправки сообщения клиенту.
+        Сообщение ставится в очередь клиента, отправка начинается сразу,
+        а остаток дописывается при готовности сокета к записи.
+        Возвращает размер кадра или None, если кадр не отправлен.
+        '''
+        session = self.sessions.get(client)
+        # Клиент уже отключён.
+        if session is None:
+            return None
+        queue = session.queue
+        pending = bool(queue)
+        frame = encode_message(
+            self.correlate(client, message), session.codec, session.compressor)
+        if not queue.push(frame):
+            self.overflow(client, codec.is_compressed(frame))
+            return None
+        if not pending:
+            self.flush(client)
+        return len(frame)
+
+    def queue_depth(self, client):
+        '''Метод возвращающий объём неотправленных клиенту данных.'''
+        session = self.sessions.get(client)
+        return len(session.queue) if session else None
+
+    def event(self, event, **fields):
+        '''Метод записи события в журнал событий, если он ведётся.'''
+        if self.events is not None:
+            self.events.write(event, **fields)
 
-            # принимаем сообщения и если ошибка, исключаем клиента.
-            if recv_data_lst:
-                for client_with_message in recv_data_lst:
-                    try:
-                        self.process_client_message(
-                            get_message(client_with_message), client_with_message)
-                    except (OSError, json.JSONDecodeError, TypeError) as err:
-                        logger.debug(f'Getting data from client exception.', exc_info=err)
-                        self.remove_client(client_with_message)
+    def auth_event(self, ok, **fields):
+        '''Метод учёта результата авторизации в метриках и журнале событий.'''
+        (metrics.auth_ok if ok else metrics.auth_failed).inc()
+        self.event('auth', ok=ok, **fields)
+
+    def message_event(self, message, route, size=None):
+        '''
+        Метод записи в журнал событий пересылки сообщения.
+        latency_ms - время от приёма сообщения до его отправки,
+        queue - объём неотправленных получателю данных.
+        '''
+        if self.events is None:
+            return
+        recipient = self.names.get(message[DESTINATION])
+        self.events.write(
+            'message', sender=message[SENDER], to=message[DESTINATION],
+            route=route, size=size,
+            queue=self.queue_depth(recipient.client) if recipient else None,
+            latency_ms=round((time.monotonic() - self.received_at) * 1000, 3))
+
+    def correlate(self, client, message):
+        '''
+        Метод добавляющий к ответу номер запроса клиента, если ответ
+        отправляется автору обрабатываемого запроса.
+        '''
+        if self.request_id is None or client is not self.requester \
+                or RESPONSE not in message:
+            return message
+        message = dict(message)
+        message[REQUEST_ID] = self.request_id
+        return message
+
+    def overflow(self, client, compressed=False):
+        '''
+        Метод вызываемый при переполнении очереди отправки клиента.
+        Отстающий клиент отключается, либо новые сообщения для него
+        отбрасываются, в зависимости от overflow_policy.
+        Сжатый кадр отбросить нельзя: поток сжатия клиента уже учёл его,
+        поэтому в этом случае клиент отключается всегда.
+        '''
+        self.event('drop', user=self.client_name(client),
+                   policy=self.overflow_policy, queue=self.queue_depth(client))
+        if self.overflow_policy == 'drop' and not compressed:
+            logger.warning(
+                f'Очередь отправки клиента {client} переполнена, сообщение отброшено.')
+        else:
+            logger.warning(
+                f'Очередь отправки клиента {client} переполнена, клиент отключён.')
+            self.remove_client(client)
+
+    def flush(self, client):
+        '''Метод отправляющий накопленные для клиента данные.'''
+        queue = self.sessions[client].queue
+        try:
+            metrics.bytes_sent.inc(queue.send(client))
+        except BlockingIOError:
+            pass
+        except OSError as err:
+            logger.debug(f'Sending data to client exception.', exc_info=err)
+            self.remove_client(client)
+            return
+        # Подписываемся на запись, только пока есть что отправлять.
+        events = selectors.EVENT_READ
+        if queue:
+            events |= selectors.EVENT_WRITE
+        else:
+            self.offline_sent(client)
+            if self.sessions[client].offline:
+                # Очередь освободилась - продолжаем доставку отложенных сообщений.
+                self.sessions[client].offline = False
+                self.call_threadsafe(self.offline_round, client)
+        if self.selector.get_key(client).events != events:
+            self.selector.modify(client, events, self.serve_client)
 
     def remove_client(self, client):
-        logger.info(f'Клиент {client.getpeername()} отключился от сервера.')
-        for name in self.names:
-            if self.names[name] == client:
-                self.database.user_logout(name)
-                del self.names[name]
-                break
-        self.clients.remove(client)
+        '''Метод отключающий клиента. Повторный вызов ничего не делает.'''
+        session = self.sessions.pop(client, None)
+        if session is None:
+            return
+        self.handshakes.pop(client, None)
+        try:
+            peer = client.getpeername()
+        except OSError:
+            peer = None
+        logger.info(f'Клиент {peer or client} отключился от сервера.')
+        self.event('disconnect', user=session.name, peer=peer)
+        # Сессия знает имя пользователя, поиск по списку не нужен.
+        # Запись в names освобождается, если она принадлежит этой сессии,
+        # в каком бы состоянии сессия ни была.
+        if self.names.get(session.name) is session:
+            self.database.user_logout(session.name)
+            del self.names[session.name]
+            if self.bus:
+                self.bus.release(session.name)
+        self.close_client(client)
+
+    def close_client(self, client):
+        '''Метод освобождающий ресурсы соединения клиента.'''
+        self.selector.unregister(client)
         client.close()
 
+    def disconnect_user(self, name):
+        '''Метод отключающий пользователя, удалённого из базы.'''
+        session = self.names.pop(name, None)
+        if session:
+            if self.bus:
+                self.bus.release(name)
+            self.remove_client(session.client)
+
+    def name_busy(self, name):
+        '''Метод проверяющий, подключён ли пользователь к этому или другому процессу.'''
+        if name in self.names:
+            return True
+        return self.bus is not None and self.bus.owner(name) is not None
+
+    def claim_name(self, name):
+        '''
+        Метод закрепляющий имя пользователя за этим процессом.
+        Возвращает False, если имя уже занято.
+        '''
+        if name in self.names:
+            return False
+        return self.bus is None or self.bus.claim(name)
+
+    def is_authorized(self, client):
+        '''Метод проверяющий, что клиент прошёл авторизацию.'''
+        session = self.sessions.get(client)
+        return session is not None and session.authorized
+
+    def client_name(self, client):
+        '''Метод возвращающий имя пользователя клиента или None.'''
+        session = self.sessions.get(client)
+        return session.name if session else None
+
     def init_socket(self):
         '''Метод инициализатор сокета.'''
         logger.info(
@@ -104,214 +440,457 @@ class MessageProcessor(threading.Thread):
         # Готовим сокет
         transport = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         transport.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        # Процессы сервера слушают один порт, подключения между ними
+        # распределяет ядро.
+        if self.bus:
+            transport.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         transport.bind((self.addr, self.port))
-        transport.settimeout(0.5)
+        transport.setblocking(False)
 
         # Начинаем слушать сокет.
         self.sock = transport
         self.sock.listen(MAX_CONNECTIONS)
 
+        # Пара сокетов пробуждения. Поручения, переданные до запуска
+        # цикла, выполняются при первом пробуждении.
+        self.wakeup_reader, self.wakeup_writer = socket.socketpair()
+        self.wakeup_reader.setblocking(False)
+        self.wakeup_writer.setblocking(False)
+        if self.tasks:
+            self.wakeup()
+
+        # Регистрируем слушающий сокет и сокет пробуждения в селекторе.
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(
+            self.sock, selectors.EVENT_READ, self.accept_clients)
+        self.selector.register(
+            self.wakeup_reader, selectors.EVENT_READ, self.run_tasks)
+        if self.bus:
+            self.bus.start(self.selector, self.receive_routed)
+
+    def close_sockets(self):
+        '''Метод закрывающий все сокеты при остановке сервера.'''
+        for client in list(self.sessions):
+            self.remove_client(client)
+        self.database.flush_statistics()
+        if self.events:
+            self.events.close()
+        if self.metrics_server:
+            self.metrics_server.shutdown()
+            self.metrics_server.server_close()
+        if self.bus:
+            self.bus.close()
+        self.selector.close()
+        self.sock.close()
+        self.wakeup_reader.close()
+        self.wakeup_writer.close()
+
     def process_message(self, message):
         '''
         Метод отправки сообщения клиенту.
+        Возвращает размер отправленного кадра.
         '''
-        if message[DESTINATION] in self.names and self.names[message[DESTINATION]
-        ] in self.listen_sockets:
-            try:
-                send_message(self.names[message[DESTINATION]], message)
-                logger.info(
-                    f'Отправлено сообщение пользователю {message[DESTINATION]} от пользователя {message[SENDER]}.')
-            except OSError:
-                self.remove_client(message[DESTINATION])
-        elif message[DESTINATION] in self.names and self.names[message[DESTINATION]] not in self.listen_sockets:
-            logger.error(
-                f'Связь с клиентом {message[DESTINATION]} была потеряна. Соединение закрыто, доставка невозможна.')
-            self.remove_client(self.names[message[DESTINATION]])
+        if message[DESTINATION] in self.names:
+            size = self.send(self.names[message[DESTINATION]].client, message)
+            logger.info(
+                f'Отправлено сообщение пользователю {message[DESTINATION]} от пользователя {message[SENDER]}.')
+            return size
         else:
             logger.error(
                 f'Пользователь {message[DESTINATION]} не зарегистрирован на сервере, отправка сообщения невозможна.')
+            return None
+
+    def receive_routed(self, message):
+        '''
+        Метод доставки сообщения, пересланного другим процессом.
+        Если получатель успел отключиться, сообщение откладывается.
+        Служебное сообщение LISTS_CHANGED обновляет справочник.
+        '''
+        if message.get(ACTION) == LISTS_CHANGED:
+            # Другой процесс изменил списки: сбрасываем устаревшие записи
+            # справочника и уведомляем своих клиентов.
+            for name in message[LIST_INFO]:
+                self.database.forget_user(name)
+            self.service_update_lists()
+            return
+        self.received_at = time.monotonic()
+        if message[DESTINATION] in self.names:
+            self.message_event(message, 'bus', self.process_message(message))
+        elif self.database.check_user(message[DESTINATION]):
+            self.database.store_offline(message[DESTINATION], message)
+            self.message_event(message, 'offline')
+
+    # Реестр обработчиков действий протокола JIM.
+    actions = ActionRegistry()
 
     @login_required
     def process_client_message(self, message, client):
-        """ Метод обработчик поступающих сообщений. """
+        """
+        Метод обработчик поступающих сообщений.
+        Находит обработчик действия в реестре actions, проверяет
+        обязательные поля и вызывает обработчик.
+        """
         logger.debug(f'Разбор сообщения от клиента : {message}')
-        # Если это сообщение о присутствии, принимаем и отвечаем
-        if ACTION in message and message[ACTION] == PRESENCE and TIME in message and USER in message:
-            # Если сообщение о присутствии то вызываем функцию авторизации.
-            self.autorize_user(message, client)
-
-        # Если это сообщение, то отправляем его получателю.
-        elif ACTION in message and message[ACTION] == MESSAGE and DESTINATION in message and TIME in message \
-                and SENDER in message and MESSAGE_TEXT in message and self.names[message[SENDER]] == client:
-            if message[DESTINATION] in self.names:
-                self.database.process_message(
-                    message[SENDER], message[DESTINATION])
-                self.process_message(message)
-                try:
-                    send_message(client, RESPONSE_200)
-                except OSError:
-                    self.remove_client(client)
+        self.requester = client
+        self.request_id = message.get(REQUEST_ID)
+        try:
+            action = self.actions.get(message.get(ACTION))
+            if action and action.accepts(message, self.client_name(client)):
+                action.handler(self, message, client)
+            # Иначе отдаём Bad request
             else:
                 response = RESPONSE_400
-                response[ERROR] = 'Пользователь не зарегистрирован на сервере.'
-                try:
-                    send_message(client, response)
-                except OSError:
-                    pass
-            return
+                response[ERROR] = 'Запрос некорректен.'
+                self.send(client, response)
+        finally:
+            self.requester = None
+            self.request_id = None
 
-        # Если клиент выходит
-        elif ACTION in message and message[ACTION] == EXIT and ACCOUNT_NAME in message \
-                and self.names[message[ACCOUNT_NAME]] == client:
-            self.remove_client(client)
+    @actions.register(MESSAGE, (DESTINATION, TIME, SENDER, MESSAGE_TEXT), SENDER)
+    def route_message(self, message, client):
+        """
+        Обработчик сообщения: отправляет его получателю.
+        Сообщение для зарегистрированного, но не подключённого
+        пользователя сохраняется до его входа.
+        """
+        metrics.messages.inc()
+        # Номер запроса отправителя не передаётся получателю, в другой
+        # процесс и в базу отложенных сообщений.
+        message.pop(REQUEST_ID, None)
+        if message[DESTINATION] in self.names:
+            self.database.process_message(
+                message[SENDER], message[DESTINATION])
+            self.message_event(message, 'local', self.process_message(message))
+            self.send(client, RESPONSE_200)
+        elif self.bus and self.bus.forward(message[DESTINATION], message):
+            self.database.process_message(
+                message[SENDER], message[DESTINATION])
+            self.message_event(message, 'forward')
+            self.send(client, RESPONSE_200)
+        elif self.database.check_user(message[DESTINATION]):
+            self.database.process_message(
+                message[SENDER], message[DESTINATION])
+            self.database.store_offline(message[DESTINATION], message)
+            logger.info(
+                f'Сообщение для пользователя {message[DESTINATION]} от пользователя {message[SENDER]} отложено до его подключения.')
+            self.message_event(message, 'offline')
+            self.send(client, RESPONSE_200)
+        else:
+            self.message_event(message, 'unknown')
+            response = RESPONSE_400
+            response[ERROR] = 'Пользователь не зарегистрирован на сервере.'
+            self.send(client, response)
 
-        # Если это запрос контакт-листа
-        elif ACTION in message and message[ACTION] == GET_CONTACTS and USER in message and \
-                self.names[message[USER]] == client:
-            response = RESPONSE_202
-            response[LIST_INFO] = self.database.get_contacts(message[USER])
-            try:
-                send_message(client, response)
-            except OSError:
-                self.remove_client(client)
+    @actions.register(EXIT, (ACCOUNT_NAME,), ACCOUNT_NAME)
+    def client_exit(self, message, client):
+        """ Обработчик выхода клиента. """
+        self.remove_client(client)
 
-        # Если это добавление контакта
-        elif ACTION in message and message[ACTION] == ADD_CONTACT and ACCOUNT_NAME in message and USER in message \
-                and self.names[message[USER]] == client:
-            self.database.add_contact(message[USER], message[ACCOUNT_NAME])
-            try:
-                send_message(client, RESPONSE_200)
-            except OSError:
-                self.remove_client(client)
+    @actions.register(GET_CONTACTS, (USER,), USER)
+    def send_contacts(self, message, client):
+        """ Обработчик запроса контакт-листа. """
+        response = RESPONSE_202
+        # Версия читается до списка: изменения между ними клиент
+        # получит повторно, повторное применение ничего не меняет.
+        response[VERSION] = self.database.get_version()
+        response[LIST_INFO] = self.database.get_contacts(message[USER])
+        self.send(client, response)
 
-        # Если это удаление контакта
-        elif ACTION in message and message[ACTION] == REMOVE_CONTACT and ACCOUNT_NAME in message and USER in message \
-                and self.names[message[USER]] == client:
-            self.database.remove_contact(message[USER], message[ACCOUNT_NAME])
-            try:
-                send_message(client, RESPONSE_200)
-            except OSError:
-                self.remove_client(client)
+    @actions.register(ADD_CONTACT, (ACCOUNT_NAME, USER), USER)
+    def add_contact(self, message, client):
+        """ Обработчик добавления контакта. """
+        self.database.add_contact(message[USER], message[ACCOUNT_NAME])
+        self.send(client, RESPONSE_200)
 
-        # Если это запрос известных пользователей
-        elif ACTION in message and message[ACTION] == USERS_REQUEST and ACCOUNT_NAME in message \
-                and self.names[message[ACCOUNT_NAME]] == client:
-            response = RESPONSE_202
-            response[LIST_INFO] = [user[0]
-                                   for user in self.database.users_list()]
-            try:
-                send_message(client, response)
-            except OSError:
-                self.remove_client(client)
+    @actions.register(REMOVE_CONTACT, (ACCOUNT_NAME, USER), USER)
+    def remove_contact(self, message, client):
+        """ Обработчик удаления контакта. """
+        self.database.remove_contact(message[USER], message[ACCOUNT_NAME])
+        self.send(client, RESPONSE_200)
 
-        # Если это запрос публичного ключа пользователя
-        elif ACTION in message and message[ACTION] == PUBLIC_KEY_REQUEST and ACCOUNT_NAME in message:
-            response = RESPONSE_511
-            response[DATA] = self.database.get_pubkey(message[ACCOUNT_NAME])
-            # может быть, что ключа ещё нет (пользователь никогда не логинился,
-            # тогда шлём 400)
-            if response[DATA]:
-                try:
-                    send_message(client, response)
-                except OSError:
-                    self.remove_client(client)
-            else:
-                response = RESPONSE_400
-                response[ERROR] = 'Нет публичного ключа для данного пользователя'
-                try:
-                    send_message(client, response)
-                except OSError:
-                    self.remove_client(client)
+    @actions.register(USERS_REQUEST, (ACCOUNT_NAME,), ACCOUNT_NAME)
+    def send_users(self, message, client):
+        """ Обработчик запроса известных пользователей. """
+        response = RESPONSE_202
+        response[VERSION] = self.database.get_version()
+        response[LIST_INFO] = [user[0]
+                               for user in self.database.users_list()]
+        self.send(client, response)
+
+    @actions.register(GET_CHANGES, (ACCOUNT_NAME, VERSION), ACCOUNT_NAME)
+    def send_changes(self, message, client):
+        """
+        Обработчик запроса изменений списков пользователей и контактов
+        после версии клиента. Если версия серверу неизвестна, отвечает 400
+        и клиент загружает списки целиком.
+        """
+        changes = None
+        if isinstance(message[VERSION], int):
+            changes = self.database.get_changes(
+                message[ACCOUNT_NAME], message[VERSION])
+        if changes:
+            response = RESPONSE_202
+            response[VERSION], response[LIST_INFO] = changes
+        else:
+            response = RESPONSE_400
+            response[ERROR] = 'Неизвестная версия списков.'
+        self.send(client, response)
 
-        # Иначе отдаём Bad request
+    @actions.register(PUBLIC_KEY_REQUEST, (ACCOUNT_NAME,))
+    def send_pubkey(self, message, client):
+        """ Обработчик запроса публичного ключа пользователя. """
+        response = RESPONSE_511
+        response[DATA] = self.database.get_pubkey(message[ACCOUNT_NAME])
+        # может быть, что ключа ещё нет (пользователь никогда не логинился,
+        # тогда шлём 400)
+        if response[DATA]:
+            self.send(client, response)
         else:
+            response = RESPONSE_400
+            response[ERROR] = 'Нет публичного ключа для данного пользователя'
+            self.send(client, response)
+
+    @actions.register(PRESENCE, (TIME, USER),
+                      nested={USER: (ACCOUNT_NAME, PUBLIC_KEY)})
+    def autorize_user(self, message, client):
+        """
+        Метод начинающий авторизацию пользователя.
+        Отправляет клиенту запрос 511 и переводит сессию в состояние
+        CHALLENGED. Ответ клиента обрабатывает complete_auth при
+        получении следующего сообщения, основной цикл не блокируется.
+        """
+        session = self.sessions[client]
+        # Повторный presence (в том числе от авторизованного клиента)
+        # не должен сбрасывать состояние сессии.
+        if session.state != AWAITING_PRESENCE:
             response = RESPONSE_400
             response[ERROR] = 'Запрос некорректен.'
-            try:
-                send_message(client, response)
-            except OSError:
-                self.remove_client(client)
+            self.send(client, response)
+            return
+        if not self.check_presence(message, client):
+            return
+        message_auth, session.digest = self.make_challenge(
+            message[USER][ACCOUNT_NAME])
+        session.presence = message
+        session.state = CHALLENGED
+        # Если клиент поддерживает двоичный формат кадров и сжатие,
+        # сообщаем ему об этом в запросе 511 и дальше используем их.
+        codecs = message.get(CODECS)
+        if not isinstance(codecs, list):
+            codecs = []
+        if BINARY_CODEC in codecs or DEFLATE in codecs:
+            message_auth = dict(message_auth)
+        if BINARY_CODEC in codecs:
+            message_auth[CODEC] = BINARY_CODEC
+        if DEFLATE in codecs:
+            message_auth[COMPRESSION] = DEFLATE
+        self.send(client, message_auth)
+        if BINARY_CODEC in codecs:
+            session.codec = BINARY_CODEC
+        if DEFLATE in codecs:
+            session.compressor = zlib.compressobj()
 
-    def autorize_user(self, message, sock):
-        """ Метод реализующий авторизацию пользователей. """
+    def check_presence(self, message, client):
+        """
+        Метод первичной проверки сообщения о присутствии.
+        Если имя занято или не зарегистрировано, отвечает 400,
+        отключает клиента и возвращает False.
+        """
         # Если имя пользователя уже занято то возвращаем 400
         logger.debug(f'Start auth process for {message[USER]}')
-        if message[USER][ACCOUNT_NAME] in self.names.keys():
+        if self.name_busy(message[USER][ACCOUNT_NAME]):
             response = RESPONSE_400
             response[ERROR] = 'Имя пользователя уже занято.'
-            try:
-                logger.debug(f'Username busy, sending {response}')
-                send_message(sock, response)
-            except OSError:
-                logger.debug('OS Error')
-                pass
-            self.clients.remove(sock)
-            sock.close()
+            logger.debug(f'Username busy, sending {response}')
         # Проверяем что пользователь зарегистрирован на сервере.
         elif not self.database.check_user(message[USER][ACCOUNT_NAME]):
             response = RESPONSE_400
             response[ERROR] = 'Пользователь не зарегистрирован.'
-            try:
-                logger.debug(f'Unknown username, sending {response}')
-                send_message(sock, response)
-            except OSError:
-                pass
-            self.clients.remove(sock)
-            sock.close()
+            logger.debug(f'Unknown username, sending {response}')
         else:
             logger.debug('Correct username, starting passwd check.')
-            # Иначе отвечаем 511 и проводим процедуру авторизации
-            # Словарь - заготовка
-            message_auth = RESPONSE_511
-            # Набор байтов в hex представлении
-            random_str = binascii.hexlify(os.urandom(64))
-            # В словарь байты нельзя, декодируем (json.dumps -> TypeError)
-            message_auth[DATA] = random_str.decode('ascii')
-            # Создаём хэш пароля и связки с рандомной строкой, сохраняем
-            # серверную версию ключа
-            hash = hmac.new(self.database.get_hash(message[USER][ACCOUNT_NAME]), random_str, 'MD5')
-            digest = hash.digest()
-            logger.debug(f'Auth message = {message_auth}')
-            try:
-                # Обмен с клиентом
-                send_message(sock, message_auth)
-                ans = get_message(sock)
-            except OSError as err:
-                logger.debug('Error in auth, data:', exc_info=err)
-                sock.close()
-                return
+            return True
+        self.auth_event(user=message[USER][ACCOUNT_NAME], ok=False,
+                        reason=response[ERROR])
+        self.send(client, response)
+        self.remove_client(client)
+        return False
+
+    def make_challenge(self, name):
+        """
+        Метод формирующий запрос 511 для проверки пароля.
+        Возвращает сообщение для клиента и ожидаемый от него дайджест.
+        """
+        # Словарь - заготовка
+        message_auth = RESPONSE_511
+        # Набор байтов в hex представлении
+        random_str = binascii.hexlify(os.urandom(64))
+        # В словарь байты нельзя, декодируем (json.dumps -> TypeError)
+        message_auth[DATA] = random_str.decode('ascii')
+        # Создаём хэш пароля и связки с рандомной строкой, сохраняем
+        # серверную версию ключа
+        hash = hmac.new(self.database.get_hash(name), random_str, 'MD5')
+        digest = hash.digest()
+        logger.debug(f'Auth message = {message_auth}')
+        return message_auth, digest
+
+    def complete_auth(self, client, ans):
+        """ Метод проверяющий ответ клиента на запрос 511. """
+        session = self.sessions[client]
+        message = session.presence
+        # Если ответ клиента корректный, то сохраняем его в список
+        # пользователей.
+        try:
             client_digest = binascii.a2b_base64(ans[DATA])
-            # Если ответ клиента корректный, то сохраняем его в список
-            # пользователей.
-            if RESPONSE in ans and ans[RESPONSE] == 511 and \
-                    hmac.compare_digest(digest, client_digest):
-                self.names[message[USER][ACCOUNT_NAME]] = sock
-                client_ip, client_port = sock.getpeername()
-                try:
-                    send_message(sock, RESPONSE_200)
-                except OSError:
-                    self.remove_client(message[USER][ACCOUNT_NAME])
-                # добавляем пользователя в список активных и,
-                # если у него изменился открытый ключ, то сохраняем новый
-                self.database.user_login(
+        except (KeyError, TypeError, ValueError):
+            client_digest = b''
+        if RESPONSE in ans and ans[RESPONSE] == 511 and \
+                hmac.compare_digest(session.digest, client_digest):
+            # Пока шла проверка, имя мог занять другой клиент.
+            if not self.claim_name(message[USER][ACCOUNT_NAME]):
+                response = RESPONSE_400
+                response[ERROR] = 'Имя пользователя уже занято.'
+                self.auth_event(user=message[USER][ACCOUNT_NAME], ok=False,
+                                reason=response[ERROR])
+                self.send(client, response)
+                self.remove_client(client)
+                return
+            session.name = message[USER][ACCOUNT_NAME]
+            session.state = AUTHENTICATED
+            session.digest = session.presence = None
+            self.handshakes.pop(client, None)
+            self.names[session.name] = session
+            client_ip, client_port = client.getpeername()
+            # добавляем пользователя в список активных и,
+            # если у него изменился открытый ключ, то сохраняем новый
+            # и уведомляем клиентов о смене ключа
+            if self.database.user_login(
                     message[USER][ACCOUNT_NAME],
                     client_ip,
                     client_port,
-                    message[USER][PUBLIC_KEY])
+                    message[USER][PUBLIC_KEY]):
+                self.service_update_lists()
+                if self.bus:
+                    self.bus.broadcast({ACTION: LISTS_CHANGED,
+                                        LIST_INFO: [session.name]})
+            self.auth_event(user=session.name, ok=True, peer=(client_ip, client_port))
+            self.send(client, RESPONSE_200)
+            self.offline_round(client)
+        else:
+            response = RESPONSE_400
+            response[ERROR] = 'Неверный пароль.'
+            self.auth_event(user=message[USER][ACCOUNT_NAME], ok=False,
+                            reason=response[ERROR])
+            self.send(client, response)
+            self.remove_client(client)
+
+    def deliver_offline(self, client):
+        '''
+        Метод отправляющий пользователю очередную пачку отложенных
+        сообщений (не более OFFLINE_BATCH).
+        Сообщения удаляются из базы методом offline_sent только после
+        передачи их кадров в сокет, поэтому при отключении клиента
+        неотправленные сообщения доставляются при следующем входе.
+        Возвращает True, если в базе могли остаться ещё сообщения.
+        '''
+        session = self.sessions.get(client)
+        if session is None or not session.authorized:
+            return False
+        messages = self.database.get_offline(session.name, OFFLINE_BATCH)
+        if not messages:
+            return False
+        queued = 0
+        for message_id, message in messages:
+            # Очередь переполнена: остальные сообщения остаются в базе.
+            if self.send(client, message) is None:
+                break
+            session.offline_queued = message_id
+            queued += 1
+        if client not in self.sessions:
+            return False
+        if not self.queue_depth(client):
+            self.offline_sent(client)
+        logger.info(
+            f'Пользователю {session.name} отправлено отложенных сообщений: {queued}.')
+        return queued < len(messages) or len(messages) == OFFLINE_BATCH
+
+    def offline_sent(self, client):
+        '''
+        Метод вызываемый после отправки очереди клиента целиком:
+        удаляет из базы переданные в сокет отложенные сообщения.
+        '''
+        session = self.sessions[client]
+        if session.offline_queued is not None:
+            self.database.remove_offline(session.name, session.offline_queued)
+            session.offline_queued = None
+
+    def offline_round(self, client):
+        '''
+        Метод доставки отложенных сообщений по пачкам.
+        Следующая пачка отправляется отдельным поручением основного цикла
+        после освобождения очереди клиента, поэтому доставка большого
+        числа сообщений не задерживает обслуживание остальных клиентов.
+        '''
+        if self.deliver_offline(client):
+            session = self.sessions.get(client)
+            if session is None:
+                return
+            if session.queue:
+                session.offline = True
             else:
-                response = RESPONSE_400
-                response[ERROR] = 'Неверный пароль.'
-                try:
-                    send_message(sock, response)
-                except OSError:
-                    pass
-                self.clients.remove(sock)
-                sock.close()
+                self.call_threadsafe(self.offline_round, client)
 
     def service_update_lists(self):
-        '''Метод реализующий отправки сервисного сообщения 205 клиентам.'''
-        for client in self.names:
-            try:
-                send_message(self.names[client], RESPONSE_205)
-            except OSError:
-                self.remove_client(self.names[client])
+        '''
+        Метод планирующий рассылку сервисного сообщения 205 клиентам.
+        Изменения за NOTIFY_DELAY секунд рассылаются одним уведомлением.
+        Из других потоков вызывается через call_threadsafe.
+        '''
+        if self.notify_at is None:
+            self.notify_at = time.monotonic() + NOTIFY_DELAY
+
+    def notify_if_due(self):
+        '''
+        Метод рассылающий уведомления, если подошёл их срок.
+        Возвращает время до рассылки или None.
+        '''
+        if self.notify_at is None:
+            return None
+        wait = self.notify_at - time.monotonic()
+        if wait > 0:
+            return wait
+        self.notify_clients()
+        return None
+
+    def notify_clients(self):
+        '''
+        Метод рассылки уведомлений 205 об изменении списков.
+        Уведомление получают только затронутые пользователи: о новых
+        и удалённых пользователях и смене ключей - все, об изменении
+        контактов - владелец.
+        В уведомлении передаются сами изменения и версия, от которой они
+        отсчитаны, поэтому клиенту не нужно запрашивать списки.
+        После рассылки из журнала удаляются устаревшие записи.
+        '''
+        self.notify_at = None
+        base = self.notified_version
+        self.notified_version, changes = self.database.changes_after(base)
+        if changes is None:
+            # Изменения уже удалены из журнала: клиенты загружают списки
+            # целиком по уведомлению без изменений.
+            for session in list(self.names.values()):
+                self.send(session.client, {RESPONSE: 205})
+            return
+        if not changes:
+            return
+        for session in list(self.names.values()):
+            rows = [[kind, operation, name]
+                    for kind, operation, name, owner in changes
+                    if owner is None or owner == session.name]
+            if rows:
+                response = RESPONSE_205
+                response[BASE_VERSION] = base
+                response[VERSION] = self.notified_version
+                response[LIST_INFO] = rows
+                self.send(session.client, response)
+        self.database.prune_changes(self.notified_version)
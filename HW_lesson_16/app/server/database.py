@@ -1,7 +1,38 @@
 
-from sqlalchemy import create_engine, Table, Column, Integer, String, MetaData, ForeignKey, DateTime, Text
-from sqlalchemy.orm import mapper, sessionmaker
+from sqlalchemy import create_engine, event, func, Table, Column, Integer, String, MetaData, ForeignKey, DateTime, Text, bindparam
+from sqlalchemy.orm import mapper, sessionmaker, scoped_session
+from sqlalchemy.pool import SingletonThreadPool
+import collections
+import functools
+import json
+import threading
 import datetime
+import time
+import sys
+sys.path.append('../../')
+from common.variables import STAT_FLUSH_COUNT, STAT_FLUSH_INTERVAL, \
+    SQLITE_MMAP_SIZE, SQLITE_CACHE_SIZE, CHANGES_JOURNAL_LIMIT
+from server import metrics
+
+# Запись справочника пользователей: ID, хэш пароля и публичный ключ.
+UserRecord = collections.namedtuple('UserRecord', 'id passwd_hash pubkey')
+
+
+def reader(method):
+    '''
+    Декоратор методов чтения ServerStorage.
+    По завершении метода закрывает транзакцию сессии текущего потока,
+    чтобы следующее чтение видело свежие данные, а журнал WAL
+    мог быть перенесён в файл базы.
+    '''
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            self.session.close()
+
+    return wrapper
 
 
 class ServerStorage:
@@ -52,14 +83,66 @@ class ServerStorage:
             self.sent = 0
             self.accepted = 0
 
-    def __init__(self, path):
-        # Создаём движок базы данных
+    class OfflineMessages:
+        '''Класс - отображение таблицы сообщений для отключённых пользователей.'''
+
+        def __init__(self, user, message):
+            self.id = None
+            self.user = user
+            self.message = message
+
+    class Changes:
+        '''
+        Класс - отображение журнала изменений списков пользователей
+        и контактов. ID записи служит версией списков.
+        '''
+
+        def __init__(self, kind, operation, name, owner=None):
+            self.id = None
+            self.kind = kind
+            self.operation = operation
+            self.name = name
+            self.owner = owner
+
+    def __init__(self, path, stat_flush_count=STAT_FLUSH_COUNT,
+                 stat_flush_interval=STAT_FLUSH_INTERVAL, reset_active=True,
+                 changes_limit=CHANGES_JOURNAL_LIMIT):
+        # Счётчики статистики сообщений копятся в памяти и записываются
+        # в таблицу History одним запросом раз в stat_flush_count
+        # сообщений или stat_flush_interval секунд.
+        # {имя: [отправлено, принято]}
+        self.pending_stats = collections.defaultdict(lambda: [0, 0])
+        self.pending_count = 0
+        self.stat_flush_count = stat_flush_count
+        self.stat_flush_interval = stat_flush_interval
+        self.stat_flushed = time.monotonic()
+        self.stat_lock = threading.Lock()
+
+        # Журнал изменений хранит не более changes_limit последних записей,
+        # changes_floor - версия, до которой включительно записи удалены.
+        self.changes_limit = changes_limit
+        self.changes_floor = 0
+
+        # Справочник зарегистрированных пользователей {имя: UserRecord},
+        # заполняемый по мере обращений, и счётчики попаданий и промахов.
+        # Запись сбрасывается при добавлении и удалении пользователя
+        # и обновляется при смене ключа.
+        self.directory = dict()
+        self.directory_hits = 0
+        self.directory_misses = 0
+
+        # Создаём движок базы данных. Каждый поток (сервер и GUI)
+        # работает через своё соединение.
         self.database_engine = create_engine(
             f'sqlite:///{path}',
             echo=False,
             pool_recycle=7200,
+            poolclass=SingletonThreadPool,
             connect_args={
                 'check_same_thread': False})
+        event.listen(self.database_engine, 'connect', self.set_pragmas)
+        event.listen(self.database_engine, 'before_cursor_execute', self.query_started)
+        event.listen(self.database_engine, 'after_cursor_execute', self.query_finished)
 
         # Создаём объект MetaData
         self.metadata = MetaData()
@@ -106,6 +189,28 @@ class ServerStorage:
                                     Column('accepted', Integer)
                                     )
 
+        # Создаём таблицу сообщений, ожидающих подключения получателя.
+        # Записи только добавляются и удаляются после доставки.
+        offline_messages_table = Table('Offline_messages', self.metadata,
+                                       Column('id', Integer, primary_key=True),
+                                       Column('user', ForeignKey('Users.id'), index=True),
+                                       Column('message', Text)
+                                       )
+
+        # Создаём журнал изменений списков: kind - user, contact или key
+        # (смена открытого ключа), operation - add, remove или change,
+        # owner - владелец контакта.
+        changes_table = Table('Changes', self.metadata,
+                              Column('id', Integer, primary_key=True),
+                              Column('kind', String),
+                              Column('operation', String),
+                              Column('name', String),
+                              Column('owner', String, index=True)
+                              )
+
+        # Таблица статистики нужна для пакетного обновления счётчиков.
+        self.users_history_table = users_history_table
+
         # Создаём таблицы
         self.metadata.create_all(self.database_engine)
 
@@ -115,39 +220,76 @@ class ServerStorage:
         mapper(self.LoginHistory, user_login_history)
         mapper(self.UsersContacts, contacts)
         mapper(self.UsersHistory, users_history_table)
+        mapper(self.OfflineMessages, offline_messages_table)
+        mapper(self.Changes, changes_table)
 
-        # Создаём сессию
-        Session = sessionmaker(bind=self.database_engine)
-        self.session = Session()
+        # Создаём сессию. scoped_session выдаёт каждому потоку отдельную
+        # сессию, поэтому чтение из GUI не мешает записи из потока сервера.
+        self.session = scoped_session(sessionmaker(bind=self.database_engine))
 
         # Если в таблице активных пользователей есть записи, то их необходимо
-        # удалить
-        self.session.query(self.ActiveUsers).delete()
-        self.session.commit()
+        # удалить. Процессы многопроцессного сервера открывают уже
+        # очищенную базу и записи друг друга не трогают.
+        if reset_active:
+            self.session.query(self.ActiveUsers).delete()
+            self.session.commit()
+
+    @staticmethod
+    def set_pragmas(connection, connection_record):
+        '''
+        Обработчик нового соединения с SQLite.
+        Включает журнал WAL, при котором чтение не блокирует запись,
+        ослабляет синхронизацию до NORMAL и задаёт размеры mmap и кэша страниц.
+        '''
+        cursor = connection.cursor()
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute('PRAGMA synchronous=NORMAL')
+        cursor.execute(f'PRAGMA mmap_size={SQLITE_MMAP_SIZE}')
+        cursor.execute(f'PRAGMA cache_size={SQLITE_CACHE_SIZE}')
+        cursor.close()
+
+    @staticmethod
+    def query_started(conn, cursor, statement, parameters, context, executemany):
+        '''Обработчик начала запроса: запоминает время начала.'''
+        context.query_started = time.perf_counter()
+
+    @staticmethod
+    def query_finished(conn, cursor, statement, parameters, context, executemany):
+        '''Обработчик завершения запроса: учитывает его время в метриках.'''
+        metrics.db_query_seconds.observe(
+            time.perf_counter() - context.query_started)
 
     def user_login(self, username, ip_address, port, key):
         """
         Метод выполняющийся при входе пользователя, записывает в базу факт входа
         обновляет открытый ключ пользователя при его изменении.
+        Возвращает True, если ключ изменился.
         """
-        # Запрос в таблицу пользователей на наличие там пользователя с таким
-        # именем
-        rez = self.session.query(self.AllUsers).filter_by(name=username)
+        # Ищем пользователя в справочнике.
+        user = self.lookup_user(username)
 
-        # Если имя пользователя уже присутствует в таблице, обновляем время последнего входа
+        # Если пользователь зарегистрирован, обновляем время последнего входа
         # и проверяем корректность ключа. Если клиент прислал новый ключ,
         # сохраняем его.
-        if rez.count():
-            user = rez.first()
-            user.last_login = datetime.datetime.now()
-            if user.pubkey != key:
-                user.pubkey = key
+        if user:
+            changes = {self.AllUsers.last_login: datetime.datetime.now()}
+            key_changed = user.pubkey != key
+            if key_changed:
+                changes[self.AllUsers.pubkey] = key
+                self.directory[username] = user._replace(pubkey=key)
+                # Клиенты, сохранившие старый ключ, узнают о смене
+                # из журнала изменений.
+                self.session.add(self.Changes('key', 'change', username))
+            self.session.query(self.AllUsers).filter_by(
+                id=user.id).update(changes, synchronize_session=False)
         # Если нет, то генерируем исключение
         else:
             raise ValueError('Пользователь не зарегистрирован.')
 
         # Теперь можно создать запись в таблицу активных пользователей о факте
-        # входа.
+        # входа. Запись, оставшуюся от аварийно завершившегося процесса
+        # сервера, заменяем.
+        self.session.query(self.ActiveUsers).filter_by(user=user.id).delete()
         new_active_user = self.ActiveUsers(
             user.id, ip_address, port, datetime.datetime.now())
         self.session.add(new_active_user)
@@ -159,6 +301,7 @@ class ServerStorage:
 
         # Сохраняем изменения
         self.session.commit()
+        return key_changed
 
     def add_user(self, name, passwd_hash):
         """
@@ -170,11 +313,21 @@ class ServerStorage:
         self.session.commit()
         history_row = self.UsersHistory(user_row.id)
         self.session.add(history_row)
+        self.session.add(self.Changes('user', 'add', name))
         self.session.commit()
+        self.directory.pop(name, None)
 
     def remove_user(self, name):
         """Метод удаляющий пользователя из базы."""
-        user = self.session.query(self.AllUsers).filter_by(name=name).first()
+        user = self.lookup_user(name)
+        # Пользователь исчезает из списка всех и из контактов у тех,
+        # кто его добавил.
+        self.session.add(self.Changes('user', 'remove', name))
+        owners = self.session.query(self.AllUsers.name).join(
+            self.UsersContacts, self.UsersContacts.user == self.AllUsers.id
+        ).filter(self.UsersContacts.contact == user.id).all()
+        for owner, in owners:
+            self.session.add(self.Changes('contact', 'remove', name, owner))
         self.session.query(self.ActiveUsers).filter_by(user=user.id).delete()
         self.session.query(self.LoginHistory).filter_by(name=user.id).delete()
         self.session.query(self.UsersContacts).filter_by(user=user.id).delete()
@@ -182,22 +335,58 @@ class ServerStorage:
             self.UsersContacts).filter_by(
             contact=user.id).delete()
         self.session.query(self.UsersHistory).filter_by(user=user.id).delete()
+        self.session.query(self.OfflineMessages).filter_by(user=user.id).delete()
         self.session.query(self.AllUsers).filter_by(name=name).delete()
         self.session.commit()
+        self.directory.pop(name, None)
+
+    def lookup_user(self, name):
+        """
+        Метод поиска пользователя в справочнике.
+        При промахе запись читается из таблицы пользователей.
+        Возвращает UserRecord или None, если пользователь не зарегистрирован.
+        """
+        user = self.directory.get(name)
+        if user is not None:
+            self.directory_hits += 1
+            return user
+        self.directory_misses += 1
+        row = self.session.query(
+            self.AllUsers.id,
+            self.AllUsers.passwd_hash,
+            self.AllUsers.pubkey
+        ).filter_by(name=name).first()
+        self.session.close()
+        if row is None:
+            return None
+        user = self.directory[name] = UserRecord(*row)
+        return user
+
+    def forget_user(self, name):
+        """
+        Метод удаляющий пользователя из справочника.
+        Вызывается, когда запись изменил другой процесс сервера.
+        """
+        self.directory.pop(name, None)
+
+    def directory_stats(self):
+        """Метод возвращающий размер справочника и число попаданий и промахов."""
+        return {
+            'size': len(self.directory),
+            'hits': self.directory_hits,
+            'misses': self.directory_misses}
 
     def get_hash(self, name):
         """Метод получения хэша пароля пользователя."""
-        user = self.session.query(self.AllUsers).filter_by(name=name).first()
-        return user.passwd_hash
+        return self.lookup_user(name).passwd_hash
 
     def get_pubkey(self, name):
         """Метод получения публичного ключа пользователя."""
-        user = self.session.query(self.AllUsers).filter_by(name=name).first()
-        return user.pubkey
+        return self.lookup_user(name).pubkey
 
     def check_user(self, name):
         """Метод проверяющий существование пользователя."""
-        if self.session.query(self.AllUsers).filter_by(name=name).count():
+        if self.lookup_user(name):
             return True
         else:
             return False
@@ -205,9 +394,7 @@ class ServerStorage:
     def user_logout(self, username):
         """Метод фиксирующий отключения пользователя."""
         # Запрашиваем пользователя, что покидает нас
-        user = self.session.query(
-            self.AllUsers).filter_by(
-            name=username).first()
+        user = self.lookup_user(username)
 
         # Удаляем его из таблицы активных пользователей.
         self.session.query(self.ActiveUsers).filter_by(user=user.id).delete()
@@ -216,33 +403,92 @@ class ServerStorage:
         self.session.commit()
 
     def process_message(self, sender, recipient):
-        """Метод записывающий в таблицу статистики факт передачи сообщения."""
-        # Получаем ID отправителя и получателя
-        sender = self.session.query(
-            self.AllUsers).filter_by(
-            name=sender).first().id
-        recipient = self.session.query(
-            self.AllUsers).filter_by(
-            name=recipient).first().id
-        # Запрашиваем строки из истории и увеличиваем счётчики
-        sender_row = self.session.query(
-            self.UsersHistory).filter_by(
-            user=sender).first()
-        sender_row.sent += 1
-        recipient_row = self.session.query(
-            self.UsersHistory).filter_by(
-            user=recipient).first()
-        recipient_row.accepted += 1
+        """
+        Метод учитывающий в статистике факт передачи сообщения.
+        Счётчики увеличиваются в памяти, запись в базу откладывается
+        до flush_statistics.
+        """
+        with self.stat_lock:
+            self.pending_stats[sender][0] += 1
+            self.pending_stats[recipient][1] += 1
+            self.pending_count += 1
+            due = self.pending_count >= self.stat_flush_count
+        if due:
+            self.flush_statistics()
+
+    def flush_statistics(self, force=True):
+        """
+        Метод записывающий накопленные счётчики в таблицу статистики
+        одним пакетным UPDATE.
+        При force=False запись выполняется, только если с прошлой
+        записи прошло stat_flush_interval секунд.
+        Возвращает время в секундах до следующей записи по таймеру
+        или None, если записывать нечего.
+        """
+        with self.stat_lock:
+            if not self.pending_count:
+                return None
+            wait = self.stat_flushed + self.stat_flush_interval - time.monotonic()
+            if not force and wait > 0:
+                return wait
+            pending, self.pending_stats = self.pending_stats, \
+                collections.defaultdict(lambda: [0, 0])
+            self.pending_count = 0
+            self.stat_flushed = time.monotonic()
+
+        # Получаем ID участников из справочника, удалённых пропускаем.
+        rows = []
+        for name, (sent, accepted) in pending.items():
+            user = self.lookup_user(name)
+            if user:
+                rows.append({'user_id': user.id, 'sent_delta': sent,
+                             'accepted_delta': accepted})
+        if not rows:
+            return None
+        history = self.users_history_table
+        self.session.execute(
+            history.update().where(history.c.user == bindparam('user_id')).values(
+                sent=history.c.sent + bindparam('sent_delta'),
+                accepted=history.c.accepted + bindparam('accepted_delta')),
+            rows)
+        self.session.commit()
+        return None
 
+    def store_offline(self, username, message):
+        """Метод сохраняющий сообщение для отключённого пользователя."""
+        user = self.lookup_user(username)
+        self.session.add(self.OfflineMessages(user.id, json.dumps(message)))
+        self.session.commit()
+
+    @reader
+    def get_offline(self, username, limit):
+        """
+        Метод возвращающий не более limit старейших сообщений,
+        ожидающих пользователя, в виде списка кортежей (ID, сообщение).
+        """
+        user = self.lookup_user(username)
+        query = self.session.query(
+            self.OfflineMessages.id,
+            self.OfflineMessages.message
+        ).filter_by(user=user.id).order_by(self.OfflineMessages.id).limit(limit)
+        return [(message_id, json.loads(message))
+                for message_id, message in query.all()]
+
+    def remove_offline(self, username, last_id):
+        """Метод удаляющий доставленные сообщения пользователя до last_id включительно."""
+        user = self.lookup_user(username)
+        self.session.query(self.OfflineMessages).filter(
+            self.OfflineMessages.user == user.id,
+            self.OfflineMessages.id <= last_id
+        ).delete(synchronize_session=False)
         self.session.commit()
 
     def add_contact(self, user, contact):
         """Метод добавления контакта для пользователя."""
         # Получаем ID пользователей
-        user = self.session.query(self.AllUsers).filter_by(name=user).first()
-        contact = self.session.query(
-            self.AllUsers).filter_by(
-            name=contact).first()
+        user_name, contact_name = user, contact
+        user = self.lookup_user(user)
+        contact = self.lookup_user(contact)
 
         # Проверяем что не дубль и что контакт может существовать (полю
         # пользователь мы доверяем)
@@ -255,16 +501,16 @@ class ServerStorage:
         # Создаём объект и заносим его в базу
         contact_row = self.UsersContacts(user.id, contact.id)
         self.session.add(contact_row)
+        self.session.add(self.Changes('contact', 'add', contact_name, user_name))
         self.session.commit()
 
     # Функция удаляет контакт из базы данных
     def remove_contact(self, user, contact):
         """Метод удаления контакта пользователя."""
         # Получаем ID пользователей
-        user = self.session.query(self.AllUsers).filter_by(name=user).first()
-        contact = self.session.query(
-            self.AllUsers).filter_by(
-            name=contact).first()
+        user_name, contact_name = user, contact
+        user = self.lookup_user(user)
+        contact = self.lookup_user(contact)
 
         # Проверяем что контакт может существовать (полю пользователь мы
         # доверяем)
@@ -272,12 +518,83 @@ class ServerStorage:
             return
 
         # Удаляем требуемое
-        self.session.query(self.UsersContacts).filter(
+        if self.session.query(self.UsersContacts).filter(
             self.UsersContacts.user == user.id,
             self.UsersContacts.contact == contact.id
-        ).delete()
+        ).delete():
+            self.session.add(
+                self.Changes('contact', 'remove', contact_name, user_name))
+        self.session.commit()
+
+    @reader
+    def get_version(self):
+        """Метод возвращающий текущую версию списков пользователей и контактов."""
+        return self.session.query(func.max(self.Changes.id)).scalar() or 0
+
+    @reader
+    def get_changes(self, username, version):
+        """
+        Метод возвращающий изменения списка пользователей, ключей
+        и контактов пользователя username после версии version.
+        Возвращает кортеж (текущая версия, список [kind, operation, name])
+        в порядке изменений или None, если версия неизвестна серверу
+        или изменения после неё уже удалены из журнала.
+        """
+        first, current = self.session.query(
+            func.min(self.Changes.id), func.max(self.Changes.id)).one()
+        current = current or 0
+        if version > current or (first is not None and version < first - 1):
+            return None
+        query = self.session.query(
+            self.Changes.kind,
+            self.Changes.operation,
+            self.Changes.name
+        ).filter(
+            self.Changes.id > version,
+            self.Changes.id <= current,
+            (self.Changes.owner == None) | (self.Changes.owner == username)
+        ).order_by(self.Changes.id)
+        return current, [list(change) for change in query.all()]
+
+    @reader
+    def changes_after(self, version):
+        """
+        Метод возвращающий все изменения списков после версии version.
+        Возвращает кортеж (текущая версия, список кортежей
+        (kind, operation, name, owner)). Если изменения после version
+        уже удалены из журнала, вместо списка возвращается None.
+        """
+        first, current = self.session.query(
+            func.min(self.Changes.id), func.max(self.Changes.id)).one()
+        if first is not None and version < first - 1:
+            return current, None
+        query = self.session.query(
+            self.Changes.id,
+            self.Changes.kind,
+            self.Changes.operation,
+            self.Changes.name,
+            self.Changes.owner
+        ).filter(self.Changes.id > version).order_by(self.Changes.id)
+        rows = query.all()
+        if not rows:
+            return version, []
+        return rows[-1][0], [row[1:] for row in rows]
+
+    def prune_changes(self, version):
+        """
+        Метод удаляющий из журнала изменений записи, отстоящие от версии
+        version больше чем на changes_limit. Клиентам с более старой
+        версией списков сервер предложит загрузить списки целиком.
+        """
+        floor = version - self.changes_limit
+        if floor <= self.changes_floor:
+            return
+        self.session.query(self.Changes).filter(
+            self.Changes.id <= floor).delete(synchronize_session=False)
         self.session.commit()
+        self.changes_floor = floor
 
+    @reader
     def users_list(self):
         """Метод возвращающий список известных пользователей со временем последнего входа."""
         # Запрос строк таблицы пользователей.
@@ -288,6 +605,7 @@ class ServerStorage:
         # Возвращаем список кортежей
         return query.all()
 
+    @reader
     def active_users_list(self):
         """Метод возвращающий список активных пользователей."""
         # Запрашиваем соединение таблиц и собираем кортежи имя, адрес, порт,
@@ -301,6 +619,7 @@ class ServerStorage:
         # Возвращаем список кортежей
         return query.all()
 
+    @reader
     def login_history(self, username=None):
         """Метод возвращающий историю входов."""
         # Запрашиваем историю входа
@@ -316,10 +635,11 @@ class ServerStorage:
         # Возвращаем список кортежей
         return query.all()
 
+    @reader
     def get_contacts(self, username):
         """Метод возвращающий список контактов пользователя."""
         # Запрашиваем указанного пользователя
-        user = self.session.query(self.AllUsers).filter_by(name=username).one()
+        user = self.lookup_user(username)
 
         # Запрашиваем его список контактов
         query = self.session.query(self.UsersContacts, self.AllUsers.name). \
@@ -329,16 +649,26 @@ class ServerStorage:
         # выбираем только имена пользователей и возвращаем их.
         return [contact[1] for contact in query.all()]
 
+    @reader
     def message_history(self):
-        """Метод возвращающий статистику сообщений."""
+        """
+        Метод возвращающий статистику сообщений.
+        К записанным значениям добавляются ещё не записанные счётчики.
+        """
         query = self.session.query(
             self.AllUsers.name,
             self.AllUsers.last_login,
             self.UsersHistory.sent,
             self.UsersHistory.accepted
         ).join(self.AllUsers)
+        with self.stat_lock:
+            pending = {name: tuple(counters)
+                       for name, counters in self.pending_stats.items()}
         # Возвращаем список кортежей
-        return query.all()
+        return [(name, last_login,
+                 sent + pending.get(name, (0, 0))[0],
+                 accepted + pending.get(name, (0, 0))[1])
+                for name, last_login, sent, accepted in query.all()]
 
 
 # Отладка
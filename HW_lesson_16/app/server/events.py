@@ -0,0 +1,77 @@
+import json
+import os
+import time
+import sys
+sys.path.append('../../')
+from common.variables import *
+
+
+class EventLog:
+    '''
+    Класс - журнал событий сервера в формате JSON lines.
+    Каждое событие - одна строка JSON с полями ts (время, секунды),
+    event (вид события) и полями события. Строки накапливаются в буфере
+    и записываются в файл при заполнении буфера или по таймеру.
+    Файл открывается в двоичном режиме и при превышении max_bytes
+    переименовывается в path.1 (старые копии сдвигаются, хранится
+    не более backups копий).
+    '''
+
+    def __init__(self, path, max_bytes=EVENTS_MAX_BYTES, backups=EVENTS_BACKUPS,
+                 flush_interval=EVENTS_FLUSH_INTERVAL):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.flush_interval = flush_interval
+        self.buffer = bytearray()
+        self.flushed = time.monotonic()
+        self.file = open(path, 'ab')
+
+    def write(self, event, **fields):
+        '''Метод добавления события в журнал.'''
+        fields['ts'] = time.time()
+        fields['event'] = event
+        self.buffer += json.dumps(
+            fields, ensure_ascii=False, separators=(',', ':')).encode(ENCODING)
+        self.buffer += b'\n'
+        if len(self.buffer) >= EVENTS_BUFFER:
+            self.flush()
+
+    def flush(self, force=True):
+        '''
+        Метод записывающий накопленные события в файл.
+        При force=False запись выполняется, только если с прошлой
+        записи прошло flush_interval секунд.
+        Возвращает время в секундах до следующей записи по таймеру
+        или None, если записывать нечего.
+        '''
+        if not self.buffer:
+            return None
+        wait = self.flushed + self.flush_interval - time.monotonic()
+        if not force and wait > 0:
+            return wait
+        if self.file.tell() + len(self.buffer) > self.max_bytes:
+            self.rotate()
+        self.file.write(self.buffer)
+        self.file.flush()
+        self.buffer.clear()
+        self.flushed = time.monotonic()
+        return None
+
+    def rotate(self):
+        '''Метод начинающий новый файл журнала.'''
+        self.file.close()
+        for number in range(self.backups - 1, 0, -1):
+            source = f'{self.path}.{number}'
+            if os.path.exists(source):
+                os.replace(source, f'{self.path}.{number + 1}')
+        if self.backups:
+            os.replace(self.path, f'{self.path}.1')
+        else:
+            os.remove(self.path)
+        self.file = open(self.path, 'ab')
+
+    def close(self):
+        '''Метод записывающий остаток событий и закрывающий файл.'''
+        self.flush()
+        self.file.close()
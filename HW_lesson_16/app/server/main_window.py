@@ -2,10 +2,12 @@
 from PyQt5.QtWidgets import QMainWindow, QAction, qApp, QApplication, QLabel, QTableView
 from PyQt5.QtGui import QStandardItemModel, QStandardItem
 from PyQt5.QtCore import QTimer
+from common.variables import PROFILE_SECONDS
 from server.stat_window import StatWindow
 from server.config_window import ConfigWindow
 from server.add_user import RegisterUser
 from server.remove_user import DelUserDialog
+from server.profiling import Profiler
 
 
 class MainWindow(QMainWindow):
@@ -18,6 +20,7 @@ class MainWindow(QMainWindow):
 
         self.server_thread = server
         self.config = config
+        self.profiler = Profiler(server)
 
         # Ярлык выхода
         self.exitAction = QAction('Выход', self)
@@ -39,6 +42,10 @@ class MainWindow(QMainWindow):
         # Кнопка вывести историю сообщений
         self.show_history_button = QAction('История клиентов', self)
 
+        # Кнопки профилирования сервера (cProfile и выборка стеков)
+        self.profile_btn = QAction('Профилирование', self)
+        self.sample_btn = QAction('Профилирование выборкой', self)
+
         # Статусбар
         self.statusBar()
         self.statusBar().showMessage('Server Working')
@@ -51,6 +58,8 @@ class MainWindow(QMainWindow):
         self.toolbar.addAction(self.config_btn)
         self.toolbar.addAction(self.register_btn)
         self.toolbar.addAction(self.remove_btn)
+        self.toolbar.addAction(self.profile_btn)
+        self.toolbar.addAction(self.sample_btn)
 
         # Настройки геометрии основного окна
         # Поскольку работать с динамическими размерами мы не умеем, и мало
@@ -79,6 +88,8 @@ class MainWindow(QMainWindow):
         self.config_btn.triggered.connect(self.server_config)
         self.register_btn.triggered.connect(self.reg_user)
         self.remove_btn.triggered.connect(self.rem_user)
+        self.profile_btn.triggered.connect(lambda: self.run_profiler('cprofile'))
+        self.sample_btn.triggered.connect(lambda: self.run_profiler('sample'))
 
         # Последним параметром отображаем окно.
         self.show()
@@ -124,6 +135,14 @@ class MainWindow(QMainWindow):
         reg_window = RegisterUser(self.database, self.server_thread)
         reg_window.show()
 
+    def run_profiler(self, mode):
+        '''Метод запускающий профилирование сервера на PROFILE_SECONDS секунд.'''
+        if self.profiler.start(PROFILE_SECONDS, mode):
+            self.statusBar().showMessage(
+                f'Профилирование {PROFILE_SECONDS} с, результат в каталоге logs')
+        else:
+            self.statusBar().showMessage('Профилирование уже запущено')
+
     def rem_user(self):
         '''Метод создающий окно удаления пользователя.'''
         global rem_window
@@ -0,0 +1,184 @@
+import bisect
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import sys
+sys.path.append('../../')
+from common.variables import *
+
+# Загрузка логера
+logger = logging.getLogger('server_dist')
+
+
+class Counter:
+    '''Класс - счётчик, значение которого только растёт.'''
+    kind = 'counter'
+
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help = help_text
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def samples(self):
+        return [(self.name, '', self.value)]
+
+
+class Gauge:
+    '''
+    Класс - показатель, который может расти и уменьшаться.
+    Значение задаётся методом set либо вычисляется функцией при
+    каждом чтении (set_function).
+    '''
+    kind = 'gauge'
+
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help = help_text
+        self.value = 0
+        self.function = None
+
+    def set(self, value):
+        self.value = value
+
+    def set_function(self, function):
+        self.function = function
+
+    def samples(self):
+        value = self.function() if self.function else self.value
+        return [(self.name, '', value)]
+
+
+class Histogram:
+    '''
+    Класс - гистограмма с фиксированными границами корзин.
+    Хранит число наблюдений в каждой корзине, их сумму и количество.
+    '''
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, buckets):
+        self.name = name
+        self.help = help_text
+        self.buckets = tuple(sorted(buckets))
+        # Последняя корзина - наблюдения больше всех границ (+Inf).
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def samples(self):
+        with self.lock:
+            counts = list(self.counts)
+            total = self.sum
+        samples = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += count
+            le = '+Inf' if bound == float('inf') else repr(bound)
+            samples.append((f'{self.name}_bucket', f'{{le="{le}"}}', cumulative))
+        samples.append((f'{self.name}_sum', '', total))
+        samples.append((f'{self.name}_count', '', cumulative))
+        return samples
+
+
+class MetricsRegistry:
+    '''
+    Класс - набор метрик процесса.
+    Выдаёт значения всех метрик в текстовом формате Prometheus.
+    '''
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help_text):
+        return self.register(Counter(name, help_text))
+
+    def gauge(self, name, help_text):
+        return self.register(Gauge(name, help_text))
+
+    def histogram(self, name, help_text, buckets=METRICS_BUCKETS):
+        return self.register(Histogram(name, help_text, buckets))
+
+    def exposition(self):
+        '''Метод формирующий текст со значениями всех метрик.'''
+        lines = []
+        for metric in self.metrics:
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            for name, labels, value in metric.samples():
+                lines.append(f'{name}{labels} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+# Метрики сервера. Процесс сервера ведёт один набор метрик.
+registry = MetricsRegistry()
+connections = registry.gauge(
+    'server_connections', 'Открытые подключения клиентов.')
+connections_total = registry.counter(
+    'server_connections_total', 'Принятые подключения клиентов.')
+auth_ok = registry.counter(
+    'server_auth_ok_total', 'Успешные авторизации.')
+auth_failed = registry.counter(
+    'server_auth_failed_total', 'Неудачные авторизации.')
+messages = registry.counter(
+    'server_messages_total', 'Сообщения пользователей, принятые к доставке.')
+bytes_received = registry.counter(
+    'server_bytes_received_total', 'Байты, принятые от клиентов.')
+bytes_sent = registry.counter(
+    'server_bytes_sent_total', 'Байты, отправленные клиентам.')
+directory_size = registry.gauge(
+    'server_directory_size', 'Записи в справочнике пользователей.')
+directory_hits = registry.gauge(
+    'server_directory_hits', 'Попадания в справочник пользователей.')
+directory_misses = registry.gauge(
+    'server_directory_misses',
+    'Промахи справочника пользователей (чтения таблицы пользователей).')
+db_query_seconds = registry.histogram(
+    'server_db_query_seconds', 'Время выполнения запросов к базе, секунды.')
+loop_seconds = registry.histogram(
+    'server_loop_iteration_seconds',
+    'Время обработки событий за одну итерацию основного цикла, секунды.')
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    '''Класс - обработчик HTTP запроса значений метрик.'''
+
+    def do_GET(self):
+        if self.path not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = registry.exposition().encode(ENCODING)
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug('Запрос метрик: ' + format, *args)
+
+
+def start_http_server(port, address='127.0.0.1'):
+    '''
+    Функция запускающая HTTP сервер метрик в отдельном потоке.
+    :return: объект сервера, остановка - метод shutdown.
+    '''
+    server = ThreadingHTTPServer((address, port), MetricsHandler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    logger.info(f'Метрики сервера доступны по адресу http://{address}:{port}/metrics')
+    return server
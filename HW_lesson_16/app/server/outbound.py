@@ -0,0 +1,63 @@
+import collections
+import itertools
+
+# Максимальное число кадров, передаваемых в одном вызове sendmsg.
+MAX_IOV = 64
+
+
+class OutboundQueue:
+    '''
+    Класс - ограниченная очередь исходящих кадров одного клиента.
+    Хранит неотправленные кадры и учитывает их суммарный объём.
+    Отправка выполняется частями: сколько байтов принял сокет,
+    столько и удаляется из очереди, остаток ждёт готовности к записи.
+    '''
+
+    def __init__(self, high_water):
+        # Предельный объём неотправленных данных в байтах.
+        self.high_water = high_water
+        self.frames = collections.deque()
+        # Объём неотправленных данных и смещение в первом кадре.
+        self.size = 0
+        self.offset = 0
+
+    def __len__(self):
+        return self.size
+
+    def push(self, frame):
+        '''
+        Метод добавления кадра в очередь.
+        Возвращает False, если кадр не помещается под предел объёма.
+        В пустую очередь кадр принимается при любом размере.
+        '''
+        if self.frames and self.size + len(frame) > self.high_water:
+            return False
+        self.frames.append(frame)
+        self.size += len(frame)
+        return True
+
+    def send(self, sock):
+        '''
+        Метод отправки накопленных кадров в неблокирующий сокет.
+        Несколько кадров передаются одним системным вызовом.
+        :return: количество отправленных байтов.
+        '''
+        if not self.frames:
+            return 0
+        head = memoryview(self.frames[0])[self.offset:]
+        if hasattr(sock, 'sendmsg'):
+            buffers = [head]
+            buffers.extend(itertools.islice(self.frames, 1, MAX_IOV))
+            sent = sock.sendmsg(buffers)
+        else:
+            sent = sock.send(head)
+        self.consume(sent)
+        return sent
+
+    def consume(self, sent):
+        '''Метод удаляющий из очереди отправленные байты.'''
+        self.size -= sent
+        sent += self.offset
+        while self.frames and sent >= len(self.frames[0]):
+            sent -= len(self.frames.popleft())
+        self.offset = sent
@@ -0,0 +1,118 @@
+import collections
+import cProfile
+import logging
+import os
+import threading
+import time
+import sys
+sys.path.append('../../')
+from common.variables import *
+
+# Загрузка логера
+logger = logging.getLogger('server_dist')
+
+# Каталог, в который записываются результаты профилирования.
+PROFILE_DIR = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'logs')
+
+
+class Profiler:
+    '''
+    Класс - профилирование потока сервера по команде администратора.
+    Режим cprofile включает cProfile в потоке сервера (через
+    call_threadsafe) и записывает статистику pstats. Режим sample
+    периодически снимает стек потока сервера из отдельного потока
+    и записывает свёрнутые стеки (collapsed stacks) для построения
+    flame graph. Пока профилирование не запущено, сервер не несёт
+    никаких затрат.
+    '''
+
+    def __init__(self, server, directory=PROFILE_DIR):
+        self.server = server
+        self.directory = directory
+        # Текущий режим или None, если профилирование не идёт.
+        self.mode = None
+        self.profile = None
+        self.timer = None
+        self.sampler = None
+        self.stopped = threading.Event()
+        self.stacks = collections.Counter()
+
+    def start(self, seconds=PROFILE_SECONDS, mode='cprofile'):
+        '''
+        Метод запуска профилирования на seconds секунд, из любого потока.
+        Возвращает False, если профилирование уже идёт.
+        '''
+        if mode not in ('cprofile', 'sample'):
+            raise ValueError(f'Неизвестный режим профилирования {mode}.')
+        if self.mode:
+            return False
+        self.mode = mode
+        if mode == 'cprofile':
+            self.server.call_threadsafe(self.enable)
+        else:
+            self.stopped.clear()
+            self.stacks.clear()
+            self.sampler = threading.Thread(target=self.sample, daemon=True)
+            self.sampler.start()
+        self.timer = threading.Timer(seconds, self.stop)
+        self.timer.daemon = True
+        self.timer.start()
+        logger.info(f'Запущено профилирование сервера ({mode}) на {seconds} с.')
+        return True
+
+    def stop(self):
+        '''Метод досрочной остановки профилирования, из любого потока.'''
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+        if self.mode == 'cprofile':
+            self.server.call_threadsafe(self.disable)
+        elif self.mode == 'sample':
+            self.stopped.set()
+            self.sampler.join()
+            self.dump_stacks()
+            self.mode = None
+
+    def filename(self, extension):
+        '''Метод формирующий имя файла результата.'''
+        stamp = time.strftime('%Y%m%d-%H%M%S')
+        return os.path.join(self.directory, f'profile-{stamp}-{os.getpid()}.{extension}')
+
+    def enable(self):
+        '''Метод включающий cProfile, выполняется в потоке сервера.'''
+        self.profile = cProfile.Profile()
+        self.profile.enable()
+
+    def disable(self):
+        '''Метод выключающий cProfile и записывающий статистику, в потоке сервера.'''
+        if self.profile is None:
+            return
+        self.profile.disable()
+        path = self.filename('pstats')
+        self.profile.dump_stats(path)
+        self.profile = None
+        self.mode = None
+        logger.info(f'Профиль сервера записан в {path}')
+
+    def sample(self):
+        '''Метод - цикл потока, снимающего стеки потока сервера.'''
+        ident = self.server.ident
+        while not self.stopped.wait(PROFILE_INTERVAL):
+            frame = sys._current_frames().get(ident)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(
+                    f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def dump_stacks(self):
+        '''Метод записывающий свёрнутые стеки: строка "стек число".'''
+        path = self.filename('folded')
+        with open(path, 'w', encoding=ENCODING) as file:
+            for stack, count in self.stacks.most_common():
+                file.write(f'{stack} {count}\n')
+        logger.info(f'Профиль сервера записан в {path}')
@@ -0,0 +1,51 @@
+import sys
+sys.path.append('../../')
+from common.variables import JSON_CODEC
+
+# Состояния сессии: ожидание presence, отправлен запрос 511,
+# пользователь авторизован.
+AWAITING_PRESENCE = 'awaiting_presence'
+CHALLENGED = 'challenged'
+AUTHENTICATED = 'authenticated'
+
+
+class ClientSession:
+    '''
+    Класс - сессия подключённого клиента.
+    Связывает соединение клиента (сокет либо StreamClient) с именем
+    авторизованного пользователя и его очередью отправки, а также
+    хранит состояние авторизации:
+    AWAITING_PRESENCE -> CHALLENGED -> AUTHENTICATED.
+    MessageProcessor хранит сессии в двух словарях: по соединению
+    и по имени пользователя, поэтому и проверка авторизации, и поиск
+    получателя, и отключение выполняются за постоянное время.
+    '''
+
+    def __init__(self, client, queue=None):
+        self.client = client
+        # Очередь исходящих кадров (только для MessageProcessor).
+        self.queue = queue
+        # Имя пользователя, None до успешной авторизации.
+        self.name = None
+        # Состояние авторизации, сообщение presence и ожидаемый
+        # ответ на запрос 511.
+        self.state = AWAITING_PRESENCE
+        self.presence = None
+        self.digest = None
+        # Формат кадров, отправляемых клиенту, и поток сжатия кадров,
+        # если клиент поддерживает сжатие.
+        self.codec = JSON_CODEC
+        self.compressor = None
+        # Признак отложенных сообщений, ожидающих освобождения очереди,
+        # и ID последнего отложенного сообщения, поставленного в очередь,
+        # но ещё не переданного в сокет.
+        self.offline = False
+        self.offline_queued = None
+
+    def __repr__(self):
+        return f'<ClientSession {self.name} {self.client}>'
+
+    @property
+    def authorized(self):
+        '''Признак успешной авторизации клиента.'''
+        return self.state == AUTHENTICATED
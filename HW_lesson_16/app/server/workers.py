@@ -0,0 +1,134 @@
+import logging
+import multiprocessing
+import multiprocessing.connection
+import os
+import shutil
+import tempfile
+import threading
+import time
+import sys
+sys.path.append('../../')
+from common.variables import WORKER_RESTART_DELAY
+from server.bus import RoutingBus, socket_path
+from server.core import MessageProcessor
+from server.database import ServerStorage
+
+# Загрузка логера
+logger = logging.getLogger('server_dist')
+
+
+def run_worker(worker, listen_address, listen_port, database_path,
+               bus_path, registry, stopped, options):
+    '''
+    Функция - точка входа процесса сервера.
+    Запускает MessageProcessor, слушающий общий порт, и ждёт
+    команды на остановку: данных или закрытия канала stopped.
+    '''
+    database = ServerStorage(database_path, reset_active=False)
+    server = MessageProcessor(
+        listen_address, listen_port, database,
+        bus=RoutingBus(worker, bus_path, registry), **options)
+    server.daemon = True
+    server.start()
+    multiprocessing.connection.wait([stopped])
+    server.stop()
+    server.join()
+
+
+class WorkerPool:
+    '''
+    Класс - группа процессов сервера.
+    Процессы запускаются методом spawn, каждый открывает своё
+    подключение к общей базе данных и принимает подключения
+    клиентов на общем порту.
+    Реестр имён пользователей хранится в процессе multiprocessing.Manager.
+    Поток наблюдения освобождает имена и сокет шины аварийно
+    завершившегося процесса и перезапускает его.
+    '''
+
+    def __init__(self, count, listen_address, listen_port, database_path, **options):
+        self.context = multiprocessing.get_context('spawn')
+        self.manager = self.context.Manager()
+        self.registry = self.manager.dict()
+        # Каждый процесс ждёт команды на остановку из своего канала:
+        # общий multiprocessing.Event блокируется, если один из ждущих
+        # процессов аварийно завершился.
+        self.stopped = threading.Event()
+        self.stoppers = dict()
+        self.bus_path = tempfile.mkdtemp(prefix='server_bus_')
+        self.args = (listen_address, listen_port, database_path)
+        self.options = options
+        self.count = count
+        self.processes = []
+        # Поток наблюдения за процессами и канал его пробуждения при остановке.
+        self.watcher = threading.Thread(target=self.watch, daemon=True)
+        self.wakeup_reader, self.wakeup_writer = self.context.Pipe(duplex=False)
+
+    def spawn(self, worker):
+        '''Метод запускающий процесс сервера с номером worker.'''
+        stopped, self.stoppers[worker] = self.context.Pipe(duplex=False)
+        process = self.context.Process(
+            target=run_worker, daemon=True,
+            args=(worker, *self.args, self.bus_path, self.registry,
+                  stopped, self.options))
+        process.start()
+        # Конец канала остановки нужен только запущенному процессу.
+        stopped.close()
+        return process
+
+    def start(self):
+        '''Метод запускающий процессы.'''
+        self.processes = [self.spawn(worker) for worker in range(self.count)]
+        self.watcher.start()
+        logger.info(f'Запущено процессов сервера: {len(self.processes)}')
+
+    def watch(self):
+        '''Метод - цикл потока наблюдения за процессами.'''
+        while not self.stopped.is_set():
+            sentinels = {process.sentinel: worker
+                         for worker, process in enumerate(self.processes)}
+            ready = multiprocessing.connection.wait(
+                list(sentinels) + [self.wakeup_reader])
+            if self.stopped.is_set():
+                return
+            for sentinel in ready:
+                if sentinel in sentinels:
+                    self.restart(sentinels[sentinel])
+
+    def restart(self, worker):
+        '''Метод перезапуска аварийно завершившегося процесса.'''
+        process = self.processes[worker]
+        process.join()
+        logger.error(
+            f'Процесс сервера {worker} завершился с кодом {process.exitcode}, перезапуск.')
+        self.release(worker)
+        time.sleep(WORKER_RESTART_DELAY)
+        if self.stopped.is_set():
+            return
+        self.stoppers[worker].close()
+        self.processes[worker] = self.spawn(worker)
+
+    def release(self, worker):
+        '''
+        Метод освобождающий имена пользователей и сокет шины процесса,
+        завершившегося без освобождения своих ресурсов.
+        '''
+        for name, owner in list(self.registry.items()):
+            if owner == worker:
+                self.registry.pop(name, None)
+        try:
+            os.unlink(socket_path(self.bus_path, worker))
+        except FileNotFoundError:
+            pass
+
+    def stop(self):
+        '''Метод останавливающий процессы и удаляющий каталог шины.'''
+        self.stopped.set()
+        self.wakeup_writer.send(None)
+        self.watcher.join()
+        for stopper in self.stoppers.values():
+            stopper.close()
+        for process in self.processes:
+            process.join()
+        self.manager.shutdown()
+        shutil.rmtree(self.bus_path, ignore_errors=True)
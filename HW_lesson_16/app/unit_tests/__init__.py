@@ -0,0 +1,16 @@
+import logging
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import logs.config_server_log
+import logs.config_client_log
+
+# Тесты не пишут в логи приложения: обработчики логеров сервера
+# и клиента заменяются пустым обработчиком.
+for name in ('server_dist', 'client_dist'):
+    logger = logging.getLogger(name)
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+    logger.addHandler(logging.NullHandler())
@@ -0,0 +1,129 @@
+import sys
+import os
+import unittest
+import json
+import base64
+import zlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from common.variables import *
+from common.utils import FrameDecoder, encode_message, decode_message
+from common import codec
+
+PEM = '-----BEGIN PUBLIC KEY-----\n' + '\n'.join(
+    ['A' * 64] * 3 + ['AQAB']) + '\n-----END PUBLIC KEY-----'
+
+
+class TestCodec(unittest.TestCase):
+    '''Тесты двоичного формата кадров.'''
+    test_message = {
+        ACTION: MESSAGE,
+        TIME: 1111111.111111,
+        SENDER: 'test1',
+        DESTINATION: 'test2',
+        MESSAGE_TEXT: base64.b64encode(os.urandom(100)).decode('ascii'),
+        REQUEST_ID: 2 ** 40,
+    }
+
+    def test_round_trip(self):
+        self.assertEqual(codec.loads(codec.dumps(self.test_message)),
+                         self.test_message)
+
+    def test_smaller_than_json(self):
+        self.assertLess(len(codec.dumps(self.test_message)),
+                        len(json.dumps(self.test_message)))
+
+    def test_values(self):
+        message = {
+            RESPONSE: 202,
+            LIST_INFO: [['key', 'change', 'test1'], None, True, False, -1, 0.5],
+            'unknown_key': {'nested': 'значение'},
+            DATA: 'not base64 !',
+            PUBLIC_KEY: PEM,
+            VERSION: 2 ** 70,
+        }
+        self.assertEqual(codec.loads(codec.dumps(message)), message)
+
+    def test_pem_is_packed(self):
+        message = {PUBLIC_KEY: PEM}
+        self.assertLess(len(codec.dumps(message)), len(PEM))
+        self.assertEqual(codec.loads(codec.dumps(message)), message)
+
+    def test_decode_message(self):
+        frame = encode_message(self.test_message, BINARY_CODEC)
+        self.assertEqual(decode_message(frame[4:]), self.test_message)
+
+    def test_mixed_formats(self):
+        decoder = FrameDecoder()
+        decoder.feed(encode_message({RESPONSE: 200}, BINARY_CODEC) +
+                     encode_message({RESPONSE: 400, ERROR: 'err'}))
+        self.assertEqual(list(decoder.messages),
+                         [{RESPONSE: 200}, {RESPONSE: 400, ERROR: 'err'}])
+
+    def test_truncated(self):
+        payload = codec.dumps(self.test_message)
+        self.assertRaises(TypeError, codec.loads, payload[:-1])
+
+    def test_trailing_bytes(self):
+        payload = codec.dumps(self.test_message)
+        self.assertRaises(TypeError, codec.loads, payload + b'\0')
+
+    def test_not_dict(self):
+        self.assertRaises(TypeError, codec.loads, codec.dumps([1, 2]))
+
+    def test_unknown_type(self):
+        self.assertRaises(TypeError, codec.loads, bytes((codec.BINARY_MARKER, 0xff)))
+
+    def test_too_deep(self):
+        message = {}
+        for _ in range(codec.MAX_DEPTH + 1):
+            message = {USER: message}
+        self.assertRaises(ValueError, codec.dumps, message)
+
+
+class TestDeflate(unittest.TestCase):
+    '''Тесты сжатия кадров потоком соединения.'''
+    test_list = {RESPONSE: 202, LIST_INFO: [f'user{i}' for i in range(500)]}
+
+    def test_round_trip(self):
+        compressor = zlib.compressobj()
+        frame = encode_message(self.test_list, compressor=compressor)
+        self.assertTrue(codec.is_compressed(frame))
+        self.assertLess(len(frame), len(json.dumps(self.test_list)))
+        decoder = FrameDecoder()
+        decoder.feed(frame)
+        self.assertEqual(decoder.messages.popleft(), self.test_list)
+
+    def test_short_frame_not_compressed(self):
+        frame = encode_message({RESPONSE: 200}, compressor=zlib.compressobj())
+        self.assertFalse(codec.is_compressed(frame))
+
+    def test_stream(self):
+        '''Кадры соединения сжимаются одним потоком и идут вперемешку с несжатыми.'''
+        compressor = zlib.compressobj()
+        frames = [encode_message(self.test_list, compressor=compressor),
+                  encode_message({RESPONSE: 200}, BINARY_CODEC, compressor),
+                  encode_message(self.test_list, compressor=compressor)]
+        # Повторные данные сжимаются лучше благодаря общему словарю потока.
+        self.assertLess(len(frames[2]), len(frames[0]))
+        decoder = FrameDecoder()
+        data = b''.join(frames)
+        for i in range(0, len(data), 7):
+            decoder.feed(data[i:i + 7])
+        self.assertEqual(list(decoder.messages),
+                         [self.test_list, {RESPONSE: 200}, self.test_list])
+
+    def test_corrupted(self):
+        payload = codec.deflate(zlib.compressobj(), json.dumps(self.test_list).encode())
+        broken = payload[:1] + b'\xff' * 8 + payload[9:]
+        self.assertRaises(TypeError, codec.inflate, zlib.decompressobj(), broken)
+
+    def test_bomb(self):
+        '''Распакованный кадр не может превышать MAX_FRAME_LENGTH.'''
+        payload = codec.deflate(zlib.compressobj(), b' ' * (MAX_FRAME_LENGTH + 1))
+        self.assertRaises(TypeError, codec.inflate, zlib.decompressobj(), payload)
+
+
+if __name__ == '__main__':
+    unittest.main()
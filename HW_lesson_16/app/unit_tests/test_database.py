@@ -0,0 +1,137 @@
+import sys
+import os
+import unittest
+import tempfile
+import types
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from sqlalchemy.orm import clear_mappers
+from server.database import ServerStorage
+from client.database import ClientDatabase
+from client.transport import ClientTransport
+
+
+class TestChanges(unittest.TestCase):
+    '''Тесты журнала изменений списков сервера.'''
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.TemporaryDirectory()
+        cls.database = ServerStorage(
+            os.path.join(cls.directory.name, 'server.db3'))
+        for name in ('test1', 'test2', 'test3'):
+            cls.database.add_user(name, b'hash')
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.database.database_engine.dispose()
+        cls.directory.cleanup()
+        # Мапперы классов хранилища создаются заново следующим тестом.
+        clear_mappers()
+
+    def test_version_grows(self):
+        version = self.database.get_version()
+        self.database.add_contact('test1', 'test2')
+        self.assertEqual(self.database.get_version(), version + 1)
+        self.database.remove_contact('test1', 'test2')
+        self.assertEqual(self.database.get_version(), version + 2)
+
+    def test_changes_after(self):
+        version = self.database.get_version()
+        self.database.add_contact('test1', 'test3')
+        self.database.user_login('test2', '127.0.0.1', 7777, 'new key')
+        self.assertEqual(self.database.changes_after(version), (version + 2, [
+            ('contact', 'add', 'test3', 'test1'),
+            ('key', 'change', 'test2', None)]))
+        self.assertEqual(self.database.changes_after(version + 2),
+                         (version + 2, []))
+
+    def test_get_changes_filters_owner(self):
+        '''Изменения чужих контактов пользователю не передаются.'''
+        version = self.database.get_version()
+        self.database.add_contact('test2', 'test1')
+        self.database.add_contact('test3', 'test1')
+        self.assertEqual(self.database.get_changes('test3', version),
+                         (version + 2, [['contact', 'add', 'test1']]))
+        self.assertEqual(self.database.get_changes('test1', version),
+                         (version + 2, []))
+
+    def test_get_changes_unknown_version(self):
+        version = self.database.get_version()
+        self.assertIsNone(self.database.get_changes('test1', version + 1))
+
+    def test_duplicate_contact_not_logged(self):
+        self.database.add_contact('test3', 'test2')
+        version = self.database.get_version()
+        self.database.add_contact('test3', 'test2')
+        self.assertEqual(self.database.get_version(), version)
+
+
+class TestPruning(unittest.TestCase):
+    '''Тесты ограничения журнала изменений.'''
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.TemporaryDirectory()
+        cls.database = ServerStorage(
+            os.path.join(cls.directory.name, 'server.db3'), changes_limit=3)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.database.database_engine.dispose()
+        cls.directory.cleanup()
+        clear_mappers()
+
+    def test_prune(self):
+        for i in range(6):
+            self.database.add_user(f'test{i}', b'hash')
+        self.database.prune_changes(self.database.get_version())
+        # Версия не сбрасывается, изменения последних версий доступны.
+        self.assertEqual(self.database.get_version(), 6)
+        self.assertEqual(self.database.get_changes('test0', 3),
+                         (6, [['user', 'add', f'test{i}'] for i in (3, 4, 5)]))
+        self.assertEqual(self.database.changes_after(4)[0], 6)
+        # Клиент со старой версией загружает списки целиком.
+        self.assertIsNone(self.database.get_changes('test0', 2))
+        self.assertEqual(self.database.changes_after(2), (6, None))
+
+
+class TestApplyChanges(unittest.TestCase):
+    '''Тесты применения изменений списков на клиенте.'''
+
+    @classmethod
+    def setUpClass(cls):
+        cls.database = ClientDatabase('unit_test_sync')
+        # Метод транспорта использует только базу клиента.
+        cls.transport = types.SimpleNamespace(database=cls.database)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.database.session.close()
+        cls.database.database_engine.dispose()
+        os.remove(cls.database.database_engine.url.database)
+        clear_mappers()
+
+    def apply(self, changes, version):
+        ClientTransport.apply_changes(self.transport, changes, version)
+
+    def test_apply(self):
+        self.database.add_users(['test1', 'test2'])
+        self.database.save_pubkey('test2', 'old key')
+        self.apply([['user', 'add', 'test3'],
+                    ['contact', 'add', 'test3'],
+                    ['key', 'change', 'test2'],
+                    ['user', 'remove', 'test1']], 10)
+        self.assertEqual(sorted(self.database.get_users()), ['test2', 'test3'])
+        self.assertEqual(self.database.get_contacts(), ['test3'])
+        self.assertIsNone(self.database.get_pubkey('test2'))
+        self.assertEqual(self.database.get_version(), 10)
+
+        self.apply([['contact', 'remove', 'test3']], 11)
+        self.assertEqual(self.database.get_contacts(), [])
+        self.assertEqual(self.database.get_version(), 11)
+
+
+if __name__ == '__main__':
+    unittest.main()
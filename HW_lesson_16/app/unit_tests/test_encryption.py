@@ -0,0 +1,67 @@
+import sys
+import os
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from Crypto.PublicKey import RSA
+from Crypto.Cipher import PKCS1_OAEP
+from common.variables import SESSION_KEY_MESSAGES
+from client.encryption import SessionEncryptor, MessageDecrypter
+
+
+class TestEncryption(unittest.TestCase):
+    '''Тесты гибридного шифрования сообщений.'''
+
+    @classmethod
+    def setUpClass(cls):
+        cls.keys = RSA.generate(2048)
+        cls.other_keys = RSA.generate(2048)
+
+    def setUp(self):
+        self.encryptor = SessionEncryptor(self.keys.publickey())
+        self.decrypter = MessageDecrypter(self.keys)
+
+    def test_round_trip(self):
+        for data in (b'', 'Привет'.encode('utf-8'), os.urandom(100000)):
+            self.assertEqual(self.decrypter.decrypt(self.encryptor.encrypt(data)), data)
+
+    def test_session_key_reused(self):
+        '''Сеансовый ключ расшифровывается один раз.'''
+        first = self.encryptor.encrypt(b'first')
+        second = self.encryptor.encrypt(b'second')
+        self.assertNotEqual(first, second)
+        self.decrypter.decrypt(first)
+        self.decrypter.decrypt(second)
+        self.assertEqual(len(self.decrypter.session_keys), 1)
+
+    def test_rotation(self):
+        wrapped = self.encryptor.wrapped
+        for _ in range(SESSION_KEY_MESSAGES):
+            self.encryptor.encrypt(b'x')
+        self.assertEqual(self.encryptor.wrapped, wrapped)
+        data = self.encryptor.encrypt(b'rotated')
+        self.assertNotEqual(self.encryptor.wrapped, wrapped)
+        self.assertEqual(self.decrypter.decrypt(data), b'rotated')
+
+    def test_legacy_rsa(self):
+        '''Сообщения старых клиентов, целиком зашифрованные RSA.'''
+        data = PKCS1_OAEP.new(self.keys.publickey()).encrypt(b'legacy')
+        self.assertEqual(self.decrypter.decrypt(data), b'legacy')
+
+    def test_tampered(self):
+        data = bytearray(self.encryptor.encrypt(b'message'))
+        data[-1] ^= 1
+        self.assertRaises(ValueError, self.decrypter.decrypt, bytes(data))
+
+    def test_wrong_key(self):
+        data = self.encryptor.encrypt(b'message')
+        self.assertRaises(ValueError, MessageDecrypter(self.other_keys).decrypt, data)
+
+    def test_unknown_format(self):
+        self.assertRaises(ValueError, self.decrypter.decrypt, b'\x02' + b'\0' * 300)
+        self.assertRaises(ValueError, self.decrypter.decrypt, b'\x01')
+
+
+if __name__ == '__main__':
+    unittest.main()
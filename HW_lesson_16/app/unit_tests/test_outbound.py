@@ -0,0 +1,114 @@
+import sys
+import os
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from server.outbound import OutboundQueue, MAX_IOV
+
+
+class TestSocket:
+    '''
+    Тестовый неблокирующий сокет: за один вызов принимает не более
+    limit байтов и запоминает всё отправленное.
+    '''
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.sent = b''
+        self.calls = 0
+
+    def sendmsg(self, buffers):
+        self.calls += 1
+        data = b''.join(bytes(buffer) for buffer in buffers)[:self.limit]
+        if not data:
+            raise BlockingIOError
+        self.sent += data
+        return len(data)
+
+
+class TestPlainSocket:
+    '''Тестовый сокет без sendmsg (как StreamClient).'''
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.sent = b''
+
+    def send(self, data):
+        data = bytes(data)[:self.limit]
+        self.sent += data
+        return len(data)
+
+
+class TestOutboundQueue(unittest.TestCase):
+    frames = [bytes([i]) * 10 for i in range(5)]
+
+    def filled(self, high_water=1000):
+        queue = OutboundQueue(high_water)
+        for frame in self.frames:
+            self.assertTrue(queue.push(frame))
+        return queue
+
+    def test_high_water(self):
+        queue = OutboundQueue(25)
+        self.assertTrue(queue.push(self.frames[0]))
+        self.assertTrue(queue.push(self.frames[1]))
+        self.assertFalse(queue.push(self.frames[2]))
+        self.assertEqual(len(queue), 20)
+
+    def test_empty_accepts_any_frame(self):
+        queue = OutboundQueue(5)
+        self.assertTrue(queue.push(b'x' * 100))
+        self.assertFalse(queue.push(b'x'))
+
+    def test_send_all(self):
+        queue = self.filled()
+        sock = TestSocket(1000)
+        self.assertEqual(queue.send(sock), 50)
+        self.assertEqual(sock.sent, b''.join(self.frames))
+        self.assertEqual(sock.calls, 1)
+        self.assertEqual(len(queue), 0)
+        self.assertFalse(queue)
+
+    def test_partial_send(self):
+        '''Неотправленный остаток кадра отправляется следующим вызовом.'''
+        queue = self.filled()
+        sock = TestSocket(7)
+        while queue:
+            queue.send(sock)
+        self.assertEqual(sock.sent, b''.join(self.frames))
+        self.assertEqual(queue.offset, 0)
+
+    def test_room_after_send(self):
+        queue = self.filled(50)
+        self.assertFalse(queue.push(b'x'))
+        queue.send(TestSocket(15))
+        self.assertEqual(len(queue), 35)
+        self.assertTrue(queue.push(b'x' * 15))
+
+    def test_iov_limit(self):
+        queue = OutboundQueue(10000)
+        for i in range(MAX_IOV + 10):
+            queue.push(b'x')
+        sock = TestSocket(10000)
+        self.assertEqual(queue.send(sock), MAX_IOV)
+        self.assertEqual(len(queue), 10)
+
+    def test_would_block(self):
+        queue = self.filled()
+        self.assertRaises(BlockingIOError, queue.send, TestSocket(0))
+        self.assertEqual(len(queue), 50)
+
+    def test_plain_send(self):
+        queue = self.filled()
+        sock = TestPlainSocket(25)
+        while queue:
+            queue.send(sock)
+        self.assertEqual(sock.sent, b''.join(self.frames))
+
+    def test_send_empty(self):
+        self.assertEqual(OutboundQueue(10).send(TestSocket(10)), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
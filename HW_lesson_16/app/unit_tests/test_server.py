@@ -0,0 +1,256 @@
+import sys
+import os
+import unittest
+import socket
+import struct
+import tempfile
+import time
+import hashlib
+import hmac
+import binascii
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from common.variables import *
+from common.utils import send_message, get_message
+from sqlalchemy.orm import clear_mappers
+from server.core import MessageProcessor
+from server.async_core import AsyncMessageProcessor
+from server.database import ServerStorage
+
+
+def free_port():
+    '''Функция возвращающая свободный порт.'''
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def password_hash(name):
+    return binascii.hexlify(hashlib.pbkdf2_hmac(
+        'sha512', b'pw', name.encode('utf-8'), 10000))
+
+
+class TestServer(unittest.TestCase):
+    '''Тесты MessageProcessor с подключением по сети.'''
+
+    # Класс тестируемого обработчика сообщений.
+    processor = MessageProcessor
+
+    @classmethod
+    def setUpClass(cls):
+        # Классические мапперы позволяют создать хранилище один раз на процесс.
+        cls.directory = tempfile.TemporaryDirectory()
+        cls.database = ServerStorage(
+            os.path.join(cls.directory.name, 'server.db3'))
+        for name in ('alice', 'bob'):
+            cls.database.add_user(name, password_hash(name))
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.database.database_engine.dispose()
+        cls.directory.cleanup()
+        clear_mappers()
+
+    def setUp(self):
+        self.clients = []
+        self.start_server()
+
+    def start_server(self, **options):
+        self.port = free_port()
+        self.server = self.processor(
+            '127.0.0.1', self.port, self.database, **options)
+        self.server.daemon = True
+        self.server.start()
+        for _ in range(50):
+            try:
+                socket.create_connection(('127.0.0.1', self.port)).close()
+                break
+            except OSError:
+                time.sleep(0.05)
+
+    def tearDown(self):
+        for client in self.clients:
+            client.close()
+        self.stop_server()
+
+    def stop_server(self):
+        self.server.stop()
+        self.server.join(5)
+
+    def connect(self, rcvbuf=None):
+        client = socket.socket()
+        if rcvbuf:
+            client.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+        client.settimeout(5)
+        client.connect(('127.0.0.1', self.port))
+        self.clients.append(client)
+        return client
+
+    def presence(self, client, name):
+        send_message(client, {ACTION: PRESENCE, TIME: 1,
+                              USER: {ACCOUNT_NAME: name, PUBLIC_KEY: 'key'}})
+        return get_message(client)
+
+    def answer(self, client, challenge, name, valid=True):
+        digest = hmac.new(password_hash(name), challenge[DATA].encode('ascii'),
+                          'MD5').digest()
+        if not valid:
+            digest = b'wrong'
+        send_message(client, {RESPONSE: 511,
+                              DATA: binascii.b2a_base64(digest).decode('ascii')})
+        return get_message(client)
+
+    def login(self, name, rcvbuf=None):
+        client = self.connect(rcvbuf)
+        ans = self.answer(client, self.presence(client, name), name)
+        self.assertEqual(ans[RESPONSE], 200)
+        return client
+
+    def assert_closed(self, client):
+        client.settimeout(5)
+        try:
+            while client.recv(MAX_PACKAGE_LENGTH):
+                pass
+        except ConnectionResetError:
+            pass
+
+    def test_bad_utf8_frame(self):
+        '''Кадр с неверной кодировкой отключает клиента, а не сервер.'''
+        client = self.connect()
+        client.sendall(struct.pack('!I', 2) + b'\xff\xfe')
+        self.assert_closed(client)
+        self.assertTrue(self.server.is_alive())
+        self.login('alice')
+
+    def test_deeply_nested_frame(self):
+        client = self.connect()
+        payload = b'[' * 100000 + b']' * 100000
+        client.sendall(struct.pack('!I', len(payload)) + payload)
+        self.assert_closed(client)
+        self.assertTrue(self.server.is_alive())
+        self.login('alice')
+
+    def test_repeated_presence(self):
+        '''Повторный presence отклоняется и не сбрасывает авторизацию.'''
+        client = self.login('alice')
+        challenge = self.presence(client, 'bob')
+        self.assertEqual(challenge[RESPONSE], 400)
+        # Неверный ответ на запрос 511 не должен отключать клиента.
+        self.assertEqual(self.answer(client, {DATA: ''}, 'bob')[RESPONSE], 400)
+        self.assertTrue(self.server.names['alice'].authorized)
+        client.close()
+        for _ in range(50):
+            if 'alice' not in self.server.names:
+                break
+            time.sleep(0.05)
+        self.assertNotIn('alice', self.server.names)
+        self.login('alice')
+
+    def test_presence_without_user_fields(self):
+        '''Presence без имени или ключа отклоняется, сервер продолжает работу.'''
+        alice = self.login('alice')
+        for user in ({}, {ACCOUNT_NAME: 'bob'}, 'bob', [ACCOUNT_NAME, PUBLIC_KEY]):
+            client = self.connect()
+            send_message(client, {ACTION: PRESENCE, TIME: 1, USER: user})
+            self.assertEqual(get_message(client)[RESPONSE], 400)
+        self.assertTrue(self.server.is_alive())
+        send_message(alice, {ACTION: USERS_REQUEST, TIME: 1, ACCOUNT_NAME: 'alice'})
+        self.assertEqual(get_message(alice)[RESPONSE], 202)
+        self.login('bob')
+
+    def test_handler_error(self):
+        '''Ошибка в обработчике отключает только клиента, приславшего сообщение.'''
+        @MessageProcessor.actions.register('test_error')
+        def fail(processor, message, client):
+            raise KeyError('missing')
+        self.addCleanup(MessageProcessor.actions.actions.pop, 'test_error')
+        alice = self.login('alice')
+        client = self.connect()
+        send_message(client, {ACTION: 'test_error'})
+        self.assert_closed(client)
+        self.assertTrue(self.server.is_alive())
+        send_message(alice, {ACTION: USERS_REQUEST, TIME: 1, ACCOUNT_NAME: 'alice'})
+        self.assertEqual(get_message(alice)[RESPONSE], 202)
+
+    def test_request_id_not_forwarded(self):
+        '''Номер запроса отправителя не попадает в сообщение получателю.'''
+        alice = self.login('alice')
+        bob = self.login('bob')
+        message = {ACTION: MESSAGE, TIME: 1, SENDER: 'alice',
+                   DESTINATION: 'bob', MESSAGE_TEXT: 'text', REQUEST_ID: 7}
+        send_message(alice, message)
+        self.assertEqual(get_message(alice), {RESPONSE: 200, REQUEST_ID: 7})
+        self.assertNotIn(REQUEST_ID, get_message(bob))
+        bob.close()
+        for _ in range(50):
+            if 'bob' not in self.server.names:
+                break
+            time.sleep(0.05)
+        send_message(alice, message)
+        self.assertEqual(get_message(alice), {RESPONSE: 200, REQUEST_ID: 7})
+        stored = self.database.get_offline('bob', 10)
+        self.database.remove_offline('bob', 2 ** 31)
+        self.assertEqual(len(stored), 1)
+        self.assertNotIn(REQUEST_ID, stored[0][1])
+
+    def test_stop_closes_sockets(self):
+        '''Остановленный сервер закрывает слушающий сокет и пару пробуждения.'''
+        self.stop_server()
+        self.assertFalse(self.server.is_alive())
+        for sock in (self.server.sock, self.server.wakeup_reader,
+                     self.server.wakeup_writer):
+            self.assertEqual(sock.fileno(), -1)
+        # Поручения после остановки не приводят к ошибке.
+        self.server.call_threadsafe(print)
+
+    def test_offline_overflow(self):
+        '''
+        При переполнении очереди во время доставки отложенных сообщений
+        из базы удаляются только сообщения, переданные клиенту.
+        '''
+        self.stop_server()
+        self.start_server(outbound_limit=300000)
+        texts = [f'{i:03}' + 'x' * 100000 for i in range(49)]
+        for text in texts:
+            self.database.store_offline('bob', {
+                ACTION: MESSAGE, TIME: 1, SENDER: 'alice', DESTINATION: 'bob',
+                MESSAGE_TEXT: text})
+        # Клиент не читает сообщения, пока сервер его не отключит.
+        client = self.login('bob', rcvbuf=4096)
+        for _ in range(100):
+            if 'bob' not in self.server.names:
+                break
+            time.sleep(0.05)
+        self.assertNotIn('bob', self.server.names)
+        received = []
+        try:
+            while True:
+                received.append(get_message(client)[MESSAGE_TEXT])
+        except (OSError, TypeError):
+            pass
+        left = [message[MESSAGE_TEXT] for _, message in
+                self.database.get_offline('bob', len(texts))]
+        self.assertTrue(left)
+        # Каждое сообщение либо получено, либо осталось в базе.
+        self.assertEqual(sorted(set(received) | set(left)), texts)
+        self.database.remove_offline('bob', 2 ** 31)
+
+
+class TestAsyncServer(TestServer):
+    '''Те же тесты для AsyncMessageProcessor.'''
+
+    processor = AsyncMessageProcessor
+
+    def test_stop_closes_sockets(self):
+        '''Обработчик на asyncio не создаёт пару сокетов пробуждения.'''
+        self.stop_server()
+        self.assertFalse(self.server.is_alive())
+        self.assertIsNone(self.server.wakeup_reader)
+        self.assertIsNone(self.server.wakeup_writer)
+        # Поручения после остановки не приводят к ошибке.
+        self.server.call_threadsafe(print)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+import sys
+import os
+import unittest
+import json
+import struct
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from common.variables import ENCODING, ACTION, PRESENCE, TIME, USER, ACCOUNT_NAME, RESPONSE, ERROR
+from common.utils import FrameDecoder, send_message, get_message, encode_message, decode_message
+
+
+class TestSocket:
+    '''
+    Тестовый сокет: отдаёт заданные порции байтов при каждом recv
+    и запоминает всё отправленное.
+    '''
+
+    def __init__(self, chunks=()):
+        self.chunks = list(chunks)
+        self.sent = b''
+
+    def sendall(self, data):
+        self.sent += data
+
+    def recv(self, max_len):
+        return self.chunks.pop(0) if self.chunks else b''
+
+
+def frame(payload):
+    '''Функция упаковки полезной нагрузки в кадр с заголовком длины.'''
+    return struct.pack('!I', len(payload)) + payload
+
+
+class TestUtils(unittest.TestCase):
+    test_dict_send = {
+        ACTION: PRESENCE,
+        TIME: 1111111.111111,
+        USER: {
+            ACCOUNT_NAME: 'test_test'
+        }
+    }
+    test_dict_recv_ok = {RESPONSE: 200}
+    test_dict_recv_err = {
+        RESPONSE: 400,
+        ERROR: 'Bad request'
+    }
+
+    def test_send_message_ok(self):
+        test_socket = TestSocket()
+        send_message(test_socket, self.test_dict_send)
+        self.assertEqual(test_socket.sent, encode_message(self.test_dict_send))
+
+    def test_get_message_ok(self):
+        test_sock_ok = TestSocket([encode_message(self.test_dict_recv_ok)])
+        self.assertEqual(get_message(test_sock_ok), self.test_dict_recv_ok)
+
+    def test_get_message_err(self):
+        test_sock_err = TestSocket([encode_message(self.test_dict_recv_err)])
+        self.assertEqual(get_message(test_sock_err), self.test_dict_recv_err)
+
+    def test_get_message_closed(self):
+        self.assertRaises(ConnectionResetError, get_message, TestSocket())
+
+    def test_split_frame(self):
+        data = encode_message(self.test_dict_send)
+        test_socket = TestSocket([data[:3], data[3:10], data[10:]])
+        self.assertEqual(get_message(test_socket), self.test_dict_send)
+
+    def test_coalesced_frames(self):
+        decoder = FrameDecoder()
+        data = encode_message(self.test_dict_recv_ok) + \
+            encode_message(self.test_dict_recv_err)
+        self.assertEqual(decoder.feed(data + data[:5]), 2)
+        self.assertEqual(list(decoder.messages),
+                         [self.test_dict_recv_ok, self.test_dict_recv_err])
+        self.assertEqual(decoder.feed(data[5:]), 2)
+
+    def test_not_dict(self):
+        self.assertRaises(TypeError, decode_message, b'[1, 2]')
+
+    def test_bad_json(self):
+        self.assertRaises(TypeError, decode_message, b'{"a": ')
+
+    def test_bad_utf8(self):
+        self.assertRaises(TypeError, FrameDecoder().feed, frame(b'\xff\xfe'))
+
+    def test_deep_nesting(self):
+        payload = (b'{"a":' + b'[' * 100000 + b']' * 100000 + b'}')
+        self.assertRaises(TypeError, decode_message, payload)
+
+    def test_frame_too_long(self):
+        self.assertRaises(TypeError, FrameDecoder().feed, struct.pack('!I', 2 ** 31))
+
+
+if __name__ == '__main__':
+    unittest.main()